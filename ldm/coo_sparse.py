@@ -5,73 +5,93 @@ import torch
 import copy
 import numpy as np
 
+def _flat_view(tensor):
+    """Flat NumPy view of a CPU tensor's memory (a copy only if it is not contiguous)."""
+    return tensor.detach().cpu().contiguous().view(-1).numpy()
+
+
 class COOSparseTensor:
+    """
+    Sparse tensor of nnz values at flat int32 positions into a dense tensor
+    of the given shape. values is a torch tensor, a list or, after encrypt(),
+    a CKKSVector. Tensors derived from one another share the index arrays.
+    """
+    __slots__ = ("values", "flat_indices", "shape", "_indices")
+
     def __init__(self, values, indices, shape):
-        #assert len(values) == len(indices), "Length of values and indices must match"
         self.values = values
-        # Convert index lists to tuples in the initialization
-        if isinstance(indices, torch.Tensor):
-            self.indices = np.array(indices)
-        else:
-            self.indices = np.array([tuple(index) for index in indices])
-        self.shape = shape
+        self.shape = tuple(int(s) for s in shape)
+        indices = indices.cpu().numpy() if isinstance(indices, torch.Tensor) else np.asarray(indices)
+        if indices.ndim == 2:
+            # (nnz, ndim) coordinates
+            indices = np.ravel_multi_index(tuple(indices.T), self.shape) if len(indices) else indices[:, 0]
+        assert int(np.prod(self.shape)) < 2 ** 31, "int32 flat indices"
+        self.flat_indices = indices.astype(np.int32, copy=False)
+        self._indices = None
+
+    @property
+    def indices(self):
+        """(nnz, ndim) coordinates, unravelled once and cached."""
+        if self._indices is None:
+            self._indices = np.stack(np.unravel_index(self.flat_indices, self.shape), axis=1)
+        return self._indices
+
+    def _derive(self, values):
+        out = COOSparseTensor.__new__(COOSparseTensor)
+        out.values, out.flat_indices, out.shape, out._indices = values, self.flat_indices, self.shape, self._indices
+        return out
+
+    def _gather(self, dense):
+        # single fancy-indexing op on a NumPy view of the tensor, no index conversion
+        values = _flat_view(dense)[self.flat_indices]
+        if isinstance(self.values, ts.tensors.ckksvector.CKKSVector):
+            return values.astype(np.float64).tolist()
+        return torch.from_numpy(values)
+
+    def _plain_values(self):
+        if isinstance(self.values, torch.Tensor):
+            return self.values.detach().cpu()
+        return torch.as_tensor(self.values)
 
     def to_dense(self):
         if isinstance(self.values, ts.tensors.ckksvector.CKKSVector):
             print("Wrong, encrypted tensor can not be dense")
             exit()
-        dense_tensor = self._initialize_dense_tensor(self.shape)
-        for value, index in zip(self.values, self.indices):
-            self._set_value(dense_tensor, index, value)
-        return dense_tensor
+        dense = np.zeros(int(np.prod(self.shape)))
+        dense[self.flat_indices] = self._plain_values().numpy()
+        return dense.reshape(self.shape).tolist()
 
     def merge_tensor(self, dense_tensor_ori):
-        dense_tensor = copy.deepcopy(dense_tensor_ori)
         #replace the elements in the dense tensor by coo tensor
         if isinstance(dense_tensor_ori, torch.Tensor):
-            for value, index in zip(self.values, self.indices):
-                dense_tensor[tuple(index)] = value
-            return dense_tensor
-        for value, index in zip(self.values, self.indices):
+            dense_tensor = dense_tensor_ori.detach().cpu().clone(memory_format=torch.contiguous_format)
+            _flat_view(dense_tensor)[self.flat_indices] = self._plain_values().to(dense_tensor.dtype).numpy()
+            return dense_tensor.to(dense_tensor_ori.device)
+        dense_tensor = copy.deepcopy(dense_tensor_ori)
+        for value, index in zip(self._plain_values().tolist(), self.indices):
             self._set_value(dense_tensor, index, value)
         return dense_tensor
 
     def encrypt(self, context):
         #self.values = [ts.ckks_tensor(context, [i]) for i in self.values]
-        self.values = ts.ckks_vector(context, self.values)
-        #pass
+        self.values = ts.ckks_vector(context, self._plain_values().double().tolist())
 
     def decrypt_inplace(self):
-        #self.values = [i.decrypt().tolist()[0] for i in self.values]
-        self.values = self.values.decrypt()
+        self.values = torch.tensor(self.values.decrypt())
 
     def decrypt(self):
-        #values = [i.decrypt().tolist()[0] for i in self.values]
-        values = self.values.decrypt()
-        return COOSparseTensor(values, self.indices, self.shape)
-        #return COOSparseTensor(self.values, self.indices, self.shape)
+        return self._derive(torch.tensor(self.values.decrypt()))
 
     def __add__(self, other):
         if isinstance(other, torch.Tensor):
-            #values = {index: value for index, value in zip(self.indices, self.values)}
-            #for index in self.indices:
-            #    values[index] = values[index] + other[index]
-            #new_indices, new_values = zip(*values.items())
-            #new_indices = [list(index) for index in new_indices]
-            values = other[self.indices.T]
-            new_values = self.values + values
-            new_indices = self.indices
+            return self._derive(self.values + self._gather(other))
         elif isinstance(other, (int, float)):
-            new_values = self.values + other
-        
-        return COOSparseTensor(new_values, new_indices, self.shape)
+            return self._derive(self.values + other)
+        raise ValueError("Unsupported operand type for add: '{}'".format(type(other)))
 
     def __mul__(self, other):
         if isinstance(other, torch.Tensor):
-            values = other[self.indices.T]
-            new_values = self.values * values
-            return COOSparseTensor(new_values, self.indices, self.shape)
-
+            return self._derive(self.values * self._gather(other))
         elif isinstance(other, (int, float)):
             return self._scalar_mul(other)
         else:
@@ -79,16 +99,10 @@ class COOSparseTensor:
 
     def __rmul__(self, other):
         return self.__mul__(other)
-            
+
     def _scalar_mul(self, scalar):
-        result_values = scalar * self.values
         # Indices remain unchanged for scalar multiplication
-        return COOSparseTensor(result_values, self.indices, self.shape)
-
-    def _initialize_dense_tensor(self, shape):
-        if len(shape) == 1:
-            return [0] * shape[0]
-        return [self._initialize_dense_tensor(shape[1:]) for _ in range(shape[0])]
+        return self._derive(self.values * scalar)
 
     def _set_value(self, tensor, index, value):
         for i in index[:-1]:
@@ -97,10 +111,9 @@ class COOSparseTensor:
 
 def dense_to_coo(dense_tensor, prefix=[]):
     if isinstance(dense_tensor, torch.Tensor):
-        indices = dense_tensor.nonzero(as_tuple=True)
-        values = dense_tensor[indices]
-        indices = dense_tensor.nonzero()
-        return values, indices
+        flat = dense_tensor.detach().cpu().reshape(-1)
+        indices = flat.nonzero().view(-1)
+        return flat[indices], indices.to(torch.int32)
     if isinstance(dense_tensor[0], list):  # Check if the first element is a list (indicative of higher dimensions)
         values = []
         indices = []
@@ -123,6 +136,7 @@ def convert_dense_to_coo(dense_tensor):
         while isinstance(temp[0], list):
             shape.append(len(temp[0]))
             temp = temp[0]
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1, len(shape))
     return COOSparseTensor(values, indices, shape)
 
 def get_encryption_context():
@@ -0,0 +1,179 @@
+"""Sharded, memory-mapped store of retrieval embeddings.
+
+A retrieval database (directory of .npz files with 'embedding', 'img_id',
+'patch_coords', ...) is converted once, file by file and in chunks, into
+shards of .npy files that are memory mapped on open. Embeddings are stored
+L2-normalized, optionally as float16, next to their float32 norms, so
+nothing has to be normalized at load time and the pool never has to fit in
+RAM; the other keys are stored as they are.
+
+Layout of a store directory:
+    store.json                      dim, dtype, keys and rows per shard
+    shard_00000.embedding.npy       unit embeddings, (rows, dim)
+    shard_00000.norms.npy           float32 norms of the original embeddings
+    shard_00000.<key>.npy           the other arrays of the database
+"""
+
+import os
+import json
+import glob
+
+import numpy as np
+
+from ldm.util import npz_member_header
+
+
+class EmbeddingStore(object):
+    META = "store.json"
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.META)) as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.keys = meta["keys"]
+        self.shard_rows = meta["shard_rows"]
+        self.offsets = np.cumsum([0] + self.shard_rows)
+        self.arrays = {key: [np.load(self._shard_file(i, key), mmap_mode="r") for i in range(len(self.shard_rows))]
+                       for key in self.keys + ["norms"]}
+
+    def _shard_file(self, i, key):
+        return os.path.join(self.path, f"shard_{i:05d}.{key}.npy")
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, EmbeddingStore.META))
+
+    def take(self, key, indices):
+        """Rows of key at global indices of any shape, embeddings as float32 unit vectors."""
+        indices = np.asarray(indices)
+        flat = indices.reshape(-1)
+        if len(flat) > 0 and (flat.min() < 0 or flat.max() >= len(self)):
+            # e.g. the -1 padding of a search that found fewer neighbours than asked for
+            raise IndexError(f"indices out of range for a store of length {len(self)}")
+        shard = np.searchsorted(self.offsets, flat, side="right") - 1
+        first = self.arrays[key][0]
+        out = np.empty((len(flat),) + first.shape[1:], dtype=np.float32 if key == "embedding" else first.dtype)
+        for i in np.unique(shard):
+            sel = shard == i
+            out[sel] = self.arrays[key][i][flat[sel] - self.offsets[i]]
+        return out.reshape(indices.shape + first.shape[1:])
+
+    def __getitem__(self, key):
+        """A whole key in memory, meant for the small ones (ids, coordinates)."""
+        return np.concatenate(self.arrays[key], axis=0)
+
+    def chunks(self, chunk_rows=65536, normalized=True):
+        """Yield (start, float32 embeddings) in order; normalized=False restores the original vectors."""
+        for i, (shard, norms) in enumerate(zip(self.arrays["embedding"], self.arrays["norms"])):
+            for start in range(0, len(shard), chunk_rows):
+                chunk = np.asarray(shard[start:start + chunk_rows], dtype=np.float32)
+                if not normalized:
+                    chunk = chunk * norms[start:start + chunk_rows, None]
+                yield int(self.offsets[i]) + start, chunk
+
+    def normalized_embeddings(self, chunk_rows=65536):
+        """
+        All unit embeddings as one float32 (N, dim) array for searcher
+        training: the shard itself for a single float32 shard, otherwise a
+        memory-mapped float32 copy written chunk by chunk once and reused.
+        """
+        if len(self.shard_rows) == 1 and self.dtype == np.float32:
+            return self.arrays["embedding"][0]
+        path = os.path.join(self.path, "embedding.float32.npy")
+        if os.path.exists(path):
+            out = np.load(path, mmap_mode="r")
+            if out.shape == (len(self), self.dim):
+                return out
+        tmp = f"{path}.tmp"
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(len(self), self.dim))
+        for start, chunk in self.chunks(chunk_rows):
+            out[start:start + len(chunk)] = chunk
+        out.flush()
+        del out
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode="r")
+
+    @classmethod
+    def build(cls, npz_paths, path, dtype="float32", shard_size=1 << 20, chunk_rows=65536):
+        """
+        Convert .npz files into a store at path, one file in memory at a time.
+        Keys missing from some files or holding scalars are dropped.
+        """
+        npz_paths = sorted(npz_paths)
+        headers = dict()
+        for npz_path in npz_paths:
+            with np.load(npz_path) as npz:
+                for key in npz.files:
+                    headers.setdefault(key, []).append(npz_member_header(npz, key))
+        keys = [key for key in headers if len(headers[key]) == len(npz_paths) and len(headers[key][0][0]) > 0]
+        assert "embedding" in keys, f"no 'embedding' array in {npz_paths}"
+        rows = [shape[0] for shape, _, _ in headers["embedding"]]
+        dim = headers["embedding"][0][0][1]
+        total = sum(rows)
+        shard_rows = [min(shard_size, total - start) for start in range(0, total, shard_size)]
+        offsets = np.cumsum([0] + shard_rows)
+        os.makedirs(path, exist_ok=True)
+
+        def shard_file(i, key):
+            return os.path.join(path, f"shard_{i:05d}.{key}.npy")
+
+        def out_dtype(key):
+            return np.dtype(dtype) if key == "embedding" else (np.float32 if key == "norms" else headers[key][0][2])
+
+        def out_shape(key, n):
+            return (n,) if key == "norms" else (n,) + tuple(headers[key][0][0][1:])
+
+        outputs = {key: [np.lib.format.open_memmap(shard_file(i, key), mode="w+", dtype=out_dtype(key),
+                                                   shape=out_shape(key, n)) for i, n in enumerate(shard_rows)]
+                   for key in keys + ["norms"]}
+
+        def write(key, start, values):
+            # values may straddle shard boundaries
+            while len(values) > 0:
+                i = np.searchsorted(offsets, start, side="right") - 1
+                n = min(len(values), offsets[i + 1] - start)
+                outputs[key][i][start - offsets[i]:start - offsets[i] + n] = values[:n]
+                start, values = start + n, values[n:]
+
+        start = 0
+        for npz_path, n in zip(npz_paths, rows):
+            print(f"Adding {n} embeddings from {npz_path}")
+            with np.load(npz_path) as npz:
+                for key in keys:
+                    if key == "embedding":
+                        embeddings = npz[key]
+                        for s in range(0, n, chunk_rows):
+                            chunk = embeddings[s:s + chunk_rows].astype(np.float32)
+                            norms = np.linalg.norm(chunk, axis=1)
+                            chunk /= np.where(norms > 0, norms, 1.)[:, None]
+                            write("embedding", start + s, chunk)
+                            write("norms", start + s, norms)
+                        del embeddings
+                    else:
+                        write(key, start, npz[key])
+            start += n
+
+        for arrays in outputs.values():
+            for array in arrays:
+                array.flush()
+        with open(os.path.join(path, cls.META), "w") as f:
+            json.dump(dict(dim=int(dim), dtype=np.dtype(dtype).name, keys=keys, shard_rows=shard_rows), f, indent=1)
+        print(f"Built embedding store of {total} x {dim} {np.dtype(dtype).name} embeddings in {len(shard_rows)} "
+              f"shards at {path}")
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, database_path, store_path=None, dtype="float32"):
+        """Open the store of a database directory of .npz files, building it on first use."""
+        store_path = store_path or os.path.join(database_path, "store")
+        if cls.exists(store_path):
+            return cls(store_path)
+        npz_paths = glob.glob(os.path.join(database_path, "*.npz"))
+        if len(npz_paths) == 0:
+            raise ValueError(f'No npz-files in specified path "{database_path}" is this directory existing?')
+        return cls.build(npz_paths, store_path, dtype=dtype)
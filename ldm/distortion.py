@@ -8,6 +8,7 @@ import numpy as np
 import math
 import time
 import copy
+import json
 
 def load_image(image_path):
     image = Image.open(image_path).convert('L')
@@ -114,6 +115,12 @@ def additive_distortion(X, Y):
     return additive_distortion, distortion_matrix
 
 def remove_points(image, threshold=0.005):
+    """
+    Copy of image with the cheapest elements (by HILL cost) set to zero while
+    their distortion stays within threshold * the distortion of zeroing all
+    of it. The encrypted samplers encrypt the nonzero elements of the result
+    and keep the zeroed ones, image - result, in plaintext.
+    """
     distortion = 0
     cost = hill_cost_function(image)
     whole_distortion, distortion_matrix = additive_distortion(image, torch.zeros_like(image)) 
@@ -173,6 +180,42 @@ def remove_points(image, threshold=0.005):
 
     return new_image
         
+def revealed_distortion(image, new_image):
+    """Distortion of the points remove_points took out of new_image, i.e. of what stays in plaintext."""
+    return additive_distortion(image, new_image)[0].item()
+
+
+class ThresholdSchedule(object):
+    """
+    remove_points threshold per sampling step, as fitted by
+    scripts/calibrate_thresholds.py. The thresholds are stored with the
+    alpha_t (alphas_cumprod) of their step: a run with the calibrated number of
+    steps uses them as they are, other runs interpolate them over alpha_t.
+    """
+    def __init__(self, alphas, thresholds):
+        assert len(alphas) == len(thresholds)
+        self.alphas = [float(a) for a in alphas]
+        self.thresholds = [float(t) for t in thresholds]
+
+    def __call__(self, i, alpha_t, total_steps):
+        if total_steps == len(self.thresholds):
+            return self.thresholds[i]
+        order = np.argsort(self.alphas)
+        return float(np.interp(alpha_t, np.asarray(self.alphas)[order], np.asarray(self.thresholds)[order]))
+
+    def spec(self):
+        return dict(alphas=self.alphas, thresholds=self.thresholds)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.spec(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+
 def set_zero(image):
     loc = torch.where(torch.isinf(image))
     image[loc] = 0
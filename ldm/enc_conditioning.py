@@ -0,0 +1,68 @@
+"""Prompt embeddings encrypted in transit.
+
+The client encrypts the CLIP embedding of its prompt, one CKKS vector per
+token, and hands the server an EncryptedContext linked to the public context
+only. This is transport encryption, not a privacy mode: the server has the
+client decrypt the embedding once per job and runs the UNet on it in
+plaintext. The cross-attention K/V are then computed once per job by the
+samplers' cross_attention_kv_cache, since the prompt is the same at every
+timestep.
+
+Computing to_k / to_v under HE instead would not hide the prompt either. The
+plaintext UNet needs the K/V in plaintext, and to_k / to_v are public with
+full column rank, so the K/V determine the embedding (a least squares solve
+recovers it). Keeping K/V encrypted through the attention products does not
+help: the softmax needs the q.k scores in plaintext, and with the queries
+known they determine K just the same.
+"""
+
+import time
+
+import numpy as np
+import torch
+import tenseal as ts
+
+from ldm.coo_sparse import get_encryption_context
+
+
+class EncryptedContext(object):
+    def __init__(self, rows, shape, decrypt_fn):
+        self.rows = rows
+        self.shape = torch.Size(shape)
+        self.decrypt_fn = decrypt_fn
+        self.plaintext_cache = None
+
+    def plaintext(self, device=None):
+        """The embedding, decrypted by the client on first use and kept for the rest of the job."""
+        if self.plaintext_cache is None:
+            t0 = time.time()
+            # client round trip: only the key holder can decrypt
+            self.plaintext_cache = self.decrypt_fn(self.rows).float().reshape(self.shape)
+            print(f"decrypted the prompt embedding: {time.time() - t0:.1f}s")
+        if device is not None and self.plaintext_cache.device != torch.device(device):
+            # moved once, so the cached tensor keeps its identity for the K/V cache
+            self.plaintext_cache = self.plaintext_cache.to(device)
+        return self.plaintext_cache
+
+
+class ConditioningClient(object):
+    """The key holder: encrypts prompt embeddings and decrypts them for the server."""
+    def __init__(self, context=None):
+        self.context = context if context is not None else get_encryption_context()
+        self.public_context = self.context.copy()
+        self.public_context.make_context_public()
+
+    def encrypt(self, c):
+        c = c.detach().cpu().double()
+        rows = []
+        for row in c.reshape(-1, c.shape[-1]).tolist():
+            vector = ts.ckks_vector(self.context, row)
+            # the server only gets the public context
+            vector.link_context(self.public_context)
+            rows.append(vector)
+        return EncryptedContext(rows, c.shape, self.decrypt)
+
+    def decrypt(self, vectors):
+        for vector in vectors:
+            vector.link_context(self.context)
+        return torch.tensor(np.array([vector.decrypt() for vector in vectors]))
@@ -0,0 +1,106 @@
+"""Checkpoint / resume of encrypted sampling runs.
+
+After every step ENC_PLMSSampler hands its state to a CiphertextSpool: the
+ciphertext of the encrypted part of x_prev (TenSEAL serialization, which SEAL
+compresses), its positions, the plaintext remainder, the eps history and the
+RNG states. Steps are written by a background thread, each one to a
+temporary file that is renamed when complete, so a crash leaves the last
+finished step readable. The CKKS context, secret key included, is written
+once per run; the spool directory has to stay as private as the key.
+"""
+
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import tenseal as ts
+
+from ldm.coo_sparse import COOSparseTensor
+
+
+class CiphertextSpool(object):
+    def __init__(self, spool_dir, keep=2):
+        self.spool_dir = spool_dir
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.spool_dir, name)
+
+    @staticmethod
+    def _atomic_save(obj, path):
+        tmp = f"{path}.tmp"
+        torch.save(obj, tmp)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _load(path):
+        # the step files hold numpy arrays and bytes, which newer torch only loads with weights_only=False
+        try:
+            return torch.load(path, map_location="cpu", weights_only=False)
+        except TypeError:
+            return torch.load(path, map_location="cpu")
+
+    def save_context(self, context, meta):
+        """Start a new run: drop old steps, store the context and what the run looks like."""
+        self.wait()
+        for path in glob.glob(self._path("step_*.pt")):
+            os.remove(path)
+        self._atomic_save(dict(context=context.serialize(save_secret_key=True), meta=meta), self._path("context.pt"))
+
+    def steps(self):
+        return sorted(int(os.path.basename(p)[5:-3]) for p in glob.glob(self._path("step_*.pt")))
+
+    def write(self, i, coo, remain, old_eps):
+        """Spool the state after step i in the background, the tensors are not modified afterwards."""
+        self.wait()
+        rng = dict(torch=torch.get_rng_state(), numpy=np.random.get_state())
+        if torch.cuda.is_available():
+            rng["cuda"] = torch.cuda.get_rng_state_all()
+        self.pending = self.executor.submit(self._write, i, coo, remain, list(old_eps), rng)
+
+    def _write(self, i, coo, remain, old_eps, rng):
+        state = dict(i=i, ciphertext=coo.values.serialize(), flat_indices=coo.flat_indices, shape=coo.shape,
+                     remain=remain.cpu(), old_eps=[e.cpu() for e in old_eps], rng=rng)
+        self._atomic_save(state, self._path(f"step_{i:04d}.pt"))
+        for old in self.steps()[:-self.keep]:
+            os.remove(self._path(f"step_{old:04d}.pt"))
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            # re-raises errors of the background write, once
+            pending.result()
+
+    def resume(self, meta, device):
+        """
+        Load the context and the last finished step of a run with the same meta,
+        None if there is nothing to resume. Returns (context, i, x_prev, old_eps)
+        and restores the RNG states.
+        """
+        self.wait()
+        steps = self.steps()
+        if not os.path.exists(self._path("context.pt")) or len(steps) == 0:
+            return None
+        saved = self._load(self._path("context.pt"))
+        if saved["meta"] != meta:
+            print(f"Spooled run in {self.spool_dir} does not match ({saved['meta']} != {meta}), starting over")
+            return None
+        context = ts.context_from(saved["context"])
+        state = self._load(self._path(f"step_{steps[-1]:04d}.pt"))
+        coo = COOSparseTensor(ts.ckks_vector_from(context, state["ciphertext"]), state["flat_indices"], state["shape"])
+        x_prev = coo.decrypt().merge_tensor(state["remain"])
+        torch.set_rng_state(state["rng"]["torch"])
+        np.random.set_state(state["rng"]["numpy"])
+        if "cuda" in state["rng"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+        print(f"Resuming {self.spool_dir} after step {state['i']}")
+        return context, state["i"], x_prev, [e.to(device) for e in state["old_eps"]]
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,91 @@
+"""Multi-process sampling on one CPU host.
+
+The model is loaded once and its parameters and buffers are moved to shared
+memory, then N worker processes are forked from the loaded process, so the
+weights exist once however many workers run. Every worker sets its own torch
+thread count and builds its own per-process state (TenSEAL contexts and their
+thread pools do not survive a fork), takes jobs from a queue and sends the
+results back; SamplingFarm.run yields them in job order.
+"""
+
+import os
+import queue
+import traceback
+import multiprocessing as mp
+
+import torch
+
+
+def _worker(rank, job_fn, init_fn, threads, jobs, results):
+    torch.set_num_threads(threads)
+    try:
+        state = init_fn(rank) if init_fn is not None else None
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        item = jobs.get()
+        if item is None:
+            break
+        index, job = item
+        try:
+            results.put((index, job_fn(state, job), None))
+        except Exception:
+            results.put((index, None, traceback.format_exc()))
+
+
+class SamplingFarm(object):
+    def __init__(self, model, workers, threads=None):
+        assert "fork" in mp.get_all_start_methods(), "the sampling farm forks its workers"
+        assert all(p.device.type == "cpu" for p in model.parameters()), "the sampling farm runs on CPU only"
+        self.workers = workers
+        self.threads = threads if threads is not None else max(1, (os.cpu_count() or 1) // workers)
+        # forked workers would share the pages anyway until something writes to them,
+        # in shared memory they stay shared
+        model.share_memory()
+
+    def run(self, job_fn, jobs, init_fn=None):
+        """
+        Yield (job, job_fn(state, job)) for all jobs in order, where state is
+        init_fn(rank) of the worker that ran the job. job_fn and init_fn are
+        inherited through the fork and need not be picklable; jobs and results
+        are pickled. Grad mode and autocast are inherited from the caller.
+        """
+        jobs = list(jobs)
+        ctx = mp.get_context("fork")
+        job_queue, result_queue = ctx.Queue(), ctx.Queue()
+        for item in enumerate(jobs):
+            job_queue.put(item)
+        for _ in range(self.workers):
+            job_queue.put(None)
+        print(f"Starting {self.workers} sampling workers with {self.threads} threads each")
+        processes = [ctx.Process(target=_worker, args=(rank, job_fn, init_fn, self.threads, job_queue, result_queue),
+                                 daemon=True) for rank in range(self.workers)]
+        for p in processes:
+            p.start()
+
+        done, next_index = dict(), 0
+        try:
+            while next_index < len(jobs):
+                index, result, error = self._get(result_queue, processes)
+                if error is not None:
+                    raise RuntimeError(f"sampling job {index} failed in a worker:\n{error}")
+                done[index] = result
+                while next_index in done:
+                    yield jobs[next_index], done.pop(next_index)
+                    next_index += 1
+        finally:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+
+    @staticmethod
+    def _get(result_queue, processes, timeout=10):
+        while True:
+            try:
+                return result_queue.get(timeout=timeout)
+            except queue.Empty:
+                dead = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+                if len(dead) > 0:
+                    raise RuntimeError(f"a sampling worker died with exit code {dead[0]}")
@@ -0,0 +1,221 @@
+"""Flat, memory-mappable checkpoint format.
+
+A Lightning checkpoint is a pickle: loading it reads every tensor (including
+optimizer and EMA state) into memory before the model sees a single weight.
+The flat format stores only the model weights as raw, aligned tensor bytes
+behind a small JSON header, so a loader can np.memmap the file and hand out
+tensors that are paged in from disk on first touch.
+
+Layout: MAGIC | uint64 header length | JSON header | padding | tensor data
+"""
+
+import os
+import json
+import struct
+
+import numpy as np
+import torch
+from copy import deepcopy
+
+from ldm.util import instantiate_from_config
+
+
+MAGIC = b"LDMFLAT1"
+ALIGNMENT = 64
+
+# state dict prefixes of the submodules each role needs
+ROLE_PREFIXES = {
+    "unet": ("model.diffusion_model.",),
+    "vae_decoder": ("first_stage_model.decoder.", "first_stage_model.post_quant_conv."),
+    "vae_encoder": ("first_stage_model.encoder.", "first_stage_model.quant_conv."),
+    "clip": ("cond_stage_model.",),
+}
+SUBMODULE_PREFIXES = ("model.", "model_ema.", "first_stage_model.", "cond_stage_model.")
+
+# stages each process of the HE deployment builds, None means the whole LatentDiffusion
+DEPLOYMENT_ROLES = {
+    "client": ("clip", "vae_decoder"),
+    "server": ("unet",),
+    "full": None,
+}
+
+_NP_DTYPES = {
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.float64: np.float64,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.uint8: np.uint8,
+    torch.bool: np.bool_,
+}
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_flat_checkpoint(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def ema_state_dict(sd):
+    """Replace the diffusion model weights by their EMA copies (see LitEma for the naming)."""
+    out = dict()
+    for k, v in sd.items():
+        if k.startswith("model_ema."):
+            continue
+        if k.startswith("model."):
+            ema_key = "model_ema." + k[len("model."):].replace(".", "")
+            if ema_key in sd:
+                v = sd[ema_key]
+        out[k] = v
+    return out
+
+
+def convert_checkpoint(ckpt, out_path, half=False, use_ema=False):
+    """Write the weights of a Lightning checkpoint to a flat, memory-mappable file.
+
+    Optimizer state and (unless use_ema is set, in which case they replace the
+    UNet weights) EMA shadow parameters are dropped. With half=True floating
+    point tensors are stored as float16.
+    """
+    print(f"Loading model from {ckpt}")
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    sd = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+    if use_ema:
+        sd = ema_state_dict(sd)
+    else:
+        sd = {k: v for k, v in sd.items() if not k.startswith("model_ema.")}
+
+    tensors = dict()
+    offset = 0
+    arrays = []
+    for k, v in sd.items():
+        if not isinstance(v, torch.Tensor):
+            continue
+        v = v.detach().cpu()
+        if half and v.is_floating_point():
+            v = v.half()
+        if v.dtype not in _NP_DTYPES:
+            raise ValueError(f"Unsupported dtype {v.dtype} for key {k}")
+        arr = v.contiguous().numpy()
+        tensors[k] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset, "nbytes": arr.nbytes}
+        arrays.append(arr)
+        offset = _align(offset + arr.nbytes)
+
+    header = {"tensors": tensors, "global_step": pl_sd.get("global_step"), "half": half, "use_ema": use_ema}
+    header = json.dumps(header).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(out_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for arr, meta in zip(arrays, tensors.values()):
+            f.seek(data_start + meta["offset"])
+            f.write(arr.tobytes())
+    print(f"Wrote {len(tensors)} tensors ({offset / 2 ** 20:.1f} MiB) to {out_path}")
+
+
+def _wanted(key, roles):
+    if roles is None:
+        return not key.startswith("model_ema.")
+    if not key.startswith(SUBMODULE_PREFIXES):
+        # top level buffers such as the noise schedule are tiny, keep them
+        return True
+    return any(key.startswith(p) for role in roles for p in ROLE_PREFIXES[role])
+
+
+def load_flat_state_dict(path, roles=None):
+    """Map a flat checkpoint and return (state_dict, global_step).
+
+    Tensors are views on a copy-on-write memory map, so nothing is read from
+    disk until it is used and nothing is copied unless it is written to. If
+    roles is given (keys of ROLE_PREFIXES), only those submodules are returned.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a flat checkpoint")
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _align(len(MAGIC) + 8 + header_len)
+    if roles is not None:
+        unknown = set(roles) - set(ROLE_PREFIXES)
+        if unknown:
+            raise KeyError(f"Unknown roles {sorted(unknown)}, expected some of {sorted(ROLE_PREFIXES)}")
+
+    buf = np.memmap(path, dtype=np.uint8, mode="c")
+    sd = dict()
+    for k, meta in header["tensors"].items():
+        if not _wanted(k, roles):
+            continue
+        start = data_start + meta["offset"]
+        arr = buf[start:start + meta["nbytes"]].view(np.dtype(meta["dtype"])).reshape(meta["shape"])
+        sd[k] = torch.from_numpy(arr)
+    return sd, header.get("global_step")
+
+
+def load_checkpoint(path, roles=None):
+    """Return (state_dict, global_step) for either a flat or a Lightning checkpoint."""
+    if is_flat_checkpoint(path):
+        return load_flat_state_dict(path, roles=roles)
+    pl_sd = torch.load(path, map_location="cpu")
+    sd = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+    sd = {k: v for k, v in sd.items() if _wanted(k, roles)}
+    return sd, pl_sd.get("global_step")
+
+
+@torch.no_grad()
+def load_state_dict_mmap(model, sd):
+    """Non-strict load_state_dict that avoids copies where it can.
+
+    Parameters and buffers whose dtype and shape already match are rebound to
+    the (memory-mapped) tensors instead of being copied into, so the weights
+    stay backed by the page cache. Everything else falls back to copy_.
+    Returns the lists of missing and unexpected keys like load_state_dict.
+    """
+    own = model.state_dict(keep_vars=True)
+    missing = [k for k in own if k not in sd]
+    unexpected = [k for k in sd if k not in own]
+    for k, v in sd.items():
+        if k not in own:
+            continue
+        target = own[k]
+        if target.shape != v.shape:
+            raise RuntimeError(f"size mismatch for {k}: got {tuple(v.shape)}, expected {tuple(target.shape)}")
+        if target.dtype == v.dtype and target.device == v.device:
+            target.data = v
+        else:
+            target.copy_(v)
+    return missing, unexpected
+
+
+def load_model_for_role(config, ckpt, role="full", verbose=False):
+    """Build and load only the stages a deployment role needs (see DEPLOYMENT_ROLES).
+
+    The client gets the CLIP text encoder and the VAE decoder, the server only
+    the UNet; the other submodules are neither instantiated nor read from ckpt.
+    """
+    if role not in DEPLOYMENT_ROLES:
+        raise KeyError(f"Unknown role {role}, expected one of {sorted(DEPLOYMENT_ROLES)}")
+    stages = DEPLOYMENT_ROLES[role]
+    model_config = deepcopy(config.model)
+    if stages is not None:
+        model_config.params.stages = list(stages)
+    print(f"Loading {role} model from {ckpt}")
+    sd, global_step = load_checkpoint(ckpt, roles=stages)
+    if global_step is not None:
+        print(f"Global Step: {global_step}")
+    model = instantiate_from_config(model_config)
+    m, u = load_state_dict_mmap(model, sd)
+    if len(m) > 0 and verbose:
+        print("missing keys:")
+        print(m)
+    if len(u) > 0 and verbose:
+        print("unexpected keys:")
+        print(u)
+    model.eval()
+    return model
@@ -0,0 +1,136 @@
+"""Memory accounting for the HE path of the encrypted samplers.
+
+HEAccounting follows the TenSEAL objects of a sampling run: the key sizes of
+the context, and per step the live ciphertexts (count, in-memory and
+serialized bytes, coefficient moduli left) and the peak RSS of the step. With
+a memory cap, encryptions whose ciphertexts would not fit next to the current
+RSS fail with a MemoryError before they start, and so does a step whose peak
+RSS went over the cap.
+"""
+
+import os
+import math
+import weakref
+import resource
+
+import tenseal as ts
+
+
+def _mb(n):
+    return n / 2 ** 20
+
+
+def ciphertext_bytes(ciphertext):
+    """In-memory size of a SEAL ciphertext: polynomials x degree x moduli x 8 bytes."""
+    return ciphertext.size() * ciphertext.poly_modulus_degree() * ciphertext.coeff_modulus_size() * 8
+
+
+def context_sizes(context):
+    """Serialized bytes of the parameters and of each kind of key in a TenSEAL context."""
+    parts = dict(save_public_key=False, save_secret_key=False, save_galois_keys=False, save_relin_keys=False)
+    size = lambda **part: len(context.serialize(**dict(parts, **part)))
+    base = size()
+    sizes = dict(parameters=base)
+    if context.has_public_key():
+        sizes["public_key"] = size(save_public_key=True) - base
+    if context.is_private():
+        sizes["secret_key"] = size(save_secret_key=True) - base
+    if context.has_relin_keys():
+        sizes["relin_keys"] = size(save_relin_keys=True) - base
+    if context.has_galois_keys():
+        sizes["galois_keys"] = size(save_galois_keys=True) - base
+    return sizes
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak RSS in bytes since the process started or since reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class HEAccounting(object):
+    def __init__(self, memory_cap=None, serialized=False):
+        """
+        memory_cap: bytes of RSS the run may use, None for no cap.
+        serialized: also measure serialized sizes, which serializes the
+        context once (the galois keys take a while) and the ciphertexts at
+        every step.
+        """
+        self.memory_cap = memory_cap
+        self.serialized = serialized
+        self.live = weakref.WeakSet()
+        self.context_bytes = dict()
+        self.fresh_bytes = None
+        self.slots = None
+        self.per_step_peak = reset_peak_rss()
+
+    def track_context(self, context):
+        probe = ts.ckks_vector(context, [0.]).ciphertext()[0]
+        self.fresh_bytes = ciphertext_bytes(probe)
+        self.slots = probe.poly_modulus_degree() // 2
+        if self.serialized:
+            self.context_bytes = context_sizes(context)
+            print("HE context: " + ", ".join(f"{k} {_mb(v):.1f} MB" for k, v in self.context_bytes.items()))
+
+    def track(self, tensor):
+        """Count a CKKSVector / CKKSTensor as live until it is garbage collected."""
+        self.live.add(tensor)
+
+    def check(self, ciphertexts, what):
+        if self.memory_cap is None:
+            return
+        rss, need = current_rss(), ciphertexts * self.fresh_bytes
+        if rss + need > self.memory_cap:
+            raise MemoryError(f"{what} needs {ciphertexts} ciphertexts ({_mb(need):.0f} MB) on top of "
+                              f"{_mb(rss):.0f} MB RSS, over the {_mb(self.memory_cap):.0f} MB HE memory cap")
+
+    def check_vector(self, numel, what):
+        """Before ts.ckks_vector of numel values: one ciphertext per slots values."""
+        self.check(math.ceil(numel / self.slots), what)
+
+    def check_tensor(self, numel, what):
+        """Before an unbatched ts.ckks_tensor: one ciphertext per value."""
+        self.check(numel, what)
+
+    def step(self, i):
+        """Statistics of step i, for ENC_PLMSSampler.step_stats; starts the peak RSS of the next step."""
+        ciphertexts = [ct for tensor in list(self.live) for ct in tensor.ciphertext()]
+        stats = dict(ciphertexts=len(ciphertexts),
+                     ciphertext_bytes=sum(ciphertext_bytes(ct) for ct in ciphertexts),
+                     level=min((ct.coeff_modulus_size() for ct in ciphertexts), default=0),
+                     peak_rss=peak_rss())
+        if self.serialized:
+            stats["serialized_bytes"] = sum(len(tensor.serialize()) for tensor in list(self.live))
+        print(f"HE memory step {i}: {stats['ciphertexts']} ciphertexts, {_mb(stats['ciphertext_bytes']):.1f} MB"
+              + (f" ({_mb(stats['serialized_bytes']):.1f} MB serialized)" if self.serialized else "")
+              + f", {stats['level']} moduli left, peak RSS {_mb(stats['peak_rss']):.0f} MB")
+        if self.memory_cap is not None and stats["peak_rss"] > self.memory_cap:
+            raise MemoryError(f"step {i} peaked at {_mb(stats['peak_rss']):.0f} MB RSS, "
+                              f"over the {_mb(self.memory_cap):.0f} MB HE memory cap")
+        if self.per_step_peak:
+            reset_peak_rss()
+        return stats
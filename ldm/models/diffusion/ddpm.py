@@ -13,6 +13,7 @@ import pytorch_lightning as pl
 from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange, repeat
 from contextlib import contextmanager
+from copy import deepcopy
 from functools import partial
 from tqdm import tqdm
 from torchvision.utils import make_grid
@@ -24,8 +25,11 @@ from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianD
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.enc_conditioning import EncryptedContext
 
 
+STAGES = ("unet", "vae_encoder", "vae_decoder", "clip")
+
 __conditioning_keys__ = {'concat': 'c_concat',
                          'crossattn': 'c_crossattn',
                          'adm': 'y'}
@@ -71,6 +75,7 @@ class DDPM(pl.LightningModule):
                  use_positional_encodings=False,
                  learn_logvar=False,
                  logvar_init=0.,
+                 build_unet=True,
                  ):
         super().__init__()
         assert parameterization in ["eps", "x0"], 'currently only supporting "eps" and "x0"'
@@ -83,8 +88,12 @@ class DDPM(pl.LightningModule):
         self.image_size = image_size  # try conv?
         self.channels = channels
         self.use_positional_encodings = use_positional_encodings
-        self.model = DiffusionWrapper(unet_config, conditioning_key)
-        count_params(self.model, verbose=True)
+        if build_unet:
+            self.model = DiffusionWrapper(unet_config, conditioning_key)
+            count_params(self.model, verbose=True)
+        else:
+            self.model = None
+            use_ema = False
         self.use_ema = use_ema
         if self.use_ema:
             self.model_ema = LitEma(self.model)
@@ -434,7 +443,12 @@ class LatentDiffusion(DDPM):
                  conditioning_key=None,
                  scale_factor=1.0,
                  scale_by_std=False,
+                 stages=None,
                  *args, **kwargs):
+        # stages: subset of ["unet", "vae_encoder", "vae_decoder", "clip"] to build, None builds all of them.
+        # Processes that only run part of the pipeline (e.g. the HE client or server) skip the rest.
+        self.stages = STAGES if stages is None else tuple(stages)
+        assert set(self.stages) <= set(STAGES), f"unknown stages {set(self.stages) - set(STAGES)}"
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
         assert self.num_timesteps_cond <= kwargs['timesteps']
@@ -445,7 +459,7 @@ class LatentDiffusion(DDPM):
             conditioning_key = None
         ckpt_path = kwargs.pop("ckpt_path", None)
         ignore_keys = kwargs.pop("ignore_keys", [])
-        super().__init__(conditioning_key=conditioning_key, *args, **kwargs)
+        super().__init__(conditioning_key=conditioning_key, build_unet="unet" in self.stages, *args, **kwargs)
         self.concat_mode = concat_mode
         self.cond_stage_trainable = cond_stage_trainable
         self.cond_stage_key = cond_stage_key
@@ -457,8 +471,14 @@ class LatentDiffusion(DDPM):
             self.scale_factor = scale_factor
         else:
             self.register_buffer('scale_factor', torch.tensor(scale_factor))
-        self.instantiate_first_stage(first_stage_config)
-        self.instantiate_cond_stage(cond_stage_config)
+        if "vae_encoder" in self.stages or "vae_decoder" in self.stages:
+            self.instantiate_first_stage(first_stage_config)
+        else:
+            self.first_stage_model = None
+        if "clip" in self.stages:
+            self.instantiate_cond_stage(cond_stage_config)
+        else:
+            self.cond_stage_model = None
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
@@ -500,6 +520,11 @@ class LatentDiffusion(DDPM):
             self.make_cond_schedule()
 
     def instantiate_first_stage(self, config):
+        if "vae_encoder" not in self.stages or "vae_decoder" not in self.stages:
+            assert config.target.endswith("AutoencoderKL"), "partial first stages are only supported for AutoencoderKL"
+            config = deepcopy(config)
+            config.params.build_encoder = "vae_encoder" in self.stages
+            config.params.build_decoder = "vae_decoder" in self.stages
         model = instantiate_from_config(config)
         model = model.cpu()
         self.first_stage_model = model.eval()
@@ -562,6 +587,10 @@ class LatentDiffusion(DDPM):
         else:
             assert hasattr(self.cond_stage_model, self.cond_stage_forward)
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
+        placement = getattr(self, "placement", None)
+        if placement is not None and isinstance(c, torch.Tensor):
+            # hand the embedding to the device the UNet was pinned to (see ldm/placement.py)
+            c = c.to(placement.unet)
         return c
 
     def meshgrid(self, h, w):
@@ -705,6 +734,54 @@ class LatentDiffusion(DDPM):
             out.append(xc)
         return out
 
+    @staticmethod
+    def _tile_starts(size, tile, stride):
+        if size <= tile:
+            return [0]
+        # the last tile is aligned to the border instead of sticking out
+        return list(range(0, size - tile, stride)) + [size - tile]
+
+    @staticmethod
+    def _tile_ramp(n, overlap, ramp_start, ramp_end, device):
+        w = torch.ones(n, device=device)
+        if overlap > 0:
+            ramp = (torch.arange(overlap, device=device) + 0.5) / overlap
+            if ramp_start:
+                w[:overlap] = ramp
+            if ramp_end:
+                w[-overlap:] = torch.minimum(w[-overlap:], ramp.flip(0))
+        return w
+
+    @torch.no_grad()
+    def tiled_decode(self, z, decode_fn, tile_size=64, overlap=16, tile_batch=4):
+        """Decode (already scaled) latents in overlapping tiles of tile_size x tile_size.
+
+        Tiles are decoded tile_batch at a time and blended with weights that
+        ramp linearly across the overlap, so the decoder's activation memory
+        depends on the tile size, not on the output resolution.
+        """
+        b, _, h, w = z.shape
+        th, tw = min(tile_size, h), min(tile_size, w)
+        overlap = max(0, min(overlap, th // 2, tw // 2))
+        tiles = [(y, x) for y in self._tile_starts(h, th, th - overlap)
+                 for x in self._tile_starts(w, tw, tw - overlap)]
+
+        out, weights = None, None
+        for i in range(0, len(tiles), tile_batch):
+            batch = tiles[i:i + tile_batch]
+            decoded = decode_fn(torch.cat([z[:, :, y:y + th, x:x + tw] for y, x in batch]))
+            if out is None:
+                f = decoded.shape[-1] // tw
+                out = torch.zeros(b, decoded.shape[1], h * f, w * f, device=decoded.device)
+                weights = torch.zeros(1, 1, h * f, w * f, device=decoded.device)
+            for (y, x), tile in zip(batch, decoded.split(b)):
+                wy = self._tile_ramp(th * f, overlap * f, y > 0, y + th < h, decoded.device)
+                wx = self._tile_ramp(tw * f, overlap * f, x > 0, x + tw < w, decoded.device)
+                mask = wy[:, None] * wx[None, :]
+                out[:, :, y * f:(y + th) * f, x * f:(x + tw) * f] += tile.float() * mask
+                weights[:, :, y * f:(y + th) * f, x * f:(x + tw) * f] += mask
+        return (out / weights).to(decoded.dtype)
+
     @torch.no_grad()
     def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
         if predict_cids:
@@ -714,6 +791,16 @@ class LatentDiffusion(DDPM):
             z = rearrange(z, 'b h w c -> b c h w').contiguous()
 
         z = 1. / self.scale_factor * z
+        placement = getattr(self, "placement", None)
+        if placement is not None:
+            z = z.to(placement.vae)
+
+        if getattr(self, "tiled_decode_params", None) is not None:
+            if isinstance(self.first_stage_model, VQModelInterface):
+                decode_fn = partial(self.first_stage_model.decode, force_not_quantize=predict_cids or force_not_quantize)
+            else:
+                decode_fn = self.first_stage_model.decode
+            return self.tiled_decode(z, decode_fn, **self.tiled_decode_params)
 
         if hasattr(self, "split_input_params"):
             if self.split_input_params["patch_distributed_vq"]:
@@ -1409,14 +1496,18 @@ class DiffusionWrapper(pl.LightningModule):
             xc = torch.cat([x] + c_concat, dim=1)
             out = self.diffusion_model(xc, t)
         elif self.conditioning_key == 'crossattn':
-            cc = torch.cat(c_crossattn, 1)
+            # no copy for a single context, so it keeps its identity across steps
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(x, t, context=cc)
         elif self.conditioning_key == 'enc_crossattn':
             cc = c_crossattn[0]
+            if isinstance(cc, EncryptedContext):
+                # encrypted in transit only, decrypted once per job (see ldm/enc_conditioning.py)
+                cc = cc.plaintext(x.device)
             out = self.diffusion_model(x, t, context=cc)
         elif self.conditioning_key == 'hybrid':
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(xc, t, context=cc)
         elif self.conditioning_key == 'adm':
             cc = c_crossattn[0]
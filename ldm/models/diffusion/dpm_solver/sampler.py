@@ -2,6 +2,8 @@
 
 import torch
 
+from ldm.modules.attention import cross_attention_kv_cache
+
 from .dpm_solver import NoiseScheduleVP, model_wrapper, DPM_Solver
 
 
@@ -9,13 +11,15 @@ class DPMSolverSampler(object):
     def __init__(self, model, **kwargs):
         super().__init__()
         self.model = model
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(model.device)
+        to_torch = lambda x: x.clone().detach().to(torch.float32).to(model.betas.device)
         self.register_buffer('alphas_cumprod', to_torch(model.alphas_cumprod))
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            # follow the device the model's noise schedule was placed on
+            device = self.model.betas.device
+            if attr.device != device:
+                attr = attr.to(device)
         setattr(self, name, attr)
 
     @torch.no_grad()
@@ -77,6 +81,8 @@ class DPMSolverSampler(object):
         )
 
         dpm_solver = DPM_Solver(model_fn, ns, predict_x0=True, thresholding=False)
-        x = dpm_solver.sample(img, steps=S, skip_type="time_uniform", method="multistep", order=2, lower_order_final=True)
+        with cross_attention_kv_cache():
+            x = dpm_solver.sample(img, steps=S, skip_type="time_uniform", method="multistep", order=2,
+                                  lower_order_final=True)
 
         return x.to(device), None
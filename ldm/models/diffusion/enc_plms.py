@@ -15,12 +15,17 @@ from imwatermark import WatermarkEncoder
 from einops import rearrange
 from torchvision.utils import make_grid
 from ldm.coo_sparse import COOSparseTensor, convert_dense_to_coo
-from ldm.distortion import remove_points, count_zeros
+from ldm.distortion import remove_points, count_zeros, ThresholdSchedule
+from ldm.he_accounting import HEAccounting
 import copy
 import os
 
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from ldm.modules.attention import cross_attention_kv_cache
+from ldm.modules.diffusionmodules.openaimodel import begin_feature_cache_step, end_feature_cache_run, \
+    precompute_timestep_embeddings
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
+    SampleNoise
 
 def put_watermark(img, wm_encoder=None):
     if wm_encoder is not None:
@@ -30,16 +35,27 @@ def put_watermark(img, wm_encoder=None):
     return img
 
 class ENC_PLMSSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", he_threads=None, he_memory_cap=None, he_accounting=False,
+                 **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # threads of the TenSEAL contexts, None: all cores
+        self.he_threads = he_threads
+        # counter-based noise of the current run, see sample()
+        self.sample_noise = None
+        # HE memory: RSS cap in bytes and whether to measure serialized sizes, see HEAccounting
+        self.he_memory_cap = he_memory_cap
+        self.he_accounting = he_accounting
+        self.he_memory = None
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            # follow the device the model's noise schedule was placed on
+            device = self.model.betas.device
+            if attr.device != device:
+                attr = attr.to(device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
@@ -47,9 +63,10 @@ class ENC_PLMSSampler(object):
             raise ValueError('ddim_eta must be 0 for PLMS')
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
+        precompute_timestep_embeddings(self.model, self.ddim_timesteps)
         alphas_cumprod = self.model.alphas_cumprod
         assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
+        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.betas.device)
 
         self.register_buffer('betas', to_torch(self.model.betas))
         self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
@@ -75,6 +92,11 @@ class ENC_PLMSSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+    def step_noise(self, shape, device, repeat_noise, index):
+        if self.sample_noise is not None:
+            return self.sample_noise.randn(shape, index, device)
+        return noise_like(shape, device, repeat_noise)
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -98,8 +120,19 @@ class ENC_PLMSSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               threshold=0.01,
+               spool=None,
+               resume=False,
+               seed=None,
+               sample_indices=None,
                **kwargs
                ):
+        """
+        With a seed, the start code (unless x_T is given) and the step noise are
+        drawn per sample from a counter-based RNG keyed by (seed, sample index,
+        step), so results do not depend on batching, order or the global RNG.
+        sample_indices number the samples of this batch, by default 0..batch_size-1.
+        """
         if conditioning is not None:
             if isinstance(conditioning, dict):
                 cbs = conditioning[list(conditioning.keys())[0]].shape[0]
@@ -110,26 +143,32 @@ class ENC_PLMSSampler(object):
                     print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
 
         self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
+        self.sample_noise = None
+        if seed is not None:
+            self.sample_noise = SampleNoise(seed, range(batch_size) if sample_indices is None else sample_indices)
         # sampling
         C, H, W = shape
         size = (batch_size, C, H, W)
         print(f'Data shape for PLMS sampling is {size}')
 
-        samples, intermediates = self.plms_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    )
+        with cross_attention_kv_cache():
+            samples, intermediates = self.plms_sampling(conditioning, size,
+                                                        callback=callback,
+                                                        img_callback=img_callback,
+                                                        quantize_denoised=quantize_x0,
+                                                        mask=mask, x0=x0,
+                                                        ddim_use_original_steps=False,
+                                                        noise_dropout=noise_dropout,
+                                                        temperature=temperature,
+                                                        score_corrector=score_corrector,
+                                                        corrector_kwargs=corrector_kwargs,
+                                                        x_T=x_T,
+                                                        log_every_t=log_every_t,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        unconditional_conditioning=unconditional_conditioning,
+                                                        threshold=threshold,
+                                                        spool=spool, resume=resume,
+                                                        )
         return samples, intermediates
 
     @torch.no_grad()
@@ -138,16 +177,31 @@ class ENC_PLMSSampler(object):
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, threshold=0.01,
+                      spool=None, resume=False):
+        """
+        threshold is the share of the remove_points distortion budget. The
+        latent elements zeroed within it are added back in plaintext; only the
+        kept, nonzero elements are COO-encoded and encrypted.
+        It is a float or a ThresholdSchedule giving one threshold per step.
+        Per-step encrypted element counts, timings and HE memory end up in
+        self.step_stats, the HEAccounting of the run in self.he_memory.
+        With a CiphertextSpool the state after every step is spooled, and with
+        resume=True the run continues after the last spooled step.
+        """
         device = self.model.betas.device
         #device = "cuda"
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
-            img_cpu = torch.randn(shape, device="cpu")
+            # one start code for the plaintext and the encrypted path
+            if self.sample_noise is not None:
+                img_cpu = self.sample_noise.start_code(shape)
+            else:
+                img_cpu = torch.randn(shape, device="cpu")
+            img = img_cpu.to(device)
         else:
-            img = x_T
-            img_cpu = x_T
+            img = x_T.to(device)
+            img_cpu = x_T.cpu()
 
         if timesteps is None:
             timesteps = self.ddpm_num_timesteps if ddim_use_original_steps else self.ddim_timesteps
@@ -162,13 +216,15 @@ class ENC_PLMSSampler(object):
 
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
+        self.step_stats = []
 
         bits_scale = 26
         # Create TenSEAL context
         context = ts.context(
             ts.SCHEME_TYPE.CKKS,
             poly_modulus_degree=8192,
-            coeff_mod_bit_sizes=[31, bits_scale, bits_scale, bits_scale, bits_scale, bits_scale, bits_scale, 31]
+            coeff_mod_bit_sizes=[31, bits_scale, bits_scale, bits_scale, bits_scale, bits_scale, bits_scale, 31],
+            n_threads=self.he_threads
         )
 
         # set the scale
@@ -176,6 +232,21 @@ class ENC_PLMSSampler(object):
 
         # galois keys are required to do ciphertext rotations
         context.generate_galois_keys()
+
+        start = 0
+        if spool is not None:
+            meta = dict(shape=tuple(shape), steps=int(total_steps),
+                        threshold=threshold.spec() if isinstance(threshold, ThresholdSchedule) else threshold)
+            restored = spool.resume(meta, device) if resume else None
+            if restored is not None:
+                context, last, img_cpu, old_eps = restored
+                img = img_cpu.to(device)
+                start = last + 1
+            else:
+                spool.save_context(context, meta)
+        accounting = HEAccounting(self.he_memory_cap, serialized=self.he_accounting)
+        accounting.track_context(context)
+        self.he_memory = accounting
         '''
         T0 = time.time()
         enc_img = ts.ckks_tensor(context, img)
@@ -188,7 +259,10 @@ class ENC_PLMSSampler(object):
         sparse=True
 
         for i, step in enumerate(iterator):
+            if i < start:
+                continue
             index = total_steps - i - 1
+            begin_feature_cache_step(self.model, i)
             tstep = torch.full((b,), step, device=device, dtype=torch.long)
             tstep_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
 
@@ -200,13 +274,21 @@ class ENC_PLMSSampler(object):
                 enc_img = mask_img_orig + (1. - mask) * enc_img
 
             if sparse:
-                new_image = remove_points(img_cpu, threshold=0.01)
+                step_threshold = threshold
+                if isinstance(threshold, ThresholdSchedule):
+                    alphas = self.model.alphas_cumprod if ddim_use_original_steps else self.ddim_alphas
+                    step_threshold = threshold(i, float(alphas[index]), total_steps)
+                T_split = time.time()
+                new_image = remove_points(img_cpu, threshold=step_threshold)
                 remain_img = img_cpu - new_image
-                print("zeros: ", count_zeros(new_image))
+                zeros = count_zeros(new_image)
+                print("zeros: ", zeros)
                 coo_img = convert_dense_to_coo(new_image)
+                accounting.check_vector(len(coo_img.flat_indices), f"encrypting the latent at step {i}")
                 T0 = time.time()
                 coo_img.encrypt(context)
                 T1 = time.time()
+                accounting.track(coo_img.values)
                 print(f"encrypt needs: {T1-T0}s")
 
 
@@ -218,12 +300,18 @@ class ENC_PLMSSampler(object):
                                       unconditional_conditioning=unconditional_conditioning,
                                       old_eps=old_eps, t_next=tstep_next)
                 coo_img, remain_img, img_cpu, e_t = outs
-                img = img_cpu
-                #img = img_cpu.cuda()
+                img = img_cpu.to(device)
+                accounting.track(coo_img.values)
+                self.step_stats.append(dict(step=int(step), threshold=step_threshold,
+                                            encrypted=new_image.numel() - zeros,
+                                            numel=new_image.numel(), split_time=T0 - T_split, encrypt_time=T1 - T0,
+                                            **self.step_timing, **accounting.step(i)))
             else:
+                accounting.check_tensor(img.numel(), f"encrypting the latent at step {i}")
                 T0 = time.time()
                 enc_img = ts.ckks_tensor(context, img)
                 T1 = time.time()
+                accounting.track(enc_img)
                 print(f"encrypt needs: {T1-T0}s")
                 outs = self.p_sample_plms(img, enc_img, cond, tstep, index=index, use_original_steps=ddim_use_original_steps,
                                       quantize_denoised=quantize_denoised, temperature=temperature,
@@ -233,24 +321,13 @@ class ENC_PLMSSampler(object):
                                       unconditional_conditioning=unconditional_conditioning,
                                       old_eps=old_eps, t_next=tstep_next)
                 enc_img, img, e_t = outs
+                accounting.step(i)
 
-            '''
-            if i == 49:
-                thresholds = [0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 0.9, 0.99] 
-                #print("save intermediate tensors: ", i, " ", step)
-                for threshold in thresholds:
-                    new_img = remove_points(img, threshold=threshold)
-                    x_samples_ddim = self.model.decode_first_stage(new_img)
-                    x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                    grid = make_grid(x_samples_ddim, nrow=3)
-                    grid = 255. * rearrange(grid, 'c h w -> h w c').to(torch.float).cpu().numpy()
-                    img_new = Image.fromarray(grid.astype(np.uint8))
-                    img_new = put_watermark(img_new, wm_encoder)
-                    img_new.save(os.path.join("outputs/txt2img-samples/", f"thresholds_{threshold}.png"))
-            '''
             old_eps.append(e_t)
             if len(old_eps) >= 4:
                 old_eps.pop(0)
+            if spool is not None and sparse:
+                spool.write(i, coo_img, remain_img, old_eps)
             if callback: callback(i)
             #if img_callback: img_callback(pred_x0, i)
 
@@ -258,6 +335,9 @@ class ENC_PLMSSampler(object):
                 intermediates['x_inter'].append(img)
                 #intermediates['pred_x0'].append(pred_x0)
 
+        if spool is not None:
+            spool.wait()
+        end_feature_cache_run(self.model)
         return img, intermediates
 
     @torch.no_grad()
@@ -290,7 +370,8 @@ class ENC_PLMSSampler(object):
                 assert self.model.parameterization == "eps"
                 e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-            return e_t
+            # the UNet may run in bf16, the multistep update and the HE part stay in float32
+            return e_t.float()
 
         alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
         alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
@@ -310,7 +391,7 @@ class ENC_PLMSSampler(object):
                 pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
             # direction pointing to x_t
             dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+            noise = sigma_t * self.step_noise(x.shape, device, repeat_noise, index) * temperature
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
             x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
@@ -318,7 +399,7 @@ class ENC_PLMSSampler(object):
 
         def get_x_prev_and_pred_x0_enc(e_t, index):
             dir_xt = math.sqrt(1. - alphas_prev[index] - sigmas[index]**2) * e_t
-            noise = float(sigmas[index]) * temperature * noise_like(x.shape, "cpu", repeat_noise)
+            noise = float(sigmas[index]) * temperature * self.step_noise(x.shape, "cpu", repeat_noise, index)
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
             dir_xt = dir_xt + noise
@@ -386,7 +467,8 @@ class ENC_PLMSSampler(object):
                 assert self.model.parameterization == "eps"
                 e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-            return e_t
+            # the UNet may run in bf16, the multistep update and the HE part stay in float32
+            return e_t.float()
 
         alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
         alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
@@ -406,7 +488,7 @@ class ENC_PLMSSampler(object):
                 pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
             # direction pointing to x_t
             dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+            noise = sigma_t * self.step_noise(x.shape, device, repeat_noise, index) * temperature
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
             x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
@@ -414,7 +496,7 @@ class ENC_PLMSSampler(object):
 
         def get_x_prev_and_pred_x0_enc(e_t, index):
             dir_xt = math.sqrt(1. - alphas_prev[index] - sigmas[index]**2) * e_t
-            noise = float(sigmas[index]) * temperature * noise_like(x.shape, "cpu", repeat_noise)
+            noise = float(sigmas[index]) * temperature * self.step_noise(x.shape, "cpu", repeat_noise, index)
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
             dir_xt = dir_xt + noise
@@ -459,5 +541,6 @@ class ENC_PLMSSampler(object):
         #print(torch.cosine_similarity(pred_x0_ori, pred_x0))
         T2 = time.time()
         print(f"model forward: {T1-T0}s, get prev: {T2-T1}s")
+        self.step_timing = dict(model_time=T1 - T0, he_time=T2 - T1)
 
         return coo_x_prev, remain_x_prev, x_prev, e_t
@@ -1,4 +1,6 @@
 from inspect import isfunction
+from functools import partial
+from contextlib import contextmanager
 import math
 import torch
 import torch.nn.functional as F
@@ -6,6 +8,7 @@ from torch import nn, einsum
 from einops import rearrange, repeat
 
 from ldm.modules.diffusionmodules.util import checkpoint
+from ldm.modules.tome import bipartite_soft_matching_2d, do_nothing
 from ldm.enc_util import enc_sum
 
 
@@ -34,6 +37,159 @@ def init_(tensor):
     return tensor
 
 
+# torch >= 2.0 ships fused (flash / memory efficient) attention kernels
+USE_SDPA = hasattr(F, "scaled_dot_product_attention")
+# the fallback attends query_chunk_size queries at a time and, for long
+# contexts, folds key_chunk_size keys at a time into an online softmax
+QUERY_CHUNK_SIZE = 1024
+KEY_CHUNK_SIZE = 4096
+
+
+def _attention_block(q, k, v, scale, mask, key_chunk_size):
+    if k.shape[-2] <= key_chunk_size:
+        sim = torch.matmul(q, k.transpose(-1, -2)) * scale
+        if exists(mask):
+            sim.masked_fill_(~mask, max_neg_value(sim))
+        return torch.matmul(sim.softmax(dim=-1), v)
+
+    # online softmax: rescale the running sums whenever the running max grows
+    acc, denom, running_max = None, None, None
+    for j in range(0, k.shape[-2], key_chunk_size):
+        sim = torch.matmul(q, k[..., j:j + key_chunk_size, :].transpose(-1, -2)) * scale
+        if exists(mask):
+            sim.masked_fill_(~mask[..., j:j + key_chunk_size], max_neg_value(sim))
+        chunk_max = sim.amax(dim=-1, keepdim=True)
+        if acc is None:
+            running_max = chunk_max
+            p = torch.exp(sim - running_max)
+            denom = p.sum(dim=-1, keepdim=True)
+            acc = torch.matmul(p, v[..., j:j + key_chunk_size, :])
+        else:
+            new_max = torch.maximum(running_max, chunk_max)
+            alpha = torch.exp(running_max - new_max)
+            p = torch.exp(sim - new_max)
+            denom = denom * alpha + p.sum(dim=-1, keepdim=True)
+            acc = acc * alpha + torch.matmul(p, v[..., j:j + key_chunk_size, :])
+            running_max = new_max
+    return acc / denom
+
+
+def chunked_attention(q, k, v, scale, mask=None, query_chunk_size=None, key_chunk_size=None):
+    """
+    softmax(q k^T * scale) v for q of shape (..., n, d) and k, v of shape (..., m, d),
+    without materialising the full n x m similarity matrix: peak memory is
+    bounded by query_chunk_size x key_chunk_size per batch/head.
+    :param mask: optional boolean mask broadcastable to (..., n, m), False entries are ignored.
+    """
+    query_chunk_size = default(query_chunk_size, QUERY_CHUNK_SIZE)
+    key_chunk_size = default(key_chunk_size, KEY_CHUNK_SIZE)
+    n = q.shape[-2]
+    if n <= query_chunk_size:
+        return _attention_block(q, k, v, scale, mask, key_chunk_size)
+    out = torch.empty(*q.shape[:-1], v.shape[-1], dtype=v.dtype, device=v.device)
+    for i in range(0, n, query_chunk_size):
+        mask_i = mask if not exists(mask) or mask.shape[-2] == 1 else mask[..., i:i + query_chunk_size, :]
+        out[..., i:i + query_chunk_size, :] = _attention_block(q[..., i:i + query_chunk_size, :], k, v,
+                                                               scale, mask_i, key_chunk_size)
+    return out
+
+
+def attention(q, k, v, scale=None, mask=None, query_chunk_size=None, key_chunk_size=None):
+    """
+    Attention on (batch, heads, tokens, dim_head) tensors: dispatches to
+    F.scaled_dot_product_attention when available and to chunked_attention otherwise.
+    """
+    scale = default(scale, q.shape[-1] ** -0.5)
+    if USE_SDPA:
+        # the memory efficient kernels need a contiguous last dim, otherwise
+        # sdpa silently falls back to materialising the full attention matrix
+        q, k, v = map(lambda t: t if t.stride(-1) == 1 else t.contiguous(), (q, k, v))
+        # sdpa always scales by dim_head ** -0.5
+        if scale != q.shape[-1] ** -0.5:
+            q = q * (scale * q.shape[-1] ** 0.5)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    return chunked_attention(q, k, v, scale, mask=mask,
+                             query_chunk_size=query_chunk_size, key_chunk_size=key_chunk_size)
+
+
+class CrossAttentionKVCache(object):
+    """
+    Keys and values of the cross-attention layers for the contexts seen during
+    one sampling job. The context is constant over the job, so to_k / to_v only
+    need to run once per layer and context instead of at every step.
+
+    Contexts are identified by object identity and, for samplers that rebuild
+    the guidance batch with torch.cat at every step, by value. References to
+    them are held, so their memory can not be reused by a different context,
+    and a context modified in place (its _version changed) gets new keys and
+    values.
+    """
+    def __init__(self, max_contexts=8):
+        self.max_contexts = max_contexts
+        self.contexts = []
+        self.kv = dict()
+        self.hits = 0
+        self.misses = 0
+        self._last = None
+
+    def _context_id(self, context):
+        if self._last is not None and self._last[0] is context and self._last[1] == context._version:
+            return self._last[2]
+        for cid, (ctx, version) in enumerate(self.contexts):
+            if ctx._version != version:
+                # modified in place since its keys and values were computed
+                if ctx is context:
+                    self.contexts[cid] = (context, context._version)
+                    self.kv = {key: kv for key, kv in self.kv.items() if key[1] != cid}
+                    break
+                continue
+            if ctx is context:
+                break
+            if (ctx.shape == context.shape and ctx.dtype == context.dtype and ctx.device == context.device
+                    and torch.equal(ctx, context)):
+                break
+        else:
+            if len(self.contexts) >= self.max_contexts:
+                self.clear()
+            cid = len(self.contexts)
+            self.contexts.append((context, context._version))
+        self._last = (context, context._version, cid)
+        return cid
+
+    def get(self, layer, context):
+        key = (id(layer), self._context_id(context))
+        if key in self.kv:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.kv[key] = (layer.to_k(context), layer.to_v(context))
+        return self.kv[key]
+
+    def clear(self):
+        self.contexts = []
+        self.kv = dict()
+        self._last = None
+
+
+_kv_cache = None
+
+
+@contextmanager
+def cross_attention_kv_cache():
+    """Cache cross-attention keys and values for the duration of a sampling job."""
+    global _kv_cache
+    if _kv_cache is not None:
+        # nested sampling calls share the outer job's cache
+        yield _kv_cache
+        return
+    _kv_cache = CrossAttentionKVCache()
+    try:
+        yield _kv_cache
+    finally:
+        _kv_cache.clear()
+        _kv_cache = None
+
+
 # feedforward
 class GEGLU(nn.Module):
     def __init__(self, dim_in, dim_out):
@@ -133,18 +289,9 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = rearrange(q, 'b c h w -> b (h w) c')
-        k = rearrange(k, 'b c h w -> b c (h w)')
-        w_ = torch.einsum('bij,bjk->bik', q, k)
-
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = rearrange(v, 'b c h w -> b c (h w)')
-        w_ = rearrange(w_, 'b i j -> b j i')
-        h_ = torch.einsum('bij,bjk->bik', v, w_)
-        h_ = rearrange(h_, 'b c (h w) -> b c h w', h=h)
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b 1 (h w) c'), (q, k, v))
+        h_ = attention(q, k, v, scale=int(c)**(-0.5))
+        h_ = rearrange(h_, 'b 1 (h w) c -> b c h w', h=h)
         h_ = self.proj_out(h_)
 
         return x+h_
@@ -171,40 +318,23 @@ class CrossAttention(nn.Module):
     def forward(self, x, context=None, mask=None):
         h = self.heads
 
-        #print("x shape: ", x.shape)
         q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
-        #print("q shape: ", q.shape)
-        #print("k shape: ", k.shape)
-        #print("v shape: ", v.shape)
-        bq, nq, hdq = q.shape
-        dq = hdq // h
-        bk, nk, hdk = k.shape
-        dk = hdk // h
-        bv, nv, hdv = v.shape
-        dv = hdv // h
-
-        #q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
-        q = q.reshape(bq, nq*h, dq).permute(2,1,0).reshape(dq,nq,h,bq).permute(3,2,1,0).reshape(bq*h, nq,dq)
-        k = k.reshape(bk, nk*h, dk).permute(2,1,0).reshape(dk,nk,h,bk).permute(3,2,1,0).reshape(bk*h, nk,dk)
-        v = v.reshape(bv, nv*h, dv).permute(2,1,0).reshape(dv,nv,h,bv).permute(3,2,1,0).reshape(bv*h, nv,dv)
+        if context is not None and _kv_cache is not None and not torch.is_grad_enabled():
+            k, v = _kv_cache.get(self, context)
+        else:
+            context = default(context, x)
+            k = self.to_k(context)
+            v = self.to_v(context)
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+        # 'b n (h d) -> b h n d' as views, the kernel handles the strides
+        q, k, v = map(lambda t: t.view(t.shape[0], t.shape[1], h, -1).transpose(1, 2), (q, k, v))
 
         if exists(mask):
-            mask = mask.reshape(mask.shape[0], -1)
-            #mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
-            mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
+            mask = mask.reshape(mask.shape[0], 1, 1, -1)
 
         # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = einsum('b i j, b j d -> b i d', attn, v)
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+        out = attention(q, k, v, scale=self.scale, mask=mask)
+        out = out.transpose(1, 2).reshape(x.shape[0], x.shape[1], -1)
         return self.to_out(out)
 
 class EncryptedCrossAttention(nn.Module):
@@ -265,14 +395,22 @@ class BasicTransformerBlock(nn.Module):
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
-
-    def forward(self, x, context=None):
-        return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
-
-    def _forward(self, x, context=None):
-        x = self.attn1(self.norm1(x)) + x
+        # token merging for attn1 and ff (see ldm/modules/tome.py), off by default
+        self.tome_ratio = 0.
+        self.tome_stride = (2, 2)
+
+    def forward(self, x, context=None, hw=None):
+        return checkpoint(partial(self._forward, hw=hw), (x, context), self.parameters(), self.checkpoint)
+
+    def _forward(self, x, context=None, hw=None):
+        merge, unmerge = do_nothing, do_nothing
+        if self.tome_ratio > 0 and hw is not None:
+            h, w = hw
+            merge, unmerge = bipartite_soft_matching_2d(x, w, h, *self.tome_stride,
+                                                        r=int(x.shape[1] * self.tome_ratio))
+        x = unmerge(self.attn1(merge(self.norm1(x)))) + x
         x = self.attn2(self.norm2(x), context=context) + x
-        x = self.ff(self.norm3(x)) + x
+        x = unmerge(self.ff(merge(self.norm3(x)))) + x
         return x
 
 class EncryptedBasicTransformerBlock(nn.Module):
@@ -407,7 +545,7 @@ class SpatialTransformer(nn.Module):
         x = self.proj_in(x)
         x = rearrange(x, 'b c h w -> b (h w) c')
         for block in self.transformer_blocks:
-            x = block(x, context=context)
+            x = block(x, context=context, hw=(h, w))
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
         return x + x_in
@@ -6,7 +6,7 @@ import numpy as np
 from einops import rearrange
 
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, attention, chunked_attention
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -80,9 +80,13 @@ class Downsample(nn.Module):
 
 
 class ResnetBlock(nn.Module):
+    # norms that fuse_groupnorm_silu may merge with the following nonlinearity
+    fused_norm_names = ("norm1", "norm2")
+
     def __init__(self, *, in_channels, out_channels=None, conv_shortcut=False,
                  dropout, temb_channels=512):
         super().__init__()
+        self.fused_norm = False
         self.in_channels = in_channels
         out_channels = in_channels if out_channels is None else out_channels
         self.out_channels = out_channels
@@ -121,14 +125,16 @@ class ResnetBlock(nn.Module):
     def forward(self, x, temb):
         h = x
         h = self.norm1(h)
-        h = nonlinearity(h)
+        if not self.fused_norm:
+            h = nonlinearity(h)
         h = self.conv1(h)
 
         if temb is not None:
             h = h + self.temb_proj(nonlinearity(temb))[:,:,None,None]
 
         h = self.norm2(h)
-        h = nonlinearity(h)
+        if not self.fused_norm:
+            h = nonlinearity(h)
         h = self.dropout(h)
         h = self.conv2(h)
 
@@ -148,9 +154,12 @@ class LinAttnBlock(LinearAttention):
 
 
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, chunk_size=None):
         super().__init__()
         self.in_channels = in_channels
+        # if set, attend chunk_size x chunk_size blocks at a time, which bounds
+        # the memory of the (h*w) x (h*w) attention at any resolution
+        self.chunk_size = chunk_size
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -184,39 +193,44 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b,c,h*w)
-        w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b,c,h,w)
+        # b,1,hw,c with contiguous channels (a view for channels_last inputs)
+        q, k, v = map(lambda t: t.permute(0, 2, 3, 1).reshape(b, 1, h*w, c), (q, k, v))
+        if self.chunk_size is None:
+            h_ = attention(q, k, v, scale=int(c)**(-0.5))
+        else:
+            h_ = chunked_attention(q, k, v, int(c)**(-0.5),
+                                   query_chunk_size=self.chunk_size, key_chunk_size=self.chunk_size)
+        h_ = h_.reshape(b,h,w,c).permute(0, 3, 1, 2)
 
         h_ = self.proj_out(h_)
 
         return x+h_
 
 
-def make_attn(in_channels, attn_type="vanilla"):
+def make_attn(in_channels, attn_type="vanilla", chunk_size=None):
     assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
-        return AttnBlock(in_channels)
+        return AttnBlock(in_channels, chunk_size=chunk_size)
     elif attn_type == "none":
         return nn.Identity(in_channels)
     else:
         return LinAttnBlock(in_channels)
 
 
+def set_attn_chunk_size(module, chunk_size):
+    """Set the attention chunk size of every AttnBlock in module (None: default kernel)."""
+    for m in module.modules():
+        if isinstance(m, AttnBlock):
+            m.chunk_size = chunk_size
+    return module
+
+
 class Model(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla"):
+                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla",
+                 attn_chunk_size=None):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -259,7 +273,7 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -274,7 +288,7 @@ class Model(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -296,7 +310,7 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -369,7 +383,7 @@ class Encoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, double_z=True, use_linear_attn=False, attn_type="vanilla",
-                 **ignore_kwargs):
+                 attn_chunk_size=None, **ignore_kwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -402,7 +416,7 @@ class Encoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -417,7 +431,7 @@ class Encoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -460,11 +474,14 @@ class Encoder(nn.Module):
 
 
 class Decoder(nn.Module):
+    fused_norm_names = ("norm_out",)
+
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, give_pre_end=False, tanh_out=False, use_linear_attn=False,
-                 attn_type="vanilla", **ignorekwargs):
+                 attn_type="vanilla", attn_chunk_size=None, **ignorekwargs):
         super().__init__()
+        self.fused_norm = False
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
         self.temb_ch = 0
@@ -496,7 +513,7 @@ class Decoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -515,7 +532,7 @@ class Decoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, chunk_size=attn_chunk_size))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -561,7 +578,8 @@ class Decoder(nn.Module):
             return h
 
         h = self.norm_out(h)
-        h = nonlinearity(h)
+        if not self.fused_norm:
+            h = nonlinearity(h)
         h = self.conv_out(h)
         if self.tanh_out:
             h = torch.tanh(h)
@@ -197,6 +197,7 @@ class ResBlock(TimestepBlock):
         self.use_conv = use_conv
         self.use_checkpoint = use_checkpoint
         self.use_scale_shift_norm = use_scale_shift_norm
+        self.emb_table = None
 
         self.in_layers = nn.Sequential(
             normalization(channels),
@@ -261,7 +262,11 @@ class ResBlock(TimestepBlock):
             h = in_conv(h)
         else:
             h = self.in_layers(x)
-        emb_out = self.emb_layers(emb).type(h.dtype)
+        table = self.emb_table
+        if table is not None and table.index is not None:
+            emb_out = table.projections[self][table.index].type(h.dtype)
+        else:
+            emb_out = self.emb_layers(emb).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
         if self.use_scale_shift_norm:
@@ -410,6 +415,151 @@ class QKVAttention(nn.Module):
         return count_flops_attn(model, _x, y)
 
 
+class FeatureCache:
+    """
+    Cross-timestep cache of the deep UNet features (DeepCache). Every
+    `interval`-th sampling step is a full step that runs the whole UNet and
+    stores the input of output block len(output_blocks) - branch - 1; on the
+    steps in between only input blocks [0, branch] and the last branch + 1
+    output blocks run, on top of the stored features.
+
+    A step may call the UNet several times (guidance branches, the first PLMS
+    step), so features are stored per call slot: the n-th call of a cheap step
+    reuses what the n-th call of the last full step stored. Outside a run
+    (before the first begin_step, after end_run) the UNet runs in full and
+    nothing is stored, so samplers that do not call begin_step (DPM solver)
+    are unaffected.
+    """
+    def __init__(self, interval=3, branch=0):
+        assert interval >= 1 and branch >= 0
+        self.interval = interval
+        self.branch = branch
+        self.features = dict()
+        self.step = None
+        self.slot = 0
+
+    def begin_step(self, step):
+        if step == 0 or self.step is None or step != self.step + 1:
+            # new run, or a resumed one: features of other runs do not apply
+            self.features = dict()
+        self.step = step
+        self.slot = 0
+
+    def end_run(self):
+        self.features = dict()
+        self.step = None
+        self.slot = 0
+
+    @property
+    def active(self):
+        return self.step is not None
+
+    @property
+    def full_step(self):
+        return self.step % self.interval == 0
+
+    def next_slot(self):
+        self.slot += 1
+        return self.slot - 1
+
+    def lookup(self, slot, batch_size):
+        if self.full_step:
+            return None
+        h = self.features.get(slot)
+        if h is None or h.shape[0] != batch_size:
+            return None
+        return h
+
+
+def enable_feature_cache(unet, interval=3, branch=0):
+    """Turn on DeepCache-style feature caching for a UNetModel (interval 1 or None turns it off)."""
+    unet.feature_cache = FeatureCache(interval, branch) if interval is not None and interval > 1 else None
+    return unet
+
+
+def begin_feature_cache_step(model, step):
+    """Called by the samplers at the start of every step, a no-op unless caching is enabled."""
+    unet = getattr(getattr(model, "model", None), "diffusion_model", None)
+    cache = getattr(unet, "feature_cache", None)
+    if cache is not None:
+        cache.begin_step(step)
+
+
+def end_feature_cache_run(model):
+    """Called by the samplers after their last step, drops the stored features."""
+    unet = getattr(getattr(model, "model", None), "diffusion_model", None)
+    cache = getattr(unet, "feature_cache", None)
+    if cache is not None:
+        cache.end_run()
+
+
+class TimestepEmbeddingTable:
+    """
+    time_embed and ResBlock emb_layers outputs for the fixed timesteps of a
+    sampling schedule. While a UNet forward runs on timesteps that are all in
+    the table, `index` holds their rows and ResBlocks read their projection
+    from it instead of running emb_layers. The rows are rebuilt when the
+    dtype the UNet would compute them in changes (.half(), autocast).
+    """
+    def __init__(self, unet, timesteps):
+        self.unet = unet
+        self.resblocks = [m for m in unet.modules() if isinstance(m, ResBlock)]
+        self.params = list(unet.time_embed.parameters())
+        for m in self.resblocks:
+            self.params.extend(m.emb_layers.parameters())
+        self.version = self.weights_version()
+        device = unet.time_embed[0].weight.device
+        self.timesteps = th.unique(th.as_tensor(np.asarray(timesteps), dtype=th.long, device=device))
+        self.build()
+        self.index = None
+
+    def build(self):
+        with th.no_grad():
+            t_emb = timestep_embedding(self.timesteps, self.unet.model_channels, repeat_only=False)
+            self.emb = self.unet.time_embed(t_emb.to(self.unet.time_embed[0].weight.dtype))
+            self.projections = {m: m.emb_layers(self.emb) for m in self.resblocks}
+
+    def weights_version(self):
+        # bumped by every in-place update, e.g. an optimizer step
+        return sum(p._version for p in self.params)
+
+    def compute_dtype(self):
+        """dtype of time_embed's output when run now: the autocast dtype if enabled, else the weights'."""
+        device = self.timesteps.device
+        if device.type == "cuda" and th.is_autocast_enabled():
+            return th.get_autocast_gpu_dtype()
+        if device.type == "cpu" and th.is_autocast_cpu_enabled():
+            return th.get_autocast_cpu_dtype()
+        return self.unet.time_embed[0].weight.dtype
+
+    def lookup(self, timesteps):
+        """Rows of timesteps in the table, None if one of them is missing or the weights changed."""
+        if th.is_grad_enabled() or timesteps.device != self.timesteps.device or timesteps.dtype != th.long:
+            return None
+        idx = th.searchsorted(self.timesteps, timesteps).clamp_(max=len(self.timesteps) - 1)
+        if not th.equal(self.timesteps[idx], timesteps) or self.weights_version() != self.version:
+            return None
+        if self.emb.dtype != self.compute_dtype():
+            self.build()
+        return idx
+
+
+def precompute_timestep_embeddings(model, timesteps):
+    """Called by the samplers when they build their schedule."""
+    unet = getattr(getattr(model, "model", None), "diffusion_model", None)
+    if not isinstance(unet, UNetModel) or unet.num_classes is not None:
+        return
+    table = unet.timestep_table
+    if table is not None and table.version == table.weights_version() and \
+            th.equal(table.timesteps.cpu(), th.unique(th.as_tensor(np.asarray(timesteps), dtype=th.long))) and \
+            table.timesteps.device == unet.time_embed[0].weight.device:
+        return
+    table = TimestepEmbeddingTable(unet, timesteps)
+    unet.timestep_table = table
+    for m in table.resblocks:
+        m.emb_table = table
+
+
 class UNetModel(nn.Module):
     """
     The full UNet model with attention and timestep embedding.
@@ -684,6 +834,8 @@ class UNetModel(nn.Module):
             nn.SiLU(),
             zero_module(conv_nd(dims, model_channels, out_channels, 3, padding=1)),
         )
+        self.feature_cache = None
+        self.timestep_table = None
         if self.predict_codebook_ids:
             self.id_predictor = nn.Sequential(
             normalization(ch),
@@ -720,19 +872,47 @@ class UNetModel(nn.Module):
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        table = self.timestep_table
+        idx = table.lookup(timesteps) if table is not None else None
+        if table is not None:
+            # rows of this call for the ResBlocks, None makes them run emb_layers
+            table.index = idx
+        if idx is not None:
+            emb = table.emb[idx]
+        else:
+            t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+            emb = self.time_embed(t_emb)
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
+        cache, cached = self.feature_cache, None
+        if cache is not None and not cache.active:
+            # called outside a sampling run, nothing to reuse or store
+            cache = None
+        if cache is not None:
+            slot = cache.next_slot()
+            cached = cache.lookup(slot, x.shape[0])
+            resume = len(self.output_blocks) - cache.branch - 1
+
         h = x.type(self.dtype)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        if cached is not None:
+            # cheap step: shallow blocks only, deep features from the last full step
+            for module in self.input_blocks[:cache.branch + 1]:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = cached
+            output_blocks = self.output_blocks[resume:]
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            output_blocks = self.output_blocks
+        for j, module in enumerate(output_blocks):
+            if cached is None and cache is not None and j == resume:
+                cache.features[slot] = h
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
@@ -12,6 +12,7 @@ import os
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from einops import repeat
 
@@ -213,7 +214,65 @@ class SiLU(nn.Module):
 
 class GroupNorm32(nn.GroupNorm):
     def forward(self, x):
-        return super().forward(x.float()).type(x.dtype)
+        # only fp16 needs the float32 round trip, bf16 has the range of float32
+        if x.dtype == torch.float16:
+            return super().forward(x.float()).type(x.dtype)
+        return super().forward(x)
+
+
+class GroupNormSiLU(nn.GroupNorm):
+    """
+    GroupNorm followed by an in-place SiLU, replacing a (GroupNorm, SiLU) pair
+    for inference. Parameter names are those of nn.GroupNorm, so state dicts
+    still load.
+    """
+    def forward(self, x):
+        if x.dtype == torch.float16:
+            return F.silu(super().forward(x.float()), inplace=True).type(x.dtype)
+        return F.silu(super().forward(x), inplace=True)
+
+    @classmethod
+    def from_groupnorm(cls, norm):
+        fused = cls(norm.num_groups, norm.num_channels, eps=norm.eps, affine=norm.affine)
+        if norm.affine:
+            fused.weight = norm.weight
+            fused.bias = norm.bias
+        return fused
+
+
+def fuse_groupnorm_silu(module):
+    """
+    Replace every GroupNorm directly followed by SiLU inside an nn.Sequential by
+    GroupNormSiLU (the SiLU becomes an Identity, so indices do not shift), and
+    fuse the norms of modules that apply the nonlinearity functionally and list
+    them in `fused_norm_names`.
+    """
+    # with scale-shift norm the SiLU comes after the modulation, not after the norm
+    skip = set(id(m.out_layers) for m in module.modules() if getattr(m, "use_scale_shift_norm", False))
+    for m in list(module.modules()):
+        if isinstance(m, nn.Sequential) and id(m) not in skip:
+            for i in range(len(m) - 1):
+                if type(m[i]) in (nn.GroupNorm, GroupNorm32) and isinstance(m[i + 1], (nn.SiLU, SiLU)):
+                    m[i] = GroupNormSiLU.from_groupnorm(m[i])
+                    m[i + 1] = nn.Identity()
+        elif hasattr(m, "fused_norm_names") and not m.fused_norm:
+            for name in m.fused_norm_names:
+                setattr(m, name, GroupNormSiLU.from_groupnorm(getattr(m, name)))
+            m.fused_norm = True
+    return module
+
+
+def prepare_cpu_inference(module, channels_last=True, fuse_norm=True):
+    """
+    Convert a UNet or VAE decoder for CPU inference: fused GroupNorm+SiLU and
+    channels_last weights (convolutions then keep activations in NHWC, which
+    is what oneDNN is fastest with). Run it under torch.autocast("cpu") for bf16.
+    """
+    if fuse_norm:
+        fuse_groupnorm_silu(module)
+    if channels_last:
+        module.to(memory_format=torch.channels_last)
+    return module
 
 def conv_nd(dims, *args, **kwargs):
     """
@@ -264,4 +323,33 @@ class HybridConditioner(nn.Module):
 def noise_like(shape, device, repeat=False):
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
\ No newline at end of file
+    return repeat_noise() if repeat else noise()
+
+class SampleNoise(object):
+    """
+    Counter-based gaussian noise: Philox keyed by (seed, sample index), with
+    the step and the stream in the counter. The noise of a sample depends only
+    on its key and the step, not on batch composition, call order, device or
+    the global RNG, so jobs can be batched, resharded or resumed with the same
+    results.
+    """
+    START, STEP = 0, 1
+
+    def __init__(self, seed, sample_indices):
+        self.seed = int(seed)
+        self.sample_indices = [int(i) for i in sample_indices]
+
+    def _randn(self, sample_index, shape, step, stream):
+        key = [self.seed & (2 ** 64 - 1), sample_index & (2 ** 64 - 1)]
+        # Philox advances the lowest counter word, the step and stream words keep the streams apart
+        generator = np.random.Generator(np.random.Philox(key=key, counter=[0, step & (2 ** 64 - 1), stream, 0]))
+        return torch.from_numpy(generator.standard_normal(shape, dtype=np.float32))
+
+    def randn(self, shape, step, device="cpu", stream=STEP):
+        """Noise of shape (batch, ...) for the samples of this batch at the given step."""
+        assert shape[0] == len(self.sample_indices), f"{shape[0]} != {len(self.sample_indices)} samples"
+        noise = torch.stack([self._randn(i, tuple(shape[1:]), step, stream) for i in self.sample_indices])
+        return noise.to(device)
+
+    def start_code(self, shape, device="cpu"):
+        return self.randn(shape, 0, device, stream=self.START)
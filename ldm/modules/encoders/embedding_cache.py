@@ -0,0 +1,100 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+
+def cond_model_id(config, ckpt):
+    """Identify the conditioning stage by its config and the checkpoint it was loaded from."""
+    cond_config = OmegaConf.to_yaml(config.model.params.cond_stage_config)
+    ckpt = os.path.abspath(ckpt)
+    mtime = os.path.getmtime(ckpt) if os.path.exists(ckpt) else 0
+    return f"{cond_config}|{ckpt}|{mtime}"
+
+
+class PromptEmbeddingCache(object):
+    """Cache of text embeddings keyed by (cond model id, prompt).
+
+    Lookups go through an in-memory LRU first and then, if cache_dir is given,
+    through an on-disk store of one .npy file per prompt which is memory mapped
+    on read and shared between processes. Prompts missing from both are
+    encoded together in a single batch.
+    """
+    def __init__(self, model, model_id, cache_dir=None, max_items=256):
+        self.model = model
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._uc = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, prompt):
+        return hashlib.sha1(f"{self.model_id}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def _remember(self, key, emb):
+        self.lru[key] = emb
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_items:
+            self.lru.popitem(last=False)
+
+    def _lookup(self, key):
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            return self.lru[key]
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            # copy-on-write mapping: reads share the page cache with other processes, torch.stack copies
+            emb = torch.from_numpy(np.load(self._path(key), mmap_mode="c"))
+            self._remember(key, emb)
+            return emb
+        return None
+
+    def _store(self, key, emb):
+        self._remember(key, emb)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, emb.numpy())
+        # atomic, so concurrent readers never see a partial file
+        os.replace(tmp, path)
+
+    @torch.no_grad()
+    def encode(self, prompts):
+        """Return the stacked embeddings of prompts, encoding only the ones not cached yet."""
+        keys = [self._key(p) for p in prompts]
+        found = {k: self._lookup(k) for k in set(keys)}
+        missing = [k for k, v in found.items() if v is None]
+        self.hits += sum(found[k] is not None for k in keys)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            key_to_prompt = dict(zip(keys, prompts))
+            c = self.model.get_learned_conditioning([key_to_prompt[k] for k in missing])
+            for k, emb in zip(missing, c.detach().float().cpu()):
+                self._store(k, emb)
+                found[k] = emb
+        c = torch.stack([found[k] for k in keys])
+        placement = getattr(self.model, "placement", None)
+        if placement is not None:
+            c = c.to(placement.unet)
+        return c
+
+    def unconditional(self, batch_size):
+        """Embedding of the empty prompt, computed once per process."""
+        if self._uc is None:
+            self._uc = self.encode([""])
+        return self._uc.expand(batch_size, *self._uc.shape[1:])
+
+    def stats(self):
+        return f"embedding cache: {self.hits} hits, {self.misses} misses, {len(self.lru)} in memory"
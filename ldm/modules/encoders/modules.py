@@ -162,6 +162,30 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         return self(text)
 
 
+class ByteTextEmbedder(AbstractEncoder):
+    """UTF-8 bytes as tokens and a random embedding table, a stand-in for CLIP that needs no download"""
+    def __init__(self, n_embed=64, max_length=16, device="cuda", seed=0):
+        super().__init__()
+        self.device = device
+        self.max_length = max_length
+        generator = torch.Generator().manual_seed(seed)
+        self.embedding = nn.Embedding(256, n_embed)
+        self.pos_embedding = nn.Parameter(torch.zeros(max_length, n_embed))
+        with torch.no_grad():
+            self.embedding.weight.copy_(torch.randn(256, n_embed, generator=generator))
+            self.pos_embedding.copy_(0.1 * torch.randn(max_length, n_embed, generator=generator))
+        for param in self.parameters():
+            param.requires_grad = False
+
+    def forward(self, text):
+        tokens = [list(t.encode("utf-8")[:self.max_length]) for t in text]
+        tokens = torch.tensor([t + [0] * (self.max_length - len(t)) for t in tokens], device=self.device)
+        return self.embedding(tokens) + self.pos_embedding
+
+    def encode(self, text):
+        return self(text)
+
+
 class FrozenCLIPTextEmbedder(nn.Module):
     """
     Uses the CLIP transformer encoder for text.
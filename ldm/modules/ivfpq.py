@@ -0,0 +1,250 @@
+"""Approximate nearest neighbour search for the retrieval databases without scann.
+
+IVFPQIndex is an inverted file over a k-means coarse quantizer whose lists
+hold product-quantized residuals: a query scores the vectors of its
+nprobe closest lists from per-subspace lookup tables, and the best
+reorder_k candidates are rescored exactly against the stored embeddings.
+BruteForceIndex scans all embeddings in chunks. Both score by dot product
+(the embeddings are normalized), mimic the search_batched / serialize
+interface of the scann searchers, and build_index picks between them with
+the pool-size heuristics of scripts/train_searcher.py. k-means runs in torch,
+the rest in NumPy; embeddings can be memory mapped (see EmbeddingStore) and
+are only read in chunks.
+"""
+
+import os
+import json
+
+import numpy as np
+import torch
+
+
+def _assign(x, centroids, chunk=1024):
+    """Nearest centroid per subspace: x (n, m, ds), centroids (m, K, ds) -> (n, m) int64."""
+    c_norm = (centroids ** 2).sum(-1)
+    out = torch.empty(x.shape[:2], dtype=torch.long)
+    for start in range(0, len(x), chunk):
+        xc = x[start:start + chunk]
+        # ||x - c||^2 up to the ||x||^2 term, which does not change the argmin
+        dist = c_norm[None] - 2 * torch.einsum("nmd,mkd->nmk", xc, centroids)
+        out[start:start + chunk] = dist.argmin(-1)
+    return out
+
+
+def kmeans(x, k, iters=20, seed=0):
+    """
+    Independent k-means in each of the m subspaces of x (n, m, ds), all at
+    once. Empty clusters are reseeded from random points. Returns the
+    centroids (m, k, ds).
+    """
+    x = torch.as_tensor(np.ascontiguousarray(x), dtype=torch.float32)
+    n, m, ds = x.shape
+    assert n >= k, f"{n} training vectors for {k} centroids"
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(n, generator=generator)[:k]].transpose(0, 1).contiguous()
+    offsets = torch.arange(m)[None] * k
+    for _ in range(iters):
+        flat = (_assign(x, centroids) + offsets).reshape(-1)
+        sums = torch.zeros(m * k, ds).index_add_(0, flat, x.reshape(-1, ds))
+        counts = torch.zeros(m * k).index_add_(0, flat, torch.ones(len(flat)))
+        empty = counts == 0
+        sums = sums / counts.clamp(min=1)[:, None]
+        if empty.any():
+            # reseed with the subvectors of random points
+            subspace = torch.nonzero(empty)[:, 0] // k
+            points = torch.randint(n, (len(subspace),), generator=generator)
+            sums[empty] = x[points, subspace]
+        centroids = sums.reshape(m, k, ds)
+    return centroids
+
+
+def _topk(scores, k):
+    """Indices and values of the k largest scores per row, sorted."""
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-vals, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+class BruteForceIndex(object):
+    def __init__(self, embeddings, chunk_rows=65536):
+        self.embeddings = embeddings
+        self.chunk_rows = chunk_rows
+
+    def search_batched(self, queries, final_num_neighbors=10):
+        queries = np.asarray(queries, dtype=np.float32)
+        k = final_num_neighbors
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        best = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.embeddings), self.chunk_rows):
+            chunk = np.asarray(self.embeddings[start:start + self.chunk_rows], dtype=np.float32)
+            ids, scores = _topk(queries @ chunk.T, k)
+            ids, best = np.concatenate([best_ids, ids + start], 1), np.concatenate([best, scores], 1)
+            top, best = _topk(best, k)
+            best_ids = np.take_along_axis(ids, top, axis=1)
+        return best_ids, best
+
+    def serialize(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump(dict(type="brute_force"), f)
+
+
+class IVFPQIndex(object):
+    def __init__(self, centroids, codebooks, nprobe=1, reorder_k=0, embeddings=None):
+        """centroids (nlist, d), codebooks (m, K, d / m); use train() and add() to build one."""
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)
+        self.nprobe = nprobe
+        self.reorder_k = reorder_k
+        self.embeddings = embeddings
+        self.list_offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        # one row per subspace, so that scoring a list reads contiguous codes
+        self.codes = np.zeros((len(self.codebooks), 0), dtype=np.uint8)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, sample, nlist, dims_per_block=4, n_centers=256, iters=20, seed=0, max_pq_sample=65536, **kwargs):
+        """
+        Fit the coarse quantizer on a sample of embeddings and the residual
+        product quantizer on at most max_pq_sample of them.
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+        d = sample.shape[1]
+        assert d % dims_per_block == 0, f"dimension {d} is not a multiple of dims_per_block {dims_per_block}"
+        assert n_centers <= 256, "codes are stored as uint8"
+        centroids = kmeans(sample[:, None], nlist, iters, seed)[0].numpy()
+        residuals = sample - centroids[_assign(torch.from_numpy(sample[:, None]),
+                                               torch.from_numpy(centroids[None]))[:, 0].numpy()]
+        residuals = residuals[np.random.default_rng(seed).permutation(len(sample))[:max_pq_sample]]
+        codebooks = kmeans(residuals.reshape(len(residuals), -1, dims_per_block), n_centers, iters, seed).numpy()
+        return cls(centroids, codebooks, **kwargs)
+
+    def _encode(self, x):
+        x = torch.from_numpy(np.array(x, dtype=np.float32))
+        lists = _assign(x[:, None], torch.from_numpy(self.centroids[None]))[:, 0]
+        residuals = x - torch.from_numpy(self.centroids)[lists]
+        codes = _assign(residuals.reshape(len(x), len(self.codebooks), -1), torch.from_numpy(self.codebooks))
+        return lists.numpy(), codes.numpy().astype(np.uint8)
+
+    def add(self, embeddings, chunk_rows=65536):
+        """Encode all embeddings, reading them chunk by chunk; the ids are their row numbers."""
+        n = len(embeddings)
+        lists = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, len(self.codebooks)), dtype=np.uint8)
+        for start in range(0, n, chunk_rows):
+            lists[start:start + chunk_rows], codes[start:start + chunk_rows] = \
+                self._encode(embeddings[start:start + chunk_rows])
+        order = np.argsort(lists, kind="stable")
+        self.ids, self.codes = order, np.ascontiguousarray(codes[order].T)
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.nlist))])
+        if self.embeddings is None:
+            self.embeddings = embeddings
+        return self
+
+    def search_batched(self, queries, final_num_neighbors=10, leaves_to_search=None, pre_reorder_num_neighbors=None):
+        """
+        Like scann's search_batched, the last two override nprobe and reorder_k
+        for this call. More lists are probed when the nprobe closest hold fewer
+        than final_num_neighbors vectors, so only an index with fewer vectors
+        than that pads with id -1.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        k = final_num_neighbors
+        nprobe = leaves_to_search or self.nprobe
+        reorder_k = self.reorder_k if pre_reorder_num_neighbors is None else pre_reorder_num_neighbors
+        m, n_centers, ds = self.codebooks.shape
+        coarse = queries @ self.centroids.T
+        probes, _ = _topk(coarse, nprobe)
+        # lookup tables: score of every codeword in every subspace, (B, m, K)
+        luts = np.einsum("bmd,mkd->bmk", queries.reshape(len(queries), m, ds), self.codebooks)
+        rerank = reorder_k > 0 and self.embeddings is not None
+        nns = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for b, q in enumerate(queries):
+            lists = probes[b]
+            sizes = self.list_offsets[lists + 1] - self.list_offsets[lists]
+            if sizes.sum() < k:
+                # too few candidates in the probed lists: probe further, by coarse score, until there are k
+                lists = np.argsort(-coarse[b], kind="stable")
+                sizes = self.list_offsets[lists + 1] - self.list_offsets[lists]
+                n_lists = np.searchsorted(np.cumsum(sizes), k) + 1
+                lists, sizes = lists[:n_lists], sizes[:n_lists]
+            ids = np.concatenate([self.ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists])
+            codes = np.concatenate([self.codes[:, self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists], 1)
+            scores = np.repeat(coarse[b, lists], sizes)
+            for j in range(m):
+                scores += luts[b, j].take(codes[j])
+            top, scores = _topk(scores[None], max(k, reorder_k) if rerank else k)
+            ids = ids[top[0]]
+            if rerank:
+                # exact rescoring, rows read in file order
+                order = np.argsort(ids)
+                exact = np.empty(len(ids), dtype=np.float32)
+                exact[order] = np.asarray(self.embeddings[ids[order]], dtype=np.float32) @ q
+                top, scores = _topk(exact[None], k)
+                ids = ids[top[0]]
+            nns[b, :len(ids)], distances[b, :len(ids)] = ids, scores[0]
+        return nns, distances
+
+    def serialize(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, "ivfpq.npz"), centroids=self.centroids, codebooks=self.codebooks,
+                 list_offsets=self.list_offsets, ids=self.ids, codes=self.codes)
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump(dict(type="ivfpq", nprobe=self.nprobe, reorder_k=self.reorder_k), f)
+
+
+def load_index(path, embeddings=None):
+    """Load a serialized index; embeddings (the normalized database) are needed for brute force and reordering."""
+    with open(os.path.join(path, "index.json")) as f:
+        params = json.load(f)
+    if params["type"] == "brute_force":
+        assert embeddings is not None, "a brute force index needs the embeddings"
+        return BruteForceIndex(embeddings)
+    data = np.load(os.path.join(path, "ivfpq.npz"))
+    index = IVFPQIndex(data["centroids"], data["codebooks"], params["nprobe"], params["reorder_k"], embeddings)
+    index.list_offsets, index.ids, index.codes = data["list_offsets"], data["ids"], data["codes"]
+    return index
+
+
+def is_index(path):
+    return os.path.exists(os.path.join(path, "index.json"))
+
+
+def build_index(embeddings, k, reorder_k=None, num_leaves=None, num_leaves_to_search=None,
+                training_sample_size=None, dims_per_block=4, n_centers=256, seed=0):
+    """
+    Index normalized embeddings (N, d) with the pool-size heuristics of
+    train_searcher.py: brute force below 2e4 vectors, product quantization
+    with reordering below 1e5, and above that partitioning into sqrt(N)
+    lists of which 1/20 are searched, trained on a tenth of the pool.
+    """
+    pool_size = len(embeddings)
+    reorder_k = reorder_k or 2 * k
+    if pool_size < 2e4:
+        print('Using brute force search.')
+        return BruteForceIndex(embeddings)
+    if pool_size < 1e5:
+        print('Using product quantization search and reordering.')
+        num_leaves, num_leaves_to_search = 1, 1
+        training_sample_size = training_sample_size or pool_size
+    else:
+        print('Using partitioning, product quantization search and reordering.')
+        num_leaves = num_leaves or int(np.sqrt(pool_size))
+        num_leaves_to_search = num_leaves_to_search or max(num_leaves // 20, 1)
+        training_sample_size = training_sample_size or pool_size // 10
+        print(f'num_leaves: {num_leaves}')
+        print(f'num_leaves_to_search: {num_leaves_to_search}')
+    rng = np.random.default_rng(seed)
+    # sorted, so that a memory-mapped pool is read front to back
+    sample = np.sort(rng.choice(pool_size, min(max(training_sample_size, num_leaves, n_centers), pool_size),
+                                replace=False))
+    index = IVFPQIndex.train(np.asarray(embeddings[sample], dtype=np.float32), num_leaves, dims_per_block,
+                             n_centers, seed=seed, nprobe=num_leaves_to_search, reorder_k=reorder_k)
+    return index.add(embeddings)
@@ -0,0 +1,151 @@
+"""int8 inference mode for the UNet on CPU.
+
+The nn.Linear layers of CrossAttention and FeedForward are replaced with
+dynamically quantized int8 layers (int8 weights, activations quantized per
+call). Convolutions store int8 weights with a scale per output channel,
+which shrinks the saved artifact, but still compute in float: the weight
+is dequantized once per dtype and device and cached, so they run at fp32
+speed and hold a float copy of the weight at run time. Convolutions whose
+output moves too much on calibration inputs stay in float32.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+try:
+    from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+except ImportError:
+    from torch.quantization import quantize_dynamic, default_dynamic_qconfig
+
+
+class Int8Conv2d(nn.Module):
+    """Conv2d with int8 weights and a float scale per output channel."""
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1,
+                 bias=True):
+        super().__init__()
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.groups = groups
+        self.register_buffer("weight_int8", torch.zeros(out_channels, in_channels // groups, *kernel_size,
+                                                        dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(out_channels, 1, 1, 1))
+        self.bias = nn.Parameter(torch.zeros(out_channels)) if bias else None
+        self._weight_cache = None
+
+    @staticmethod
+    def quantize_weight(weight):
+        scale = weight.detach().abs().amax(dim=(1, 2, 3), keepdim=True).float() / 127.
+        scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+        return torch.round(weight.detach().float() / scale).clamp_(-127, 127).to(torch.int8), scale
+
+    @classmethod
+    def from_conv(cls, conv):
+        qconv = cls(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                    conv.dilation, conv.groups, bias=conv.bias is not None)
+        qconv.weight_int8, qconv.weight_scale = cls.quantize_weight(conv.weight)
+        if conv.bias is not None:
+            qconv.bias.data.copy_(conv.bias.detach())
+        return qconv.to(conv.weight.device)
+
+    def dequantized_weight(self, dtype=torch.float32):
+        return (self.weight_int8.to(dtype) * self.weight_scale.to(dtype))
+
+    def cached_weight(self, dtype):
+        # rebuilt when the int8 weights are replaced, loaded or moved
+        key = (dtype, self.weight_int8.device, self.weight_int8.data_ptr(), self.weight_int8._version,
+               self.weight_scale.data_ptr(), self.weight_scale._version)
+        if self._weight_cache is None or self._weight_cache[0] != key:
+            self._weight_cache = (key, self.dequantized_weight(dtype))
+        return self._weight_cache[1]
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        if torch.is_grad_enabled():
+            weight = self.dequantized_weight(x.dtype)
+        else:
+            weight = self.cached_weight(x.dtype)
+        return F.conv2d(x, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+
+    def extra_repr(self):
+        return f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size}, stride={self.stride}"
+
+
+def linear_names(unet):
+    """Names of the nn.Linear layers inside CrossAttention and FeedForward."""
+    from ldm.modules.attention import CrossAttention, FeedForward
+    names = []
+    for name, module in unet.named_modules():
+        if isinstance(module, (CrossAttention, FeedForward)):
+            names.extend(f"{name}.{n}" for n, m in module.named_modules() if isinstance(m, nn.Linear))
+    return names
+
+
+def conv_names(unet):
+    return [name for name, m in unet.named_modules() if type(m) is nn.Conv2d and m.padding_mode == "zeros"]
+
+
+def _set_module(root, name, module):
+    parent, _, child = name.rpartition(".")
+    setattr(root.get_submodule(parent) if parent else root, child, module)
+
+
+@torch.no_grad()
+def calibrate_convs(unet, run_fn, max_rel_error=0.01):
+    """
+    Run run_fn() (e.g. a few sampling steps on calibration prompts) and return
+    the names of the convolutions whose output error with int8 weights stays
+    below max_rel_error, together with all measured errors.
+    """
+    errors = dict()
+
+    def hook(name):
+        def fn(conv, inputs, output):
+            q, scale = Int8Conv2d.quantize_weight(conv.weight)
+            out_q = F.conv2d(inputs[0], (q.float() * scale).to(output.dtype), conv.bias, conv.stride,
+                             conv.padding, conv.dilation, conv.groups)
+            err = ((out_q - output).float().norm() / output.float().norm().clamp(min=1e-12)).item()
+            errors[name] = max(errors.get(name, 0.), err)
+        return fn
+
+    handles = [unet.get_submodule(name).register_forward_hook(hook(name)) for name in conv_names(unet)]
+    try:
+        run_fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+    # convs that run_fn never reached are quantized as well
+    keep = [name for name in conv_names(unet) if errors.get(name, 0.) <= max_rel_error]
+    return keep, errors
+
+
+def quantize_unet(unet, linears=None, convs=None):
+    """
+    Quantize a UNetModel in place. linears and convs are the module names to
+    quantize, by default all Linear layers of the attention / feed-forward
+    blocks and all convolutions (see calibrate_convs to select the convs).
+    """
+    linears = linear_names(unet) if linears is None else list(linears)
+    convs = conv_names(unet) if convs is None else list(convs)
+    for name in convs:
+        _set_module(unet, name, Int8Conv2d.from_conv(unet.get_submodule(name)))
+    if len(linears) > 0:
+        quantize_dynamic(unet, {name: default_dynamic_qconfig for name in linears}, inplace=True)
+    unet.quantization = dict(linears=linears, convs=convs)
+    return unet
+
+
+def save_quantized_unet(unet, path):
+    torch.save({"quantization": unet.quantization, "state_dict": unet.state_dict()}, path)
+
+
+def load_quantized_unet(unet, path):
+    """Quantize a freshly built float UNetModel like the saved one and load its weights."""
+    artifact = torch.load(path, map_location="cpu")
+    unet = quantize_unet(unet.cpu(), **artifact["quantization"])
+    unet.load_state_dict(artifact["state_dict"])
+    return unet
@@ -0,0 +1,121 @@
+"""Token merging (ToMe) for the self-attention and feed-forward layers of
+BasicTransformerBlock.
+
+Tokens are split into a fixed grid of destination tokens (one per sx x sy
+cell) and source tokens; the r source tokens most similar to some
+destination are averaged into it before the layer runs, and copied back
+out of it afterwards. Attention then costs (N - r)^2 instead of N^2.
+"""
+
+import torch
+
+
+def do_nothing(x):
+    return x
+
+
+def bipartite_soft_matching_2d(metric, w, h, sx, sy, r):
+    """
+    Match the tokens of metric (B, h*w, C) and return (merge, unmerge) functions.
+    :param r: number of tokens to remove by merging.
+    """
+    B, N, _ = metric.shape
+    if r <= 0 or h < sy or w < sx:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+        num_dst = hsy * wsx
+
+        # the top left token of every sy x sx cell is a destination (marked -1, so argsort puts it first)
+        idx_buffer = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer[:, :, 0] = -1
+        idx_buffer = idx_buffer.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+        if hsy * sy < h or wsx * sx < w:
+            # border rows / columns that do not fill a cell are always sources
+            padded = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            padded[:hsy * sy, :wsx * sx] = idx_buffer
+            idx_buffer = padded
+        idx_buffer = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        a_idx = idx_buffer[:, num_dst:, :]
+        b_idx = idx_buffer[:, :num_dst, :]
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(x.shape[0], N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(x.shape[0], num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # unmerged source tokens
+        src_idx = edge_idx[..., :r, :]  # merged source tokens
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+        counts = torch.ones(B, num_dst, 1, device=metric.device, dtype=metric.dtype)
+        counts = counts.scatter_add(-2, dst_idx, torch.ones(B, r, 1, device=metric.device, dtype=metric.dtype))
+        unm_pos = torch.gather(a_idx.expand(B, -1, 1), dim=1, index=unm_idx)
+        src_pos = torch.gather(a_idx.expand(B, -1, 1), dim=1, index=src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        n, t1, c = src.shape
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        # mean over each destination and the sources merged into it
+        # (scatter_add + counts instead of scatter_reduce, which needs torch >= 1.12)
+        dst = dst.scatter_add(-2, dst_idx.expand(n, r, c), src) / counts.to(x.dtype)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = x.shape[-1]
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=unm_pos.expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=src_pos.expand(B, r, c), src=src)
+        return out
+
+    return merge, unmerge
+
+
+def apply_token_merging(unet, ratios, stride=(2, 2)):
+    """
+    Set the token merging ratio of every BasicTransformerBlock in a UNetModel
+    by resolution level. ratios maps the downsampling factor of a level to the
+    fraction of its tokens to merge, e.g. {1: 0.5, 2: 0.3} merges half of the
+    tokens at the 64x64 level and 30% at 32x32 of a 512px SD model. Levels that
+    are not listed are left untouched (ratio 0).
+    """
+    from ldm.modules.attention import SpatialTransformer
+    from ldm.modules.diffusionmodules.openaimodel import Downsample, Upsample, ResBlock
+
+    ds = 1
+    for module in list(unet.input_blocks) + [unet.middle_block] + list(unet.output_blocks):
+        for layer in module:
+            if isinstance(layer, SpatialTransformer):
+                for block in layer.transformer_blocks:
+                    block.tome_ratio = ratios.get(ds, 0.)
+                    block.tome_stride = tuple(stride)
+            resample = layer.h_upd if isinstance(layer, ResBlock) else layer
+            if isinstance(resample, Downsample):
+                ds *= 2
+            elif isinstance(resample, Upsample):
+                ds //= 2
+    return unet
+
+
+def parse_ratios(spec):
+    """Parse "1:0.5,2:0.3" into {1: 0.5, 2: 0.3}."""
+    ratios = dict()
+    for item in spec.split(","):
+        if item.strip():
+            ds, ratio = item.split(":")
+            ratios[int(ds)] = float(ratio)
+    return ratios
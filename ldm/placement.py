@@ -0,0 +1,61 @@
+"""Pin the stages of a LatentDiffusion model to devices once.
+
+The text encoder (cond), the UNet and the VAE can live on different devices,
+e.g. "cond=cuda,unet=cpu,vae=cpu" or simply "cpu". The placement is applied a
+single time after loading; samplers follow the device of the noise schedule
+buffers, so nothing has to be moved around per prompt afterwards.
+"""
+
+import torch
+
+
+STAGE_ATTRS = {
+    "cond": ("cond_stage_model",),
+    "unet": ("model", "model_ema"),
+    "vae": ("first_stage_model",),
+}
+
+
+class DevicePlacement(object):
+    def __init__(self, cond="cpu", unet="cpu", vae="cpu"):
+        self.cond = torch.device(cond)
+        self.unet = torch.device(unet)
+        self.vae = torch.device(vae)
+
+    @classmethod
+    def from_string(cls, spec):
+        """Parse "cuda" (all stages) or "cond=cuda,unet=cpu,vae=cpu" (unlisted stages default to cpu)."""
+        spec = spec.strip()
+        if "=" not in spec:
+            return cls(spec, spec, spec)
+        devices = dict()
+        for item in spec.split(","):
+            stage, device = item.split("=")
+            stage = stage.strip()
+            if stage not in STAGE_ATTRS:
+                raise KeyError(f"Unknown stage {stage}, expected one of {sorted(STAGE_ATTRS)}")
+            devices[stage] = device.strip()
+        return cls(**devices)
+
+    def __repr__(self):
+        return f"DevicePlacement(cond={self.cond}, unet={self.unet}, vae={self.vae})"
+
+    @torch.no_grad()
+    def apply(self, model):
+        """Move each stage of model to its device and return model."""
+        for stage, attrs in STAGE_ATTRS.items():
+            device = getattr(self, stage)
+            for attr in attrs:
+                module = getattr(model, attr, None)
+                if module is not None:
+                    module.to(device)
+        # the noise schedule lives on the top level module, samplers take their device from it
+        for name, buf in model._buffers.items():
+            if buf is not None:
+                model._buffers[name] = buf.to(self.unet)
+        cond_stage_model = getattr(model, "cond_stage_model", None)
+        if cond_stage_model is not None and hasattr(cond_stage_model, "device"):
+            # encoders move their tokens to this device
+            cond_stage_model.device = self.cond
+        model.placement = self
+        return model
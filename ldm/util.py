@@ -1,4 +1,6 @@
 import importlib
+import mmap
+import traceback
 
 import torch
 import numpy as np
@@ -8,7 +10,7 @@ from functools import partial
 
 import multiprocessing as mp
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
 
 from inspect import isfunction
 from PIL import Image, ImageDraw, ImageFont
@@ -201,3 +203,180 @@ def parallel_data_prefetch(
         return out
     else:
         return gather_res
+
+
+def shared_empty(shape, dtype):
+    """
+    Uninitialised array in anonymous shared memory: processes forked after it
+    was allocated write into the same pages the parent reads.
+    """
+    count = int(np.prod(shape))
+    buffer = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+def _worker_context(cpu_intensive):
+    if cpu_intensive:
+        ctx = mp.get_context("fork")
+        return ctx.Queue, ctx.Process
+    return Queue, Thread
+
+
+def _rows(out, offsets, i):
+    if isinstance(out, dict):
+        return {key: out[key][offsets[key][i]:offsets[key][i + 1]] for key in out}
+    return out[offsets[i]:offsets[i + 1]]
+
+
+def _get_result(Q, processes, what, timeout=1.):
+    # a worker killed from outside (e.g. by the OOM killer) never reports back
+    while True:
+        try:
+            return Q.get(timeout=timeout)
+        except Empty:
+            dead = [p.exitcode for p in processes if getattr(p, "exitcode", None) not in (None, 0)]
+            if len(dead) > 0:
+                raise RuntimeError(f"{what} worker died with exit code {dead[0]}")
+
+
+def _do_parallel_fill(func, data, out, offsets, indices, Q):
+    try:
+        for i in indices:
+            func(data[i], _rows(out, offsets, i))
+        Q.put("Done")
+    except Exception:
+        Q.put(traceback.format_exc())
+
+
+def parallel_fill(func, data, out, offsets, n_proc, cpu_intensive=True):
+    """
+    Zero-copy counterpart of parallel_data_prefetch: func(item, rows) writes
+    the result of data[i] into rows = out[offsets[i]:offsets[i + 1]] of a
+    preallocated output, so nothing is pickled back or concatenated. out and
+    offsets can also be dicts of outputs and their offsets, rows is then a
+    dict as well. With cpu_intensive the workers are forked processes and out
+    has to live in shared memory (see shared_empty). Returns out.
+    """
+    Q, proc = _worker_context(cpu_intensive)
+    Q = Q()
+    n_proc = max(1, min(n_proc, len(data)))
+    processes = [proc(target=_do_parallel_fill, args=(func, data, out, offsets, range(i, len(data), n_proc), Q))
+                 for i in range(n_proc)]
+    for p in processes:
+        p.start()
+    try:
+        for _ in range(n_proc):
+            res = _get_result(Q, processes, "parallel_fill")
+            if res != "Done":
+                raise RuntimeError(f"parallel_fill worker failed:\n{res}")
+    except BaseException:
+        if cpu_intensive:
+            for p in processes:
+                p.terminate()
+        raise
+    finally:
+        for p in processes:
+            p.join()
+    return out
+
+
+def _do_parallel_prefetch_iter(func, data, indices, Q):
+    try:
+        for i in indices:
+            Q.put((func(data[i]), None))
+    except Exception:
+        Q.put((None, traceback.format_exc()))
+
+
+def parallel_prefetch_iter(func, data, n_proc, cpu_intensive=True, max_pending=2):
+    """
+    Streaming counterpart of parallel_data_prefetch: yields func(item) for the
+    items of data in order while the workers keep loading, each at most
+    max_pending results ahead of the consumer, so a pool can be processed
+    piece by piece without holding all of it at once.
+    """
+    n_proc = max(1, min(n_proc, len(data)))
+    Q, proc = _worker_context(cpu_intensive)
+    # item i goes to worker i % n_proc, whose queue then delivers it in order
+    queues = [Q(max_pending) for _ in range(n_proc)]
+    processes = [proc(target=_do_parallel_prefetch_iter, args=(func, data, range(i, len(data), n_proc), queues[i]))
+                 for i in range(n_proc)]
+    for p in processes:
+        p.daemon = True
+        p.start()
+    try:
+        for i in range(len(data)):
+            res, error = _get_result(queues[i % n_proc], processes, "parallel_prefetch_iter")
+            if error is not None:
+                raise RuntimeError(f"parallel_prefetch_iter worker failed:\n{error}")
+            yield res
+    finally:
+        if cpu_intensive:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+        for p in processes:
+            p.join(timeout=None if cpu_intensive else 0)
+
+
+def npz_member_header(npz, key):
+    """(shape, fortran_order, dtype) of an array in an open .npz archive, without reading its data."""
+    with npz.zip.open(f"{key}.npy") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+            else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+    return shape, fortran_order, dtype
+
+
+def _read_npz_member_into(npz, key, rows):
+    with npz.zip.open(f"{key}.npy") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+            else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        if fortran_order or dtype.hasobject or dtype != rows.dtype:
+            # the pool dtype was promoted from several files, cast on load
+            rows[...] = npz[key]
+            return
+        # decompress straight into the output rows
+        view = memoryview(rows.reshape(-1).view(np.uint8))
+        n = 0
+        while n < len(view):
+            read = f.readinto(view[n:])
+            if read == 0:
+                raise IOError(f"{key} in {npz.zip.filename} is truncated")
+            n += read
+
+
+def load_npz_pool(paths, n_proc):
+    """
+    Concatenate the arrays of several .npz files along their first axis, key
+    by key. Shapes are read from the archive headers, the outputs allocated
+    once in shared memory and every file is decompressed by a worker straight
+    into its rows, which avoids pickling the pool and a second copy of it.
+    Like np.concatenate, files with different dtypes give the promoted dtype;
+    their arrays are read whole and cast.
+    """
+    paths = list(paths)
+    headers = dict()
+    for path in paths:
+        with np.load(path) as npz:
+            for key in npz.files:
+                headers.setdefault(key, []).append(npz_member_header(npz, key))
+    # keys in every file, scalars can not be concatenated
+    keys = [key for key in headers if len(headers[key]) == len(paths) and len(headers[key][0][0]) > 0]
+    pool, offsets = dict(), dict()
+    for key in keys:
+        shapes = [shape for shape, _, _ in headers[key]]
+        assert all(shape[1:] == shapes[0][1:] for shape in shapes), f"{key} has different shapes: {shapes}"
+        offsets[key] = np.cumsum([0] + [shape[0] for shape in shapes]).tolist()
+        dtype = np.result_type(*[dtype for _, _, dtype in headers[key]])
+        pool[key] = shared_empty((offsets[key][-1],) + tuple(shapes[0][1:]), dtype)
+
+    def load_file(path, rows):
+        with np.load(path) as npz:
+            for key, out in rows.items():
+                _read_npz_member_into(npz, key, out)
+
+    return parallel_fill(load_file, paths, pool, offsets, n_proc)
@@ -1,5 +1,6 @@
 from torchvision.datasets.utils import download_url
 from ldm.util import instantiate_from_config
+from ldm.flat_ckpt import load_checkpoint, load_state_dict_mmap
 import torch
 import os
 # todo ?
@@ -39,11 +40,9 @@ def download_models(mode):
 
 def load_model_from_config(config, ckpt):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    global_step = pl_sd["global_step"]
-    sd = pl_sd["state_dict"]
+    sd, global_step = load_checkpoint(ckpt)
     model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    m, u = load_state_dict_mmap(model, sd)
     model.cuda()
     model.eval()
     return {"model": model}, global_step
@@ -0,0 +1,95 @@
+"""Compare the default CPU path of the UNet and VAE decoder against the CPU
+inference mode (fused GroupNorm+SiLU, channels_last, bf16 autocast).
+
+Weights are random, so no checkpoint is needed; only speed and the deviation
+between the two paths are measured.
+"""
+import argparse
+import copy
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.modules.diffusionmodules.model import Decoder
+from ldm.modules.diffusionmodules.util import prepare_cpu_inference
+
+
+def timeit(fn, iters, warmup=1):
+    for _ in range(warmup):
+        out = fn()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        out = fn()
+    return (time.perf_counter() - t0) / iters, out
+
+
+def rel_err(a, b):
+    a, b = a.float(), b.float()
+    return ((a - b).norm() / b.norm()).item()
+
+
+def bench(name, module, inputs, iters, bf16):
+    baseline = lambda: module(*inputs)
+    fast_module = prepare_cpu_inference(copy.deepcopy(module))
+
+    def fast():
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+            return fast_module(*inputs)
+
+    t_base, ref = timeit(baseline, iters)
+    t_fast, out = timeit(fast, iters)
+    print(f"{name:8s} default {t_base:7.3f}s  cpu mode {t_fast:7.3f}s  "
+          f"speedup {t_base / t_fast:5.2f}x  rel. error {rel_err(out, ref):.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="model config, the unet and first stage configs are used")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--batch_size", type=int, default=2,
+                        help="UNet batch size (2 = one sample with classifier-free guidance)")
+    parser.add_argument("--iters", type=int, default=3, help="timed iterations per configuration")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (0: torch default)")
+    parser.add_argument("--no_bf16", action="store_true", help="keep the cpu mode in float32")
+    parser.add_argument("--skip_vae", action="store_true", help="only benchmark the UNet")
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(0)
+    config = OmegaConf.load(opt.config)
+    params = config.model.params
+    h, w = opt.H // opt.f, opt.W // opt.f
+    print(f"{torch.get_num_threads()} threads, {opt.H}x{opt.W} pixels, latent {h}x{w}")
+
+    with torch.no_grad():
+        unet_config = copy.deepcopy(params.unet_config)
+        unet_config.params.use_checkpoint = False
+        unet = instantiate_from_config(unet_config).eval()
+        for p in unet.parameters():
+            # zero-initialised output layers would make every output 0
+            if p.dim() > 1 and not p.any():
+                torch.nn.init.normal_(p, std=0.02)
+        x = torch.randn(opt.batch_size, unet.in_channels, h, w)
+        t = torch.full((opt.batch_size,), 500, dtype=torch.long)
+        inputs = (x, t)
+        context_dim = unet_config.params.get("context_dim")
+        if context_dim is not None:
+            inputs = inputs + (torch.randn(opt.batch_size, 77, context_dim),)
+        bench("unet", unet, inputs, opt.iters, not opt.no_bf16)
+        del unet
+
+        if not opt.skip_vae:
+            ddconfig = params.first_stage_config.params.ddconfig
+            decoder = Decoder(**ddconfig).eval()
+            z = torch.randn(1, ddconfig.z_channels, h, w)
+            bench("decoder", decoder, (z,), opt.iters, not opt.no_bf16)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Speed and quality of cross-timestep UNet feature caching (DeepCache).
+
+A prompt is sampled from a fixed start code once without caching and once per
+refresh interval; the sampling time, the number of full UNet steps and the
+PSNR of the decoded image against the uncached one are reported.
+"""
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from ldm.flat_ckpt import load_model_for_role
+from ldm.placement import DevicePlacement
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.modules.diffusionmodules.openaimodel import enable_feature_cache
+
+
+def psnr(a, b):
+    mse = torch.mean((a.float() - b.float()) ** 2)
+    return (10 * torch.log10(1. / mse)).item()
+
+
+def make_sampler(name, model):
+    if name == "plms":
+        from ldm.models.diffusion.plms import PLMSSampler
+        return PLMSSampler(model)
+    if name == "enc_plms":
+        from ldm.models.diffusion.enc_plms import ENC_PLMSSampler
+        return ENC_PLMSSampler(model)
+    return DDIMSampler(model)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, required=True, help="path to checkpoint of model")
+    parser.add_argument("--device", type=str, default="cpu", help="device for all stages or per stage")
+    parser.add_argument("--sampler", type=str, default="ddim", choices=["ddim", "plms", "enc_plms"])
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 5],
+                        help="refresh intervals to compare against no caching")
+    parser.add_argument("--branch", type=int, default=0,
+                        help="number of extra shallow UNet blocks recomputed on the cached steps")
+    parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse")
+    parser.add_argument("--steps", type=int, default=50, help="number of sampling steps")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the start code")
+    opt = parser.parse_args()
+
+    config = OmegaConf.load(opt.config)
+    model = DevicePlacement.from_string(opt.device).apply(load_model_for_role(config, opt.ckpt))
+    unet = model.model.diffusion_model
+    sampler = make_sampler(opt.sampler, model)
+    shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
+    start_code = torch.randn([1] + shape, generator=torch.Generator().manual_seed(opt.seed))
+
+    with torch.no_grad():
+        c, uc = model.get_learned_conditioning([opt.prompt]), model.get_learned_conditioning([""])
+        print(f"{opt.sampler} {opt.steps} steps, branch {opt.branch}, PSNR against no caching")
+        ref = None
+        for interval in [1] + opt.intervals:
+            enable_feature_cache(unet, interval, opt.branch)
+            torch.manual_seed(opt.seed)
+            t0 = time.perf_counter()
+            samples, _ = sampler.sample(S=opt.steps, conditioning=c, batch_size=1, shape=shape,
+                                        verbose=False, unconditional_guidance_scale=opt.scale,
+                                        unconditional_conditioning=uc, eta=0., x_T=start_code)
+            dt = time.perf_counter() - t0
+            img = torch.clamp((model.decode_first_stage(samples).cpu() + 1.) / 2., 0., 1.)
+            full = (opt.steps + interval - 1) // interval
+            if ref is None:
+                ref, t_ref = img, dt
+                print(f"  interval {interval:2d}  {full:3d} full steps  {dt:7.1f}s")
+            else:
+                print(f"  interval {interval:2d}  {full:3d} full steps  {dt:7.1f}s  "
+                      f"speedup {t_ref / dt:5.2f}x  PSNR {psnr(img, ref):.2f} dB")
+        enable_feature_cache(unet, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Offline end-to-end benchmark of the encrypted txt2img pipeline.
+
+Builds the scaled-down model of configs/stable-diffusion/enc-tiny-bench.yaml
+with random weights (no checkpoint, no CLIP or safety checker download) and
+runs conditioning, the encrypted PLMS sampler with a real TenSEAL context and
+the VAE decode on CPU. Reports steps/s, the time per phase (remove_points
+split, encryption, UNet, HE update, rest of the sampler, conditioning, decode)
+and memory. With --out the results are saved as JSON, with --baseline they
+are compared against an earlier JSON and the script exits with status 1 if
+throughput dropped by more than --tolerance or the output latent changed, so
+regressions in enc_plms.py, coo_sparse.py and distortion.py show up locally.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.models.diffusion.enc_plms import ENC_PLMSSampler
+from ldm.enc_conditioning import ConditioningClient
+from ldm.he_accounting import peak_rss
+
+
+def build_model(config, seed):
+    torch.manual_seed(seed)
+    model = instantiate_from_config(config.model)
+    # zero-initialised output layers (zero_module) would make the random UNet predict no noise at all
+    with torch.no_grad():
+        for param in model.parameters():
+            if param.dim() > 1 and not param.any():
+                param.normal_(std=0.05)
+    return model.cpu().eval()
+
+
+def run(model, sampler, opt, client=None):
+    shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
+    prompts = opt.n_samples * [opt.prompt]
+    t0 = time.perf_counter()
+    c = model.get_learned_conditioning(prompts)
+    if client is not None:
+        c = client.encrypt(c)
+    uc = model.get_learned_conditioning(opt.n_samples * [""])
+    t1 = time.perf_counter()
+    samples, _ = sampler.sample(S=opt.steps, conditioning=c, batch_size=opt.n_samples, shape=shape, verbose=False,
+                                unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc, eta=0.,
+                                threshold=opt.threshold, seed=opt.seed)
+    t2 = time.perf_counter()
+    model.decode_first_stage(samples)
+    t3 = time.perf_counter()
+
+    stats = sampler.step_stats
+    phases = dict(cond=t1 - t0, decode=t3 - t2)
+    for phase in ["split", "encrypt", "model", "he"]:
+        phases[phase] = sum(s[f"{phase}_time"] for s in stats)
+    # context and key generation, decryption of the result, bookkeeping
+    phases["sampler_other"] = (t2 - t1) - sum(phases[p] for p in ["split", "encrypt", "model", "he"])
+    return dict(steps_per_s=len(stats) / (t2 - t1),
+                sample_time=t2 - t1,
+                phases=phases,
+                encrypted_per_step=float(np.mean([s["encrypted"] for s in stats])),
+                ciphertext_mb=max(s["ciphertext_bytes"] for s in stats) / 2 ** 20,
+                # HEAccounting restarts the peak RSS at every step
+                peak_rss_mb=max([s["peak_rss"] for s in stats] + [peak_rss()]) / 2 ** 20,
+                latent_mean=samples.abs().mean().item())
+
+
+def compare(result, baseline, tolerance):
+    ok = True
+    ratio = result["steps_per_s"] / baseline["steps_per_s"]
+    print(f"steps/s {result['steps_per_s']:.3f} against baseline {baseline['steps_per_s']:.3f} ({ratio:.2f}x)")
+    if ratio < 1. - tolerance:
+        print(f"REGRESSION: throughput dropped by more than {tolerance:.0%}")
+        ok = False
+    for phase, t in result["phases"].items():
+        base = baseline["phases"].get(phase)
+        if base:
+            print(f"  {phase:14s} {t:8.3f}s  baseline {base:8.3f}s  ({t / base:.2f}x)")
+    # CKKS noise moves the latent by ~1e-3, a changed computation by much more
+    drift = abs(result["latent_mean"] - baseline["latent_mean"]) / max(abs(baseline["latent_mean"]), 1e-12)
+    if drift > 1e-2:
+        print(f"REGRESSION: output latent moved by {drift:.2%} (mean |x| {result['latent_mean']:.5f} "
+              f"against {baseline['latent_mean']:.5f})")
+        ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/enc-tiny-bench.yaml",
+                        help="path to config which constructs the (random weight) model")
+    parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse")
+    parser.add_argument("--steps", type=int, default=10, help="number of PLMS steps")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--threshold", type=float, default=0.01, help="remove_points threshold")
+    parser.add_argument("--prompt_transport_encryption", action="store_true",
+                        help="also encrypt the prompt embedding in transit; it is decrypted once per job for the "
+                             "plaintext UNet (see ldm/enc_conditioning.py)")
+    parser.add_argument("--n_samples", type=int, default=1, help="batch size")
+    parser.add_argument("--H", type=int, default=128, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=128, help="image width, in pixel space")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--runs", type=int, default=3, help="timed runs")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before")
+    parser.add_argument("--threads", type=int, default=None, help="torch and TenSEAL threads (default: all)")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the weights and the sampling noise")
+    parser.add_argument("--out", type=str, default=None, help="save the results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative drop in steps/s")
+    opt = parser.parse_args()
+
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    config = OmegaConf.load(opt.config)
+    model = build_model(config, opt.seed)
+    sampler = ENC_PLMSSampler(model, he_threads=opt.threads)
+    client = ConditioningClient() if opt.prompt_transport_encryption else None
+
+    with torch.no_grad():
+        for _ in range(opt.warmup):
+            run(model, sampler, opt, client)
+        runs = [run(model, sampler, opt, client) for _ in range(opt.runs)]
+
+    result = dict(config=opt.config, steps=opt.steps, H=opt.H, W=opt.W, n_samples=opt.n_samples,
+                  threshold=opt.threshold, prompt_transport_encryption=opt.prompt_transport_encryption, runs=opt.runs,
+                  steps_per_s=float(np.median([r["steps_per_s"] for r in runs])),
+                  phases={p: float(np.median([r["phases"][p] for r in runs])) for p in runs[0]["phases"]},
+                  encrypted_per_step=runs[0]["encrypted_per_step"],
+                  ciphertext_mb=runs[0]["ciphertext_mb"],
+                  peak_rss_mb=max(r["peak_rss_mb"] for r in runs),
+                  latent_mean=float(np.median([r["latent_mean"] for r in runs])))
+
+    print(f"{result['steps_per_s']:.3f} steps/s, {result['encrypted_per_step']:.0f} encrypted elements per step, "
+          f"{result['ciphertext_mb']:.1f} MB ciphertexts, peak RSS {result['peak_rss_mb']:.0f} MB")
+    print("| phase | seconds per run |\n|---|---|")
+    for phase, t in result["phases"].items():
+        print(f"| {phase} | {t:.3f} |")
+
+    if opt.out is not None:
+        with open(opt.out, "w") as f:
+            json.dump(result, f, indent=1)
+        print(f"Saved results to {opt.out}")
+    if opt.baseline is not None:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        if not compare(result, baseline, opt.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Recall and QPS of the NumPy IVF-PQ index against brute force search.
+
+Indexes the embedding store of a retrieval database (--database) or a
+synthetic pool of clustered unit vectors (--synthetic N) with build_index of
+ldm/modules/ivfpq.py, the fallback train_searcher.py uses without scann, and
+searches perturbed database vectors as queries. Reports recall@k against
+exact brute force search and queries per second for every combination of
+--leaves_to_search and --reorder_k, so the accuracy / speed trade-off of the
+pool-size heuristics can be checked on the machine that will run knn2img.py.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from ldm.data.embedding_store import EmbeddingStore
+from ldm.modules.ivfpq import BruteForceIndex, IVFPQIndex, build_index
+
+
+def synthetic_pool(n, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    x = (centers[rng.integers(clusters, size=n)] + 0.5 * rng.standard_normal((n, dim))).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def make_queries(embeddings, n, noise, seed):
+    rng = np.random.default_rng(seed + 1)
+    rows = np.sort(rng.choice(len(embeddings), n, replace=False))
+    q = np.asarray(embeddings[rows], dtype=np.float32)
+    q = q + noise * rng.standard_normal(q.shape).astype(np.float32) / np.sqrt(q.shape[1])
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def timed_search(index, queries, k, batch_size, **kwargs):
+    nns = []
+    start = time.perf_counter()
+    for s in range(0, len(queries), batch_size):
+        nns.append(index.search_batched(queries[s:s + batch_size], final_num_neighbors=k, **kwargs)[0])
+    return np.concatenate(nns), len(queries) / (time.perf_counter() - start)
+
+
+def recall(nns, truth):
+    return float(np.mean([len(np.intersect1d(a, b)) / len(b) for a, b in zip(nns, truth)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", type=str, default=None,
+                        help="retrieval database directory, its embedding store is built if missing")
+    parser.add_argument("--synthetic", type=int, default=200000, help="size of the synthetic pool without --database")
+    parser.add_argument("--dim", type=int, default=768, help="dimension of the synthetic pool")
+    parser.add_argument("--clusters", type=int, default=1000, help="clusters in the synthetic pool")
+    parser.add_argument("--knn", "-k", type=int, default=20, help="number of neighbours")
+    parser.add_argument("--queries", type=int, default=1000, help="number of queries")
+    parser.add_argument("--noise", type=float, default=0.5, help="norm of the noise added to the query vectors")
+    parser.add_argument("--batch_size", type=int, default=16, help="queries per search_batched call")
+    parser.add_argument("--leaves_to_search", type=int, nargs="*", default=None,
+                        help="lists to probe (default: the heuristic value)")
+    parser.add_argument("--reorder_k", type=int, nargs="*", default=None,
+                        help="candidates to rescore exactly (default: 2 * k)")
+    parser.add_argument("--dims_per_block", type=int, default=4, help="dimensions per product quantization block")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None, help="save the results as JSON")
+    opt = parser.parse_args()
+
+    if opt.database is not None:
+        embeddings = EmbeddingStore.open_or_build(opt.database).normalized_embeddings()
+    else:
+        embeddings = synthetic_pool(opt.synthetic, opt.dim, opt.clusters, opt.seed)
+    queries = make_queries(embeddings, opt.queries, opt.noise, opt.seed)
+    print(f"Pool of {embeddings.shape[0]} x {embeddings.shape[1]}, {len(queries)} queries, k = {opt.knn}")
+
+    brute_force = BruteForceIndex(embeddings)
+    truth, brute_qps = timed_search(brute_force, queries, opt.knn, opt.batch_size)
+    print(f"brute force: {brute_qps:.1f} QPS")
+
+    start = time.perf_counter()
+    index = build_index(embeddings, opt.knn, dims_per_block=opt.dims_per_block, seed=opt.seed)
+    build_time = time.perf_counter() - start
+    results = dict(pool_size=int(embeddings.shape[0]), dim=int(embeddings.shape[1]), k=opt.knn,
+                   queries=len(queries), brute_force_qps=brute_qps, build_time=build_time, runs=[])
+    if not isinstance(index, IVFPQIndex):
+        print("The pool is small enough for brute force search, nothing to compare.")
+    else:
+        results["index_mb"] = (index.codes.nbytes + index.ids.nbytes + index.centroids.nbytes
+                               + index.codebooks.nbytes) / 2 ** 20
+        print(f"IVF-PQ index: {index.nlist} lists, {len(index.codebooks)} subspaces, built in {build_time:.1f}s, "
+              f"{results['index_mb']:.1f} MB")
+        print("| lists searched | reorder_k | recall@k | QPS | speedup |\n|---|---|---|---|---|")
+        for nprobe in opt.leaves_to_search or [index.nprobe]:
+            for reorder_k in opt.reorder_k or [index.reorder_k]:
+                nns, qps = timed_search(index, queries, opt.knn, opt.batch_size, leaves_to_search=nprobe,
+                                        pre_reorder_num_neighbors=reorder_k)
+                run = dict(leaves_to_search=nprobe, reorder_k=reorder_k, recall=recall(nns, truth), qps=qps)
+                results["runs"].append(run)
+                print(f"| {nprobe} | {reorder_k} | {run['recall']:.3f} | {qps:.1f} | {qps / brute_qps:.2f}x |")
+
+    if opt.out is not None:
+        with open(opt.out, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"Saved results to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
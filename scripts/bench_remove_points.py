@@ -0,0 +1,160 @@
+"""Privacy / latency trade-off of the remove_points threshold.
+
+For every threshold and seed the encrypted sampler (ENC_PLMS) is run from the
+same start code as the plaintext PLMSSampler and compared against it:
+encrypted latent elements per step, HE time per step (encryption + encrypted
+update + decryption), total wall time, cosine similarity of the final latents
+and PSNR / SSIM of the decoded images. Results are written as CSV and a
+markdown table to --outdir, with a plot of the trade-off if matplotlib is
+installed.
+"""
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+from ldm.flat_ckpt import load_model_for_role
+from ldm.placement import DevicePlacement
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.enc_plms import ENC_PLMSSampler
+
+
+def psnr(a, b):
+    mse = torch.mean((a.float() - b.float()) ** 2)
+    return (10 * torch.log10(1. / mse)).item()
+
+
+def ssim(a, b, window_size=11, sigma=1.5):
+    """Mean SSIM of (N, C, H, W) images in [0, 1] with a gaussian window."""
+    a, b = a.float(), b.float()
+    coords = torch.arange(window_size, dtype=torch.float32) - window_size // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    window = (g[:, None] * g[None, :]).expand(a.shape[1], 1, window_size, window_size).contiguous()
+    blur = lambda x: F.conv2d(x, window, padding=window_size // 2, groups=a.shape[1])
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    s = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return s.mean().item()
+
+
+def cosine(a, b):
+    return F.cosine_similarity(a.flatten().float(), b.flatten().float(), dim=0).item()
+
+
+def write_table(rows, outdir):
+    keys = list(rows[0].keys())
+    with open(os.path.join(outdir, "remove_points.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=keys)
+        writer.writeheader()
+        writer.writerows(rows)
+    fmt = lambda v: f"{v:.4g}" if isinstance(v, float) else str(v)
+    lines = ["| " + " | ".join(keys) + " |", "|" + "---|" * len(keys)]
+    lines += ["| " + " | ".join(fmt(row[k]) for k in keys) + " |" for row in rows]
+    with open(os.path.join(outdir, "remove_points.md"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+
+
+def plot(rows, outdir):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib not installed, skipping the plot")
+        return
+    fig, axes = plt.subplots(1, 2, figsize=(11, 4))
+    for ax, (y, label) in zip(axes, [("psnr", "PSNR against plaintext [dB]"), ("ssim", "SSIM against plaintext")]):
+        x = [row["encrypted_frac"] for row in rows]
+        ax.scatter(x, [row[y] for row in rows], c=[row["he_time_per_step"] for row in rows], cmap="viridis")
+        for row in rows:
+            ax.annotate(f"{row['threshold']:g}", (row["encrypted_frac"], row[y]), fontsize=7)
+        ax.set_xlabel("encrypted fraction of the latent")
+        ax.set_ylabel(label)
+    axes[1].figure.colorbar(axes[1].collections[0], ax=axes, label="HE time per step [s]")
+    path = os.path.join(outdir, "remove_points.png")
+    fig.savefig(path, dpi=150)
+    print(f"Saved plot to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, required=True, help="path to checkpoint of model")
+    parser.add_argument("--device", type=str, default="cpu", help="device for all stages or per stage")
+    parser.add_argument("--outdir", type=str, default="outputs/remove_points", help="where to write the results")
+    parser.add_argument("--thresholds", type=float, nargs="+",
+                        default=[0.005, 0.01, 0.05, 0.1, 0.2, 0.5, 0.9, 0.99],
+                        help="remove_points thresholds to sweep")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[42], help="seeds of the start codes")
+    parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse")
+    parser.add_argument("--steps", type=int, default=50, help="number of PLMS steps")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    opt = parser.parse_args()
+
+    os.makedirs(opt.outdir, exist_ok=True)
+    config = OmegaConf.load(opt.config)
+    model = DevicePlacement.from_string(opt.device).apply(load_model_for_role(config, opt.ckpt))
+    shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
+    plain, enc = PLMSSampler(model), ENC_PLMSSampler(model)
+
+    def decode(samples):
+        return torch.clamp((model.decode_first_stage(samples).cpu() + 1.) / 2., 0., 1.)
+
+    with torch.no_grad():
+        c, uc = model.get_learned_conditioning([opt.prompt]), model.get_learned_conditioning([""])
+        kwargs = dict(S=opt.steps, conditioning=c, batch_size=1, shape=shape, verbose=False,
+                      unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc, eta=0.)
+        references = dict()
+        for seed in opt.seeds:
+            x_T = torch.randn([1] + shape, generator=torch.Generator().manual_seed(seed))
+            t0 = time.perf_counter()
+            samples, _ = plain.sample(x_T=x_T, **kwargs)
+            references[seed] = (x_T, samples.cpu(), decode(samples), time.perf_counter() - t0)
+
+        rows = []
+        for threshold in opt.thresholds:
+            per_seed = []
+            for seed in opt.seeds:
+                x_T, ref_latent, ref_img, plain_time = references[seed]
+                torch.manual_seed(seed)
+                t0 = time.perf_counter()
+                samples, _ = enc.sample(x_T=x_T, threshold=threshold, **kwargs)
+                wall = time.perf_counter() - t0
+                img = decode(samples)
+                stats = enc.step_stats
+                per_seed.append(dict(
+                    encrypted_per_step=np.mean([s["encrypted"] for s in stats]),
+                    encrypted_frac=np.mean([s["encrypted"] / s["numel"] for s in stats]),
+                    he_time_per_step=np.mean([s["encrypt_time"] + s["he_time"] for s in stats]),
+                    wall_time=wall,
+                    plain_time=plain_time,
+                    cosine=cosine(samples.cpu(), ref_latent),
+                    psnr=psnr(img, ref_img),
+                    ssim=ssim(img, ref_img),
+                ))
+            row = dict(threshold=threshold)
+            row.update({k: float(np.mean([r[k] for r in per_seed])) for k in per_seed[0]})
+            rows.append(row)
+            print(f"threshold {threshold:g}: {row}")
+
+    write_table(rows, opt.outdir)
+    plot(rows, opt.outdir)
+
+
+if __name__ == "__main__":
+    main()
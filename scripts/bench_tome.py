@@ -0,0 +1,109 @@
+"""Speed and quality of token merging in the UNet's transformer blocks.
+
+For every ratio setting the UNet forward time is compared against no merging,
+together with the relative error of the predicted noise. With --ckpt a
+prompt is additionally sampled with DDIM from the same start code and the
+PSNR of the decoded image against the unmerged one is reported.
+"""
+import argparse
+import copy
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.flat_ckpt import load_model_for_role
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.modules.tome import apply_token_merging, parse_ratios
+
+
+def timeit(fn, iters):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        out = fn()
+    return (time.perf_counter() - t0) / iters, out
+
+
+def psnr(a, b):
+    mse = torch.mean((a.float() - b.float()) ** 2)
+    return (10 * torch.log10(1. / mse)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, default=None,
+                        help="checkpoint for the quality comparison (random UNet weights if omitted)")
+    parser.add_argument("--ratios", type=str, nargs="+", default=["1:0.5", "2:0.5", "1:0.5,2:0.5"],
+                        help="merge ratios per downsampling factor, ds 1 and 2 are the 64x64 and 32x32 levels at 512px")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--iters", type=int, default=3, help="timed UNet forwards per setting")
+    parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse",
+                        help="prompt for the quality comparison")
+    parser.add_argument("--ddim_steps", type=int, default=25, help="sampling steps for the quality comparison")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--seed", type=int, default=42, help="seed for inputs and start code")
+    opt = parser.parse_args()
+
+    config = OmegaConf.load(opt.config)
+    h, w = opt.H // opt.f, opt.W // opt.f
+    torch.manual_seed(opt.seed)
+    settings = [("none", dict())] + [(spec, parse_ratios(spec)) for spec in opt.ratios]
+
+    if opt.ckpt is not None:
+        model = load_model_for_role(config, opt.ckpt)
+        unet = model.model.diffusion_model
+        c = model.get_learned_conditioning(2 * [opt.prompt])
+    else:
+        model = None
+        unet_config = copy.deepcopy(config.model.params.unet_config)
+        unet = instantiate_from_config(unet_config).eval()
+        for p in unet.parameters():
+            # zero-initialised output layers would make every output 0
+            if p.dim() > 1 and not p.any():
+                torch.nn.init.normal_(p, std=0.02)
+        c = torch.randn(2, 77, unet_config.params.context_dim)
+    x = torch.randn(2, unet.in_channels, h, w)
+    t = torch.full((2,), 500, dtype=torch.long)
+
+    print(f"UNet forward at {h}x{w} latents, batch 2")
+    ref = None
+    with torch.no_grad():
+        for name, ratios in settings:
+            apply_token_merging(unet, ratios)
+            dt, out = timeit(lambda: unet(x, t, context=c), opt.iters)
+            if ref is None:
+                ref, t_ref = out, dt
+            err = ((out - ref).norm() / ref.norm()).item()
+            print(f"  ratios {name:14s} {dt:7.3f}s  speedup {t_ref / dt:5.2f}x  eps rel. error {err:.3e}")
+
+    if model is None:
+        return
+    print(f"DDIM {opt.ddim_steps} steps, PSNR against no merging")
+    sampler = DDIMSampler(model)
+    start_code = torch.randn(1, 4, h, w, generator=torch.Generator().manual_seed(opt.seed))
+    c, uc = model.get_learned_conditioning([opt.prompt]), model.get_learned_conditioning([""])
+    ref = None
+    with torch.no_grad():
+        for name, ratios in settings:
+            apply_token_merging(unet, ratios)
+            t0 = time.perf_counter()
+            samples, _ = sampler.sample(S=opt.ddim_steps, conditioning=c, batch_size=1, shape=[4, h, w],
+                                        verbose=False, unconditional_guidance_scale=opt.scale,
+                                        unconditional_conditioning=uc, eta=0., x_T=start_code)
+            img = torch.clamp((model.decode_first_stage(samples) + 1.) / 2., 0., 1.)
+            dt = time.perf_counter() - t0
+            if ref is None:
+                ref = img
+                print(f"  ratios {name:14s} {dt:7.1f}s")
+            else:
+                print(f"  ratios {name:14s} {dt:7.1f}s  PSNR {psnr(img, ref):.2f} dB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Fit a per-step remove_points threshold schedule for the encrypted sampler.
+
+The plaintext PLMSSampler is run on the calibration prompts and seeds, and for
+every step and every threshold of --grid the latent entering that step is put
+through remove_points: n is the number of elements that would be encrypted and
+d the distortion of the elements that stay in plaintext. The schedule picks one
+threshold per step so that the summed distortion stays within the target and
+the summed encrypted elements are minimal (a multiple-choice knapsack, solved
+by Lagrangian relaxation: every step takes argmin n + lambda * d, lambda is
+bisected until the distortion fits). By default the target is the distortion
+of the constant --match_constant threshold. The result is written as JSON for
+`enc_txt2img.py --threshold_schedule`.
+"""
+import argparse
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from ldm.flat_ckpt import load_model_for_role
+from ldm.placement import DevicePlacement
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.distortion import remove_points, count_zeros, revealed_distortion, ThresholdSchedule
+
+
+def measure(latents, grid):
+    """(steps, thresholds) arrays of encrypted elements and revealed distortion, summed over the batch."""
+    encrypted = np.zeros((len(latents), len(grid)))
+    distortion = np.zeros((len(latents), len(grid)))
+    for i, x in enumerate(latents):
+        x = x.cpu().float()
+        for j, threshold in enumerate(grid):
+            new_image = remove_points(x.clone(), threshold=threshold)
+            encrypted[i, j] = new_image.numel() - count_zeros(new_image)
+            distortion[i, j] = revealed_distortion(x, new_image)
+    return encrypted, distortion
+
+
+def fit(encrypted, distortion, target, iters=100):
+    """Per-step column choice minimizing the encrypted total with the distortion total <= target."""
+    steps = np.arange(encrypted.shape[0])
+
+    def choose(lam):
+        return np.argmin(encrypted + lam * distortion, axis=1)
+
+    lo, hi = -30., 30.
+    choice = choose(10 ** hi)
+    if distortion[steps, choice].sum() > target:
+        print(f"target {target:.4g} is below the smallest reachable distortion, using the least revealing schedule")
+        return choice
+    for _ in range(iters):
+        mid = (lo + hi) / 2
+        if distortion[steps, choose(10 ** mid)].sum() <= target:
+            hi = mid
+        else:
+            lo = mid
+    return choose(10 ** hi)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, required=True, help="path to checkpoint of model")
+    parser.add_argument("--device", type=str, default="cpu", help="device for all stages or per stage")
+    parser.add_argument("--out", type=str, default="outputs/threshold_schedule.json",
+                        help="where to write the schedule")
+    parser.add_argument("--prompts", type=str, nargs="+",
+                        default=["a photograph of an astronaut riding a horse", "a painting of a fox in the snow"],
+                        help="calibration prompts")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[42], help="seeds of the start codes")
+    parser.add_argument("--grid", type=float, nargs="+",
+                        default=[0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2],
+                        help="candidate thresholds per step")
+    parser.add_argument("--match_constant", type=float, default=0.01,
+                        help="target the total distortion of this constant threshold")
+    parser.add_argument("--target", type=float, default=None,
+                        help="total distortion target, overrides --match_constant")
+    parser.add_argument("--steps", type=int, default=50, help="number of PLMS steps")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    opt = parser.parse_args()
+
+    grid = sorted(set(opt.grid) | {opt.match_constant})
+    config = OmegaConf.load(opt.config)
+    model = DevicePlacement.from_string(opt.device).apply(load_model_for_role(config, opt.ckpt))
+    sampler = PLMSSampler(model)
+    shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
+
+    encrypted, distortion = 0., 0.
+    with torch.no_grad():
+        uc = model.get_learned_conditioning([""])
+        for prompt in opt.prompts:
+            c = model.get_learned_conditioning([prompt])
+            for seed in opt.seeds:
+                x_T = torch.randn([1] + shape, generator=torch.Generator().manual_seed(seed))
+                _, intermediates = sampler.sample(S=opt.steps, conditioning=c, batch_size=1, shape=shape,
+                                                  verbose=False, unconditional_guidance_scale=opt.scale,
+                                                  unconditional_conditioning=uc, eta=0., x_T=x_T, log_every_t=1)
+                # x_inter[i] is the latent that step i starts from, the one the encrypted sampler splits;
+                # the schedule may have a step more than --steps
+                total_steps = sampler.ddim_timesteps.shape[0]
+                n, d = measure(intermediates["x_inter"][:total_steps], grid)
+                encrypted += n
+                distortion += d
+                print(f"measured {prompt!r}, seed {seed}")
+
+    runs = len(opt.prompts) * len(opt.seeds)
+    encrypted, distortion = encrypted / runs, distortion / runs
+    constant = grid.index(opt.match_constant)
+    target = distortion[:, constant].sum() if opt.target is None else opt.target
+    choice = fit(encrypted, distortion, target)
+    steps = np.arange(total_steps)
+    if opt.target is None and encrypted[steps, choice].sum() > encrypted[:, constant].sum():
+        choice = np.full(total_steps, constant)
+
+    # alpha_t of step i, as ENC_PLMSSampler looks it up
+    alphas = sampler.ddim_alphas.cpu().numpy()[::-1]
+    schedule = ThresholdSchedule(alphas, [grid[j] for j in choice])
+    schedule.save(opt.out)
+
+    print("step  alpha_t   threshold  encrypted")
+    for i in range(total_steps):
+        print(f"{i:4d}  {alphas[i]:.5f}  {grid[choice[i]]:9g}  {encrypted[i, choice[i]]:9.0f}")
+    total, total_constant = encrypted[steps, choice].sum(), encrypted[:, constant].sum()
+    print(f"encrypted elements per run: schedule {total:.0f}, constant {opt.match_constant:g} {total_constant:.0f} "
+          f"({100 * (1 - total / max(total_constant, 1)):.1f}% fewer)")
+    print(f"revealed distortion per run: schedule {distortion[steps, choice].sum():.4g}, target {target:.4g}")
+    print(f"Saved schedule to {opt.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import argparse, os, sys
+
+# run from the repository root, before ldm is imported
+sys.path.append(os.getcwd())
+from ldm.flat_ckpt import convert_checkpoint
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ckpt",
+        type=str,
+        default="models/ldm/stable-diffusion-v1/model.ckpt",
+        help="path to the Lightning checkpoint to convert",
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="path of the flat checkpoint to write (default: next to --ckpt with a .flat suffix)",
+    )
+    parser.add_argument(
+        "--half",
+        action='store_true',
+        help="store floating point weights as float16",
+    )
+    parser.add_argument(
+        "--use_ema",
+        action='store_true',
+        help="replace the UNet weights by their EMA copies (for full, non EMA-only checkpoints)",
+    )
+    opt = parser.parse_args()
+
+    out = opt.out if opt.out is not None else os.path.splitext(opt.ckpt)[0] + ".flat"
+    convert_checkpoint(opt.ckpt, out, half=opt.half, use_ema=opt.use_ema)
@@ -15,6 +15,18 @@ from torch import autocast
 from contextlib import contextmanager, nullcontext
 
 from ldm.util import instantiate_from_config
+from ldm.flat_ckpt import load_checkpoint, load_state_dict_mmap
+from ldm.placement import DevicePlacement
+from ldm.enc_spool import CiphertextSpool
+from ldm.enc_conditioning import ConditioningClient
+from ldm.distortion import ThresholdSchedule
+from ldm.farm import SamplingFarm
+from ldm.modules.diffusionmodules.util import prepare_cpu_inference
+from ldm.modules.diffusionmodules.model import set_attn_chunk_size
+from ldm.modules.tome import apply_token_merging, parse_ratios
+from ldm.modules.quantization import load_quantized_unet
+from ldm.modules.diffusionmodules.openaimodel import enable_feature_cache
+from ldm.modules.encoders.embedding_cache import PromptEmbeddingCache, cond_model_id
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.enc_plms import ENC_PLMSSampler
 from ldm.models.diffusion.dpm_solver import DPMSolverSampler
@@ -49,12 +61,11 @@ def numpy_to_pil(images):
 
 def load_model_from_config(config, ckpt, verbose=False):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
+    sd, global_step = load_checkpoint(ckpt)
+    if global_step is not None:
+        print(f"Global Step: {global_step}")
     model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    m, u = load_state_dict_mmap(model, sd)
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -224,7 +235,7 @@ def main():
         "--seed",
         type=int,
         default=42,
-        help="the seed (for reproducible sampling)",
+        help="the seed (for reproducible sampling), job i (prompt chunk, iteration) is sampled with seed + i",
     )
     parser.add_argument(
         "--precision",
@@ -233,6 +244,134 @@ def main():
         choices=["full", "autocast"],
         default="autocast"
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="device for all stages (e.g. cpu) or per stage, e.g. cond=cuda,unet=cpu,vae=cpu",
+    )
+    parser.add_argument(
+        "--vae_attn_chunk",
+        type=int,
+        default=0,
+        help="compute the VAE attention in blocks of this many tokens so that it fits in fixed memory (0: default kernel)",
+    )
+    parser.add_argument(
+        "--tome_ratios",
+        type=str,
+        default="",
+        help="token merging ratio per UNet level as ds:ratio pairs, e.g. 1:0.5,2:0.3 (ds 1 is the 64x64 level at 512px)",
+    )
+    parser.add_argument(
+        "--deepcache_interval",
+        type=int,
+        default=1,
+        help="run the full UNet only every n-th step and reuse its deep features in between (1: off, "
+             "DDIM/PLMS/ENC_PLMS only)",
+    )
+    parser.add_argument(
+        "--deepcache_branch",
+        type=int,
+        default=0,
+        help="number of extra shallow UNet blocks recomputed on the cached steps (higher: slower, closer to full)",
+    )
+    parser.add_argument(
+        "--int8_unet",
+        type=str,
+        default=None,
+        help="quantized UNet artifact from scripts/quantize_unet.py (CPU only, runs in float32)",
+    )
+    parser.add_argument(
+        "--cpu_opt",
+        action='store_true',
+        help="CPU inference mode for the UNet and VAE decoder: fused GroupNorm+SiLU and channels_last "
+             "(combine with --precision autocast for bf16)",
+    )
+    parser.add_argument(
+        "--embedding_cache",
+        type=str,
+        default=None,
+        help="directory of an on-disk prompt embedding cache shared between runs (default: in-memory only)",
+    )
+    parser.add_argument(
+        "--prompt_transport_encryption",
+        action='store_true',
+        help="encrypt the prompt embedding in transit only: it is decrypted once per job and the UNet runs on it "
+             "in plaintext, so the server sees the prompt (--plms only, see ldm/enc_conditioning.py)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.01,
+        help="remove_points threshold: share of the distortion budget left in plaintext at every step (--plms only)",
+    )
+    parser.add_argument(
+        "--threshold_schedule",
+        type=str,
+        default=None,
+        help="JSON file with a per-step threshold schedule from scripts/calibrate_thresholds.py, "
+             "overrides --threshold",
+    )
+    parser.add_argument(
+        "--spool_dir",
+        type=str,
+        default=None,
+        help="spool the encrypted sampling state after every step to this directory (--plms only, holds the secret key)",
+    )
+    parser.add_argument(
+        "--resume",
+        action='store_true',
+        help="continue the runs spooled in --spool_dir from their last completed step",
+    )
+    parser.add_argument(
+        "--counter_rng",
+        action='store_true',
+        help="draw start codes and step noise per sample from (seed, sample number, step), so that results "
+             "do not depend on batching, farm workers or resuming (--plms only)",
+    )
+    parser.add_argument(
+        "--he_memory_cap",
+        type=float,
+        default=None,
+        help="fail before an encryption or after a step that would take the process over this many GB of RSS "
+             "(--plms only)",
+    )
+    parser.add_argument(
+        "--he_accounting",
+        action='store_true',
+        help="also report serialized sizes of the HE context keys and of the ciphertexts at every step",
+    )
+    parser.add_argument(
+        "--farm_workers",
+        type=int,
+        default=0,
+        help="run the (prompt chunk, iteration) jobs in this many forked worker processes sharing the model "
+             "weights, e.g. one per socket (CPU only, 0: sample in this process)",
+    )
+    parser.add_argument(
+        "--farm_threads",
+        type=int,
+        default=None,
+        help="torch and TenSEAL threads per farm worker (default: cores / workers)",
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=0,
+        help="decode the latents in tiles of this many latent pixels to bound VAE memory (0 disables tiling)",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="overlap between neighbouring VAE tiles in latent pixels, blended to hide seams",
+    )
+    parser.add_argument(
+        "--vae_tile_batch",
+        type=int,
+        default=4,
+        help="number of VAE tiles decoded together",
+    )
     opt = parser.parse_args()
 
     if opt.laion400m:
@@ -247,14 +386,50 @@ def main():
     config = OmegaConf.load(f"{opt.config}")
     model = load_model_from_config(config, f"{opt.ckpt}")
 
-    #device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    device = torch.device("cpu")
-    model = model.to(device)
+    placement = DevicePlacement.from_string(opt.device)
+    print(f"Placing model stages: {placement}")
+    model = placement.apply(model)
+    device = placement.unet
+
+    if opt.int8_unet:
+        assert device.type == "cpu", "the int8 UNet runs on CPU only"
+        load_quantized_unet(model.model.diffusion_model, opt.int8_unet)
+        # dynamically quantized layers take float32 activations
+        opt.precision = "full"
+
+    if opt.cpu_opt:
+        prepare_cpu_inference(model.model.diffusion_model)
+        prepare_cpu_inference(model.first_stage_model.decoder)
+
+    if opt.tome_ratios:
+        apply_token_merging(model.model.diffusion_model, parse_ratios(opt.tome_ratios))
+
+    if opt.deepcache_interval > 1:
+        assert not opt.dpm_solver, "--deepcache_interval needs a sampler that marks its steps (DDIM/PLMS/ENC_PLMS)"
+        enable_feature_cache(model.model.diffusion_model, opt.deepcache_interval, opt.deepcache_branch)
+
+    if opt.vae_attn_chunk > 0:
+        set_attn_chunk_size(model.first_stage_model, opt.vae_attn_chunk)
+
+    if opt.vae_tile_size > 0:
+        model.tiled_decode_params = dict(tile_size=opt.vae_tile_size, overlap=opt.vae_tile_overlap,
+                                         tile_batch=opt.vae_tile_batch)
+
+    embedding_cache = PromptEmbeddingCache(model, cond_model_id(config, opt.ckpt), cache_dir=opt.embedding_cache)
+
+    if opt.prompt_transport_encryption:
+        assert opt.plms, "--prompt_transport_encryption needs the encrypted PLMS sampler (--plms)"
+
+    threshold = opt.threshold
+    if opt.threshold_schedule is not None:
+        threshold = ThresholdSchedule.load(opt.threshold_schedule)
 
     if opt.dpm_solver:
         sampler = DPMSolverSampler(model)
     elif opt.plms:
-        sampler = ENC_PLMSSampler(model)
+        he_memory_cap = int(opt.he_memory_cap * 2 ** 30) if opt.he_memory_cap is not None else None
+        sampler = ENC_PLMSSampler(model, he_threads=opt.farm_threads if opt.farm_workers > 0 else None,
+                                  he_memory_cap=he_memory_cap, he_accounting=opt.he_accounting)
     else:
         sampler = DDIMSampler(model)
 
@@ -288,63 +463,77 @@ def main():
     if opt.fixed_code:
         start_code = torch.randn([opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f], device=device)
 
-    context = ts.context(
-                ts.SCHEME_TYPE.CKKS,
-                poly_modulus_degree=16384,
-                coeff_mod_bit_sizes=[60, 40, 40, 40, 40, 60]
-            )
-    context.generate_galois_keys()
-    context.global_scale = 2**40
+    def init_worker(rank):
+        # TenSEAL contexts are made per process, their thread pools do not survive a fork
+        return dict(conditioning_client=ConditioningClient() if opt.prompt_transport_encryption else None)
+
+    def sample_job(state, job):
+        index, prompts = job
+        # every job gets its own seed, so a job samples the same with or without the farm, whose
+        # workers run the jobs in any order
+        seed_everything(opt.seed + index)
+        c = embedding_cache.encode(prompts)
+        if state["conditioning_client"] is not None:
+            c = state["conditioning_client"].encrypt(c)
+        uc = None
+        if opt.scale != 1.0:
+            uc = embedding_cache.unconditional(len(prompts))
+        shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
+        spool = None
+        if opt.spool_dir is not None and opt.plms:
+            spool = CiphertextSpool(os.path.join(opt.spool_dir, f"job{index:05}"))
+        enc_kwargs = dict(threshold=threshold) if isinstance(sampler, ENC_PLMSSampler) else dict()
+        if spool is not None:
+            enc_kwargs.update(spool=spool, resume=opt.resume)
+        if opt.counter_rng and isinstance(sampler, ENC_PLMSSampler):
+            enc_kwargs.update(seed=opt.seed, sample_indices=range(index * opt.n_samples, (index + 1) * opt.n_samples))
+        samples_ddim, _ = sampler.sample(S=opt.ddim_steps,
+                                         conditioning=c,
+                                         batch_size=opt.n_samples,
+                                         shape=shape,
+                                         verbose=False,
+                                         unconditional_guidance_scale=opt.scale,
+                                         unconditional_conditioning=uc,
+                                         eta=opt.ddim_eta,
+                                         x_T=start_code,
+                                         **enc_kwargs)
+        if spool is not None:
+            spool.close()
+
+        x_samples_ddim = model.decode_first_stage(samples_ddim)
+        x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+        x_samples_ddim = x_samples_ddim.to(torch.float).cpu().permute(0, 2, 3, 1).numpy()
+
+        x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
+
+        return torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
+
+    # one job per prompt chunk and iteration, numbered like the spool directories
+    jobs = list(enumerate(list(prompts) for prompts in data for _ in range(opt.n_iter)))
+    farm = SamplingFarm(model, opt.farm_workers, opt.farm_threads) if opt.farm_workers > 0 else None
 
     precision_scope = autocast if opt.precision=="autocast" else nullcontext
     with torch.no_grad():
-        #with precision_scope("cuda"):
-        with precision_scope("cpu"):
+        with precision_scope(device.type):
             with model.ema_scope():
                 tic = time.time()
                 all_samples = list()
-                uc = None
-                    #enc_uc = ts.ckks_tensor(context, uc)
-                for prompts in tqdm(data, desc="data"):
-                    if isinstance(prompts, tuple):
-                        prompts = list(prompts)
-                    model = model.cuda()
-                    c = model.get_learned_conditioning(prompts).cpu()
-                    if opt.scale != 1.0:
-                        uc = model.get_learned_conditioning(batch_size * [""]).cpu()
-                    #enc_c = ts.ckks_tensor(context, c)
-                    model = model.cpu()
-                    for n in trange(opt.n_iter, desc="Sampling"):
-                        shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
-                        samples_ddim, _ = sampler.sample(S=opt.ddim_steps,
-                                                         conditioning=c,
-                                                         batch_size=opt.n_samples,
-                                                         shape=shape,
-                                                         verbose=False,
-                                                         unconditional_guidance_scale=opt.scale,
-                                                         unconditional_conditioning=uc,
-                                                         eta=opt.ddim_eta,
-                                                         x_T=start_code)
-
-                        #model = model.cuda()
-                        x_samples_ddim = model.decode_first_stage(samples_ddim)
-                        x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                        x_samples_ddim = x_samples_ddim.to(torch.float).cpu().permute(0, 2, 3, 1).numpy()
-
-                        x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
-
-                        x_checked_image_torch = torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
-
-                        if not opt.skip_save:
-                            for x_sample in x_checked_image_torch:
-                                x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                                img = Image.fromarray(x_sample.astype(np.uint8))
-                                img = put_watermark(img, wm_encoder)
-                                img.save(os.path.join(sample_path, f"{base_count:05}.png"))
-                                base_count += 1
-
-                        if not opt.skip_grid:
-                            all_samples.append(x_checked_image_torch)
+                if farm is not None:
+                    results = farm.run(sample_job, jobs, init_worker)
+                else:
+                    state = init_worker(0)
+                    results = ((job, sample_job(state, job)) for job in jobs)
+                for job, x_checked_image_torch in tqdm(results, desc="Sampling", total=len(jobs)):
+                    if not opt.skip_save:
+                        for x_sample in x_checked_image_torch:
+                            x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
+                            img = Image.fromarray(x_sample.astype(np.uint8))
+                            img = put_watermark(img, wm_encoder)
+                            img.save(os.path.join(sample_path, f"{base_count:05}.png"))
+                            base_count += 1
+
+                    if not opt.skip_grid:
+                        all_samples.append(x_checked_image_torch)
 
                 if not opt.skip_grid:
                     # additionally, save as grid
@@ -362,6 +551,7 @@ def main():
                 toc = time.time()
 
     print(f"whole time cost: {toc - tic}s")
+    print(embedding_cache.stats())
     print(f"Your samples are ready and waiting for you here: \n{outpath} \n"
           f" \nEnjoy.")
 
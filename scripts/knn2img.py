@@ -9,15 +9,21 @@ from tqdm import tqdm, trange
 from itertools import islice
 from einops import rearrange, repeat
 from torchvision.utils import make_grid
-import scann
 import time
 from multiprocessing import cpu_count
 
-from ldm.util import instantiate_from_config, parallel_data_prefetch
+from ldm.util import instantiate_from_config
+from ldm.data.embedding_store import EmbeddingStore
+from ldm.modules.ivfpq import BruteForceIndex, is_index, load_index
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.modules.encoders.modules import FrozenClipImageEmbedder, FrozenCLIPTextEmbedder
 
+try:
+    import scann
+except ImportError:
+    scann = None
+
 DATABASES = [
     "openimages",
     "artbench-art_nouveau",
@@ -66,9 +72,7 @@ class Searcher(object):
         self.searcher_savedir = f'data/rdm/searchers/{self.database_name}'
         self.database_path = f'data/rdm/retrieval_databases/{self.database_name}'
         self.retriever = self.load_retriever(version=retriever_version)
-        self.database = {'embedding': [],
-                         'img_id': [],
-                         'patch_coords': []}
+        self.store = None
         self.load_database()
         self.load_searcher()
 
@@ -77,10 +81,11 @@ class Searcher(object):
                        searcher_savedir=None):
 
         print('Start training searcher')
-        searcher = scann.scann_ops_pybind.builder(self.database['embedding'] /
-                                                  np.linalg.norm(self.database['embedding'], axis=1)[:, np.newaxis],
-                                                  k, metric)
-        self.searcher = searcher.score_brute_force().build()
+        if scann is not None:
+            searcher = scann.scann_ops_pybind.builder(self.store.normalized_embeddings(), k, metric)
+            self.searcher = searcher.score_brute_force().build()
+        else:
+            self.searcher = BruteForceIndex(self.store.normalized_embeddings())
         print('Finish training searcher')
 
         if searcher_savedir is not None:
@@ -88,37 +93,13 @@ class Searcher(object):
             os.makedirs(searcher_savedir, exist_ok=True)
             self.searcher.serialize(searcher_savedir)
 
-    def load_single_file(self, saved_embeddings):
-        compressed = np.load(saved_embeddings)
-        self.database = {key: compressed[key] for key in compressed.files}
-        print('Finished loading of clip embeddings.')
-
-    def load_multi_files(self, data_archive):
-        out_data = {key: [] for key in self.database}
-        for d in tqdm(data_archive, desc=f'Loading datapool from {len(data_archive)} individual files.'):
-            for key in d.files:
-                out_data[key].append(d[key])
-
-        return out_data
-
     def load_database(self):
 
         print(f'Load saved patch embedding from "{self.database_path}"')
-        file_content = glob.glob(os.path.join(self.database_path, '*.npz'))
+        # memory-mapped, built from the npz-files on first use
+        self.store = EmbeddingStore.open_or_build(self.database_path)
 
-        if len(file_content) == 1:
-            self.load_single_file(file_content[0])
-        elif len(file_content) > 1:
-            data = [np.load(f) for f in file_content]
-            prefetched_data = parallel_data_prefetch(self.load_multi_files, data,
-                                                     n_proc=min(len(data), cpu_count()), target_data_type='dict')
-
-            self.database = {key: np.concatenate([od[key] for od in prefetched_data], axis=1)[0] for key in
-                             self.database}
-        else:
-            raise ValueError(f'No npz-files in specified path "{self.database_path}" is this directory existing?')
-
-        print(f'Finished loading of retrieval database of length {self.database["embedding"].shape[0]}.')
+        print(f'Finished loading of retrieval database of length {len(self.store)}.')
 
     def load_retriever(self, version='ViT-L/14', ):
         model = FrozenClipImageEmbedder(model=version)
@@ -129,13 +110,22 @@ class Searcher(object):
 
     def load_searcher(self):
         print(f'load searcher for database {self.database_name} from {self.searcher_savedir}')
-        self.searcher = scann.scann_ops_pybind.load_searcher(self.searcher_savedir)
+        if is_index(self.searcher_savedir):
+            # trained with train_searcher.py --backend ivfpq, reorders against the store
+            self.searcher = load_index(self.searcher_savedir, self.store.normalized_embeddings())
+        elif scann is not None:
+            self.searcher = scann.scann_ops_pybind.load_searcher(self.searcher_savedir)
+        else:
+            # search() fits a brute force searcher for small databases
+            print(f'No IVF-PQ index in {self.searcher_savedir} and scann is not installed.')
+            self.searcher = None
+            return
         print('Finished loading searcher.')
 
     def search(self, x, k):
-        if self.searcher is None and self.database['embedding'].shape[0] < 2e4:
+        if self.searcher is None and len(self.store) < 2e4:
             self.train_searcher(k)   # quickly fit searcher on the fly for small databases
-        assert self.searcher is not None, 'Cannot search with uninitialized searcher'
+        assert self.searcher is not None, 'Cannot search with uninitialized searcher, train one with scripts/train_searcher.py'
         if isinstance(x, torch.Tensor):
             x = x.detach().cpu().numpy()
         if len(x.shape) == 3:
@@ -146,9 +136,9 @@ class Searcher(object):
         nns, distances = self.searcher.search_batched(query_embeddings, final_num_neighbors=k)
         end = time.time()
 
-        out_embeddings = self.database['embedding'][nns]
-        out_img_ids = self.database['img_id'][nns]
-        out_pc = self.database['patch_coords'][nns]
+        out_embeddings = self.store.take('embedding', nns)
+        out_img_ids = self.store.take('img_id', nns)
+        out_pc = self.store.take('patch_coords', nns)
 
         out = {'nn_embeddings': out_embeddings / np.linalg.norm(out_embeddings, axis=-1)[..., np.newaxis],
                'img_ids': out_img_ids,
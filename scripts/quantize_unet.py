@@ -0,0 +1,119 @@
+"""Build the int8 CPU UNet artifact and report its throughput and fidelity.
+
+The convolutions are calibrated with a few DDIM steps on the calibration
+prompts (the ones whose output error exceeds --max_conv_error stay float32),
+the attention / feed-forward Linear layers are dynamically quantized, and the
+result is saved to --out for `enc_txt2img.py --int8_unet`. The report compares
+artifact size, UNet forward time and predicted noise against the fp32 UNet,
+and the PSNR of a sampled image. Only the Linear layers compute in int8; the
+int8 convolutions are a size saving and run at fp32 speed.
+"""
+import argparse
+import copy
+import os
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from ldm.flat_ckpt import load_model_for_role
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.modules.quantization import calibrate_convs, quantize_unet, save_quantized_unet
+
+
+def timeit(fn, iters):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        out = fn()
+    return (time.perf_counter() - t0) / iters, out
+
+
+def psnr(a, b):
+    mse = torch.mean((a.float() - b.float()) ** 2)
+    return (10 * torch.log10(1. / mse)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, required=True, help="path to checkpoint of model")
+    parser.add_argument("--out", type=str, default="models/ldm/stable-diffusion-v1/unet-int8.pt",
+                        help="where to save the quantized UNet")
+    parser.add_argument("--calib_prompts", type=str, nargs="+",
+                        default=["a photograph of an astronaut riding a horse", "a painting of a fox in the snow",
+                                 "a close up portrait of an old man"],
+                        help="prompts to calibrate the convolutions on")
+    parser.add_argument("--calib_steps", type=int, default=5, help="DDIM steps per calibration prompt")
+    parser.add_argument("--max_conv_error", type=float, default=0.01,
+                        help="convolutions whose relative output error exceeds this stay float32")
+    parser.add_argument("--prompt", type=str, default="a photograph of an astronaut riding a horse",
+                        help="prompt for the fidelity report")
+    parser.add_argument("--ddim_steps", type=int, default=25, help="sampling steps for the fidelity report")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--iters", type=int, default=3, help="timed UNet forwards per model")
+    parser.add_argument("--seed", type=int, default=42, help="seed for inputs and start code")
+    parser.add_argument("--skip_report", action="store_true", help="only build and save the artifact")
+    opt = parser.parse_args()
+
+    config = OmegaConf.load(opt.config)
+    model = load_model_for_role(config, opt.ckpt).cpu()
+    fp32_unet = model.model.diffusion_model
+    unet = copy.deepcopy(fp32_unet)
+    shape = [4, opt.H // opt.f, opt.W // opt.f]
+    sampler = DDIMSampler(model)
+
+    def sample(prompt, steps, x_T=None):
+        c, uc = model.get_learned_conditioning([prompt]), model.get_learned_conditioning([""])
+        samples, _ = sampler.sample(S=steps, conditioning=c, batch_size=1, shape=shape, verbose=False,
+                                    unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc,
+                                    eta=0., x_T=x_T)
+        return samples
+
+    def calibrate():
+        for prompt in opt.calib_prompts:
+            sample(prompt, opt.calib_steps)
+
+    with torch.no_grad():
+        model.model.diffusion_model = unet
+        convs, errors = calibrate_convs(unet, calibrate, opt.max_conv_error)
+        quantize_unet(unet, convs=convs)
+        print(f"int8 weights for {len(convs)}/{len(errors)} convolutions and "
+              f"{len(unet.quantization['linears'])} Linear layers, "
+              f"largest conv error {max(errors.values()):.2e}")
+        save_quantized_unet(unet, opt.out)
+        fp32_bytes = sum(t.numel() * t.element_size() for t in fp32_unet.state_dict().values())
+        print(f"Saved quantized UNet to {opt.out}: {os.path.getsize(opt.out) / 2 ** 20:.0f} MB "
+              f"against {fp32_bytes / 2 ** 20:.0f} MB of fp32 weights")
+        print("int8 compute in the Linear layers only, the int8 convolutions dequantize their weights once "
+              "and run at fp32 speed")
+        if opt.skip_report:
+            return
+
+        torch.manual_seed(opt.seed)
+        x = torch.randn(2, *shape)
+        t = torch.full((2,), 500, dtype=torch.long)
+        c = model.get_learned_conditioning(2 * [opt.prompt])
+        t_fp32, ref = timeit(lambda: fp32_unet(x, t, context=c), opt.iters)
+        t_int8, out = timeit(lambda: unet(x, t, context=c), opt.iters)
+        err = ((out - ref).norm() / ref.norm()).item()
+        print(f"UNet forward, batch 2: fp32 {t_fp32:.3f}s  int8 {t_int8:.3f}s  "
+              f"speedup {t_fp32 / t_int8:.2f}x  eps rel. error {err:.3e}")
+
+        start_code = torch.randn([1] + shape, generator=torch.Generator().manual_seed(opt.seed))
+        images = []
+        for name, m in [("fp32", fp32_unet), ("int8", unet)]:
+            model.model.diffusion_model = m
+            t0 = time.perf_counter()
+            samples = sample(opt.prompt, opt.ddim_steps, x_T=start_code)
+            images.append(torch.clamp((model.decode_first_stage(samples) + 1.) / 2., 0., 1.))
+            print(f"DDIM {opt.ddim_steps} steps, {name}: {time.perf_counter() - t0:.1f}s")
+        print(f"PSNR int8 against fp32: {psnr(images[1], images[0]):.2f} dB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the tests import ldm from the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+# command line tool, not a test module
+collect_ignore = ["test_watermark.py"]
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+import ldm.modules.attention as attention_module
+from ldm.modules.attention import attention, chunked_attention
+
+
+def dense(q, k, v, scale, mask=None):
+    sim = torch.einsum("...id,...jd->...ij", q, k) * scale
+    if mask is not None:
+        sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+    return sim.softmax(dim=-1) @ v
+
+
+def inputs(n=37, m=29, d=8, magnitude=1., seed=0):
+    g = torch.Generator().manual_seed(seed)
+    q, k, v = (torch.randn(2, 3, length, d, generator=g, dtype=torch.float64) for length in (n, m, m))
+    return q * magnitude, k, v
+
+
+@pytest.mark.parametrize("query_chunk_size,key_chunk_size", [(1024, 4096), (8, 4096), (1024, 5), (8, 5), (1, 1)])
+def test_chunked_matches_dense(query_chunk_size, key_chunk_size):
+    q, k, v = inputs()
+    out = chunked_attention(q, k, v, 0.35, query_chunk_size=query_chunk_size, key_chunk_size=key_chunk_size)
+    assert torch.allclose(out, dense(q, k, v, 0.35), atol=1e-10)
+
+
+def test_online_softmax_is_stable_for_large_logits():
+    # logits of several hundred overflow a naive exp, the running max has to grow between key chunks
+    q, k, v = inputs(magnitude=200.)
+    k[..., -3:, :] *= 3
+    out = chunked_attention(q, k, v, 1., query_chunk_size=8, key_chunk_size=4)
+    assert torch.isfinite(out).all()
+    assert torch.allclose(out, dense(q, k, v, 1.), atol=1e-8)
+
+
+@pytest.mark.parametrize("per_query", [False, True])
+def test_masks(per_query):
+    q, k, v = inputs()
+    g = torch.Generator().manual_seed(1)
+    shape = (2, 1, q.shape[-2] if per_query else 1, k.shape[-2])
+    mask = torch.rand(shape, generator=g) > 0.3
+    mask[..., 0] = True
+    out = chunked_attention(q, k, v, 0.35, mask=mask, query_chunk_size=8, key_chunk_size=5)
+    assert torch.allclose(out, dense(q, k, v, 0.35, mask), atol=1e-10)
+
+
+def test_attention_fallback_and_sdpa_agree(monkeypatch):
+    q, k, v = (t.float() for t in inputs())
+    expected = dense(q, k, v, 0.2)
+    monkeypatch.setattr(attention_module, "USE_SDPA", False)
+    assert torch.allclose(attention(q, k, v, scale=0.2, query_chunk_size=8, key_chunk_size=5), expected, atol=1e-5)
+    if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        monkeypatch.setattr(attention_module, "USE_SDPA", True)
+        # non-contiguous last dim and a scale other than dim_head ** -0.5
+        qt = q.transpose(-1, -2).contiguous().transpose(-1, -2)
+        assert torch.allclose(attention(qt, k, v, scale=0.2), expected, atol=1e-5)
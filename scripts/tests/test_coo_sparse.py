@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from ldm.coo_sparse import COOSparseTensor, convert_dense_to_coo, get_encryption_context
+
+
+@pytest.fixture(scope="module")
+def context():
+    return get_encryption_context()
+
+
+def sparse_latent(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    x = torch.randn(2, 4, 8, 8, generator=g)
+    x[torch.rand(x.shape, generator=g) < 0.7] = 0
+    return x
+
+
+def test_dense_round_trip():
+    x = sparse_latent()
+    coo = convert_dense_to_coo(x)
+    assert coo.flat_indices.dtype == np.int32 and len(coo.flat_indices) == int((x != 0).sum())
+    assert coo.shape == tuple(x.shape)
+    assert torch.equal(torch.tensor(coo.to_dense(), dtype=x.dtype), x)
+    assert np.array_equal(coo.indices, torch.nonzero(x).numpy())
+
+
+def test_list_input_matches_tensor_input():
+    x = sparse_latent()[0, 0]
+    from_list, from_tensor = convert_dense_to_coo(x.tolist()), convert_dense_to_coo(x)
+    assert np.array_equal(from_list.flat_indices, from_tensor.flat_indices)
+    assert torch.allclose(torch.as_tensor(from_list.values, dtype=torch.float32), from_tensor.values)
+
+
+def test_merge_tensor():
+    x = sparse_latent()
+    remain = torch.randn(x.shape) * (x == 0)
+    before = remain.clone()
+    merged = convert_dense_to_coo(x).merge_tensor(remain)
+    assert torch.equal(merged, x + remain)
+    assert torch.equal(remain, before)
+    # nested lists take the generic path
+    merged_list = convert_dense_to_coo(x).merge_tensor(remain.tolist())
+    assert torch.allclose(torch.tensor(merged_list), x + remain)
+
+
+def test_encrypted_update_and_merge(context):
+    # the sampler's step: encrypt the kept elements, update them under HE, decrypt and merge the plain part
+    x = sparse_latent()
+    remain = torch.randn(x.shape) * (x == 0)
+    a, b = torch.randn(x.shape), 0.7
+    coo = convert_dense_to_coo(x)
+    coo.encrypt(context)
+    updated = (coo * a + a) * b
+    assert updated.flat_indices is coo.flat_indices
+    result = updated.decrypt().merge_tensor((remain * a + a) * b)
+    # CKKS noise of the 2^26 scale of get_encryption_context(), mostly from the plaintext multiplications
+    assert torch.allclose(result, ((x + remain) * a + a) * b, atol=5e-2)
+    assert torch.equal(result[x == 0], ((remain * a + a) * b)[x == 0])
+    coo.decrypt_inplace()
+    assert torch.allclose(torch.tensor(coo.to_dense(), dtype=x.dtype), x, atol=1e-4)
+
+
+def test_indices_from_coordinates():
+    coo = COOSparseTensor([1., 2.], [(0, 1, 1), (1, 0, 0)], (2, 2, 2))
+    assert coo.flat_indices.tolist() == [3, 4]
+    assert coo.to_dense() == [[[0., 0.], [0., 1.]], [[2., 0.], [0., 0.]]]
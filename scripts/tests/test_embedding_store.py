@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from ldm.data.embedding_store import EmbeddingStore
+
+
+@pytest.fixture
+def database(tmp_path):
+    rng = np.random.default_rng(0)
+    parts = []
+    for i, n in enumerate([70, 45, 30]):
+        part = dict(embedding=rng.standard_normal((n, 8)).astype(np.float32),
+                    img_id=np.arange(n) + 1000 * i,
+                    patch_coords=rng.integers(0, 64, (n, 4)))
+        np.savez(tmp_path / f"part{i}.npz", **part)
+        parts.append(part)
+    full = {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+    return tmp_path, full
+
+
+def build(database, **kwargs):
+    path, full = database
+    store = EmbeddingStore.build(sorted(str(p) for p in path.glob("*.npz")), str(path / "store"), **kwargs)
+    return store, full
+
+
+def unit(x):
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_take_across_shards(database):
+    # shard boundaries at 40, 80, 120 straddle the file boundaries at 70 and 115
+    store, full = build(database, shard_size=40, chunk_rows=16)
+    assert len(store) == 145 and len(store.shard_rows) == 4
+    indices = np.array([[0, 39, 40, 144], [79, 80, 114, 115]])
+    assert np.allclose(store.take("embedding", indices), unit(full["embedding"])[indices], atol=1e-6)
+    assert np.array_equal(store.take("img_id", indices), full["img_id"][indices])
+    assert np.array_equal(store.take("patch_coords", indices), full["patch_coords"][indices])
+    assert np.array_equal(store["img_id"], full["img_id"])
+
+
+def test_take_rejects_out_of_range(database):
+    store, _ = build(database, shard_size=40)
+    for bad in [[-1], [0, 145]]:
+        with pytest.raises(IndexError):
+            store.take("img_id", bad)
+
+
+def test_chunks_and_normalized_embeddings(database):
+    store, full = build(database, shard_size=40, dtype="float16")
+    starts, chunks = zip(*store.chunks(chunk_rows=25))
+    assert np.allclose(np.concatenate(chunks), unit(full["embedding"]), atol=1e-3)
+    assert np.allclose(np.concatenate([c for _, c in store.chunks(normalized=False)]), full["embedding"],
+                       atol=1e-2)
+    embeddings = store.normalized_embeddings()
+    assert embeddings.dtype == np.float32 and embeddings.shape == (145, 8)
+    assert np.allclose(embeddings, unit(full["embedding"]), atol=1e-3)
+    # the float32 copy is reused when reopened
+    assert np.array_equal(EmbeddingStore(store.path).normalized_embeddings(), embeddings)
+
+
+def test_open_or_build(database):
+    path, full = database
+    store = EmbeddingStore.open_or_build(str(path))
+    assert EmbeddingStore.exists(store.path) and len(store) == len(full["img_id"])
+    assert EmbeddingStore.open_or_build(str(path)).shard_rows == store.shard_rows
+    with pytest.raises(ValueError):
+        EmbeddingStore.open_or_build(str(path / "missing"))
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import tenseal as ts
+import torch
+
+from ldm.coo_sparse import convert_dense_to_coo
+from ldm.enc_spool import CiphertextSpool
+
+
+@pytest.fixture(scope="module")
+def context():
+    context = ts.context(ts.SCHEME_TYPE.CKKS, poly_modulus_degree=8192, coeff_mod_bit_sizes=[31, 26, 26, 31])
+    context.global_scale = 2 ** 26
+    return context
+
+
+def step_state(context, i):
+    g = torch.Generator().manual_seed(i)
+    x = torch.randn(1, 4, 8, 8, generator=g)
+    new_image = x * (torch.rand(x.shape, generator=g) > 0.5)
+    coo = convert_dense_to_coo(new_image)
+    coo.encrypt(context)
+    old_eps = [torch.randn(1, 4, 8, 8, generator=g) for _ in range(min(i, 3))]
+    return x, coo, x - new_image, old_eps
+
+
+def test_resume_from_last_step(tmp_path, context):
+    meta = dict(shape=[1, 4, 8, 8], steps=10)
+    spool = CiphertextSpool(str(tmp_path), keep=2)
+    spool.save_context(context, meta)
+    for i in range(4):
+        x, coo, remain, old_eps = step_state(context, i)
+        torch.manual_seed(100 + i)
+        np.random.seed(100 + i)
+        spool.write(i, coo, remain, old_eps)
+    spool.wait()
+    assert spool.steps() == [2, 3]
+    expected_torch, expected_numpy = torch.rand(3), np.random.rand(3)
+    spool.close()
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    restored_context, i, x_prev, restored_eps = CiphertextSpool(str(tmp_path)).resume(meta, torch.device("cpu"))
+    assert i == 3
+    assert torch.allclose(x_prev, x, atol=1e-3)
+    assert all(torch.equal(a, b) for a, b in zip(restored_eps, old_eps)) and len(restored_eps) == 3
+    # the RNG states are those of the spooled step
+    assert torch.equal(torch.rand(3), expected_torch) and np.array_equal(np.random.rand(3), expected_numpy)
+    assert restored_context.is_private()
+
+
+def test_nothing_to_resume(tmp_path, context):
+    meta = dict(steps=10)
+    spool = CiphertextSpool(str(tmp_path))
+    assert spool.resume(meta, torch.device("cpu")) is None
+    spool.save_context(context, meta)
+    # a context without finished steps
+    assert spool.resume(meta, torch.device("cpu")) is None
+    _, coo, remain, old_eps = step_state(context, 1)
+    spool.write(1, coo, remain, old_eps)
+    spool.wait()
+    # a different run
+    assert spool.resume(dict(steps=20), torch.device("cpu")) is None
+    assert spool.resume(meta, torch.device("cpu")) is not None
+    # a new run drops the old steps
+    spool.save_context(context, dict(steps=20))
+    assert spool.steps() == []
+    spool.close()
+
+
+def test_partial_write_is_ignored(tmp_path, context):
+    meta = dict(steps=10)
+    spool = CiphertextSpool(str(tmp_path))
+    spool.save_context(context, meta)
+    _, coo, remain, old_eps = step_state(context, 1)
+    spool.write(1, coo, remain, old_eps)
+    spool.wait()
+    # a crash in the middle of writing step 2 leaves only its temporary file
+    (tmp_path / "step_0002.pt.tmp").write_bytes(b"partial")
+    assert spool.resume(meta, torch.device("cpu"))[1] == 1
+    spool.close()
+
+
+def test_background_write_errors_are_raised(tmp_path, context):
+    spool = CiphertextSpool(str(tmp_path))
+    spool.save_context(context, dict(steps=10))
+    _, coo, remain, old_eps = step_state(context, 1)
+    coo.values = None
+    spool.write(1, coo, remain, old_eps)
+    with pytest.raises(AttributeError):
+        spool.wait()
+    spool.close()
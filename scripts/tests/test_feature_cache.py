@@ -0,0 +1,66 @@
+import torch
+
+from ldm.modules.diffusionmodules.openaimodel import (UNetModel, begin_feature_cache_step, enable_feature_cache,
+                                                      end_feature_cache_run)
+
+
+class Wrapper(torch.nn.Module):
+    """Stands in for LatentDiffusion: model.model.diffusion_model is the UNet."""
+    def __init__(self, unet):
+        super().__init__()
+        self.model = torch.nn.Module()
+        self.model.diffusion_model = unet
+
+
+def make_unet(interval=3):
+    torch.manual_seed(0)
+    unet = UNetModel(image_size=8, in_channels=4, out_channels=4, model_channels=32, attention_resolutions=[2],
+                     num_res_blocks=1, channel_mult=[1, 2], num_heads=2, use_spatial_transformer=True,
+                     context_dim=16, transformer_depth=1).eval()
+    return enable_feature_cache(unet, interval)
+
+
+def inputs(batch_size=2):
+    return torch.randn(batch_size, 4, 8, 8), torch.full((batch_size,), 10), torch.randn(batch_size, 3, 16)
+
+
+def test_calls_outside_a_run_store_nothing():
+    # e.g. the DPM solver, which never calls begin_feature_cache_step
+    unet = make_unet()
+    x, t, context = inputs()
+    with torch.no_grad():
+        expected = enable_feature_cache(make_unet(), None)(x, t, context=context)
+        for _ in range(20):
+            assert torch.allclose(unet(x, t, context=context), expected, atol=1e-6)
+    assert unet.feature_cache.features == dict()
+
+
+def test_features_are_bounded_by_the_calls_per_step():
+    unet = make_unet()
+    model = Wrapper(unet)
+    x, t, context = inputs()
+    with torch.no_grad():
+        for run in range(3):
+            for i in range(10):
+                begin_feature_cache_step(model, i)
+                for _ in range(2):
+                    unet(x, t, context=context)
+                assert len(unet.feature_cache.features) == 2
+            end_feature_cache_run(model)
+            assert unet.feature_cache.features == dict()
+            # stray calls between runs do not grow the cache either
+            unet(x, t, context=context)
+            assert unet.feature_cache.features == dict()
+
+
+def test_cheap_steps_reuse_the_full_step():
+    unet = make_unet()
+    model = Wrapper(unet)
+    x, t, context = inputs()
+    with torch.no_grad():
+        begin_feature_cache_step(model, 0)
+        full = unet(x, t, context=context)
+        begin_feature_cache_step(model, 1)
+        cheap = unet(x, t, context=context)
+    # same input, so the deep features of step 0 are exactly the ones step 1 would compute
+    assert torch.allclose(cheap, full, atol=1e-5)
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from ldm.modules.ivfpq import BruteForceIndex, IVFPQIndex, build_index, load_index
+
+
+def pool(n=4000, dim=16, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    x = (centers[rng.integers(clusters, size=n)] + 0.3 * rng.standard_normal((n, dim))).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    q = x[rng.integers(n, size=50)] + 0.05 * rng.standard_normal((50, dim)).astype(np.float32)
+    return x, q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def exact(x, q, k):
+    return np.argsort(-(q @ x.T), axis=1, kind="stable")[:, :k]
+
+
+def recall(nns, truth):
+    return np.mean([len(np.intersect1d(a, b)) / len(b) for a, b in zip(nns, truth)])
+
+
+def make_index(x, nlist=16, nprobe=4, reorder_k=50):
+    index = IVFPQIndex.train(x, nlist, dims_per_block=2, n_centers=64, iters=10, nprobe=nprobe,
+                             reorder_k=reorder_k)
+    return index.add(x, chunk_rows=1000)
+
+
+def test_brute_force_is_exact_across_chunks():
+    x, q = pool()
+    nns, distances = BruteForceIndex(x, chunk_rows=700).search_batched(q, final_num_neighbors=10)
+    assert (nns == exact(x, q, 10)).all()
+    assert np.allclose(distances, np.take_along_axis(q @ x.T, nns, axis=1), atol=1e-6)
+
+
+def test_ivfpq_recall():
+    x, q = pool()
+    index = make_index(x)
+    nns, distances = index.search_batched(q, final_num_neighbors=10)
+    assert recall(nns, exact(x, q, 10)) >= 0.9
+    # reordered distances are exact dot products
+    assert np.allclose(distances, np.take_along_axis(q @ x.T, nns, axis=1), atol=1e-5)
+    # the list layout holds every vector exactly once
+    assert sorted(index.ids.tolist()) == list(range(len(x)))
+
+
+def test_serialize_round_trip(tmp_path):
+    x, q = pool()
+    index = make_index(x)
+    index.serialize(str(tmp_path))
+    loaded = load_index(str(tmp_path), x)
+    for a, b in zip(index.search_batched(q, 10), loaded.search_batched(q, 10)):
+        assert np.array_equal(a, b)
+    BruteForceIndex(x).serialize(str(tmp_path / "bf"))
+    assert isinstance(load_index(str(tmp_path / "bf"), x), BruteForceIndex)
+
+
+def test_probes_more_lists_for_k_candidates():
+    x, q = pool(n=600)
+    # ~5 vectors per list, one probed list can not hold 30 neighbours
+    index = make_index(x, nlist=128, nprobe=1, reorder_k=0)
+    nns, _ = index.search_batched(q, final_num_neighbors=30)
+    assert (nns >= 0).all()
+    assert all(len(set(row)) == 30 for row in nns)
+
+
+def test_pads_only_when_the_index_is_too_small():
+    x, q = pool(n=300)
+    index = make_index(x, nlist=4, nprobe=1)
+    nns, distances = index.search_batched(q, final_num_neighbors=len(x) + 5)
+    assert (nns[:, :len(x)] >= 0).all() and (nns[:, len(x):] == -1).all()
+    assert np.isneginf(distances[:, len(x):]).all()
+
+
+def test_build_index_heuristics():
+    x, _ = pool(n=1000)
+    assert isinstance(build_index(x, 10), BruteForceIndex)
+    x, q = pool(n=25000, dim=8)
+    index = build_index(x, 10, reorder_k=300, dims_per_block=2, n_centers=256, training_sample_size=5000)
+    assert isinstance(index, IVFPQIndex) and index.nlist == 1
+    assert recall(index.search_batched(q, 10)[0], exact(x, q, 10)) >= 0.9
+
+
+def test_kmeans_needs_enough_points():
+    x, _ = pool(n=10)
+    with pytest.raises(AssertionError):
+        IVFPQIndex.train(x, 32, dims_per_block=2, n_centers=4)
@@ -0,0 +1,56 @@
+import torch
+
+from ldm.modules.attention import CrossAttention, CrossAttentionKVCache, cross_attention_kv_cache
+
+
+def make_layer():
+    torch.manual_seed(0)
+    return CrossAttention(query_dim=16, context_dim=8, heads=2, dim_head=4).eval()
+
+
+def test_cached_attention_matches_uncached():
+    layer = make_layer()
+    x, context = torch.randn(2, 5, 16), torch.randn(2, 3, 8)
+    with torch.no_grad():
+        expected = layer(x, context)
+        with cross_attention_kv_cache() as cache:
+            for _ in range(3):
+                assert torch.allclose(layer(x, context), expected, atol=1e-6)
+    assert (cache.misses, cache.hits) == (1, 2)
+
+
+def test_equal_context_is_matched_by_value():
+    layer, cache = make_layer(), CrossAttentionKVCache()
+    context = torch.randn(2, 3, 8)
+    with torch.no_grad():
+        cache.get(layer, context)
+        cache.get(layer, context.clone())
+        cache.get(layer, context + 1)
+    assert (cache.misses, cache.hits) == (2, 1)
+
+
+def test_in_place_modification_invalidates():
+    layer, cache = make_layer(), CrossAttentionKVCache()
+    context = torch.randn(2, 3, 8)
+    with torch.no_grad():
+        cache.get(layer, context)
+        context.mul_(2)
+        k, v = cache.get(layer, context)
+        assert torch.allclose(k, layer.to_k(context))
+        assert torch.allclose(v, layer.to_v(context))
+        # a copy of the old value must not match the modified context's entry either
+        k, _ = cache.get(layer, context / 2)
+        assert torch.allclose(k, layer.to_k(context / 2))
+    assert cache.misses == 3
+
+
+def test_stale_context_is_not_matched_by_value():
+    layer, cache = make_layer(), CrossAttentionKVCache()
+    context = torch.randn(2, 3, 8)
+    old = context.clone()
+    with torch.no_grad():
+        cache.get(layer, context)
+        context.add_(1)
+        k, _ = cache.get(layer, old + 1)
+        assert torch.allclose(k, layer.to_k(old + 1))
+    assert cache.misses == 2
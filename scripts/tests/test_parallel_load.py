@@ -0,0 +1,113 @@
+import os
+import zipfile
+
+import numpy as np
+import pytest
+
+from ldm.util import load_npz_pool, parallel_fill, parallel_prefetch_iter, shared_empty
+
+
+def write_parts(tmp_path):
+    rng = np.random.default_rng(0)
+    parts = []
+    for i, n in enumerate([5, 0, 5000, 3000]):
+        part = dict(embedding=rng.standard_normal((n, 6)).astype(np.float32),
+                    img_id=np.arange(n, dtype=np.int64) + 100 * i,
+                    # Fortran order takes the fallback path
+                    patch_coords=np.asfortranarray(rng.integers(0, 9, (n, 4))),
+                    only_here=np.zeros(1) if i == 0 else None,
+                    scalar=np.float64(i))
+        part = {k: v for k, v in part.items() if v is not None}
+        save = np.savez_compressed if i % 2 else np.savez
+        save(tmp_path / f"part{i}.npz", **part)
+        parts.append(part)
+    return [str(tmp_path / f"part{i}.npz") for i in range(len(parts))], parts
+
+
+@pytest.mark.parametrize("n_proc", [1, 3])
+def test_load_npz_pool_matches_concatenation(tmp_path, n_proc):
+    paths, parts = write_parts(tmp_path)
+    pool = load_npz_pool(paths, n_proc)
+    assert sorted(pool) == ["embedding", "img_id", "patch_coords"]
+    for key, value in pool.items():
+        assert np.array_equal(value, np.concatenate([p[key] for p in parts]))
+
+
+def test_load_npz_pool_promotes_dtypes(tmp_path):
+    rng = np.random.default_rng(0)
+    parts = [dict(embedding=rng.standard_normal((n, 6)).astype(dtype), img_id=np.arange(n, dtype=id_dtype))
+             for n, dtype, id_dtype in [(40, np.float32, np.int64), (30, np.float64, np.int32),
+                                        (20, np.float16, np.int16), (10, ">f4", ">i8")]]
+    paths = [str(tmp_path / f"part{i}.npz") for i in range(len(parts))]
+    for path, part in zip(paths, parts):
+        np.savez(path, **part)
+    pool = load_npz_pool(paths, 2)
+    for key, value in pool.items():
+        expected = np.concatenate([p[key] for p in parts])
+        assert value.dtype == expected.dtype
+        assert np.array_equal(value, expected)
+
+
+@pytest.mark.parametrize("part", [2, 3])
+def test_load_npz_pool_propagates_errors(tmp_path, part):
+    paths, _ = write_parts(tmp_path)
+    # corrupt the embedding data, the headers the parent reads stay intact
+    info = zipfile.ZipFile(paths[part]).getinfo("embedding.npy")
+    data_start = info.header_offset + 30 + len(info.filename) + len(info.extra)
+    with open(paths[part], "r+b") as f:
+        f.seek(data_start + info.compress_size - 8)
+        f.write(b"\xff" * 8)
+    with pytest.raises(RuntimeError, match="parallel_fill worker failed"):
+        load_npz_pool(paths, 2)
+
+
+def fill(item, rows):
+    if item == 3:
+        raise ValueError("bad item")
+    rows[:] = item
+
+
+@pytest.mark.parametrize("cpu_intensive", [True, False])
+def test_parallel_fill(cpu_intensive):
+    data = [0, 1, 2, 4]
+    offsets = [0, 2, 3, 6, 7]
+    out = shared_empty((7,), np.int64)
+    parallel_fill(fill, data, out, offsets, 2, cpu_intensive=cpu_intensive)
+    assert out.tolist() == [0, 0, 1, 2, 2, 2, 4]
+
+
+@pytest.mark.parametrize("cpu_intensive", [True, False])
+def test_parallel_fill_worker_error(cpu_intensive):
+    out = shared_empty((4,), np.int64)
+    with pytest.raises(RuntimeError, match="bad item"):
+        parallel_fill(fill, [0, 1, 3, 2], out, [0, 1, 2, 3, 4], 2, cpu_intensive=cpu_intensive)
+
+
+def die(item, rows):
+    if item == 2:
+        os._exit(3)
+    rows[:] = item
+
+
+def test_parallel_fill_dead_worker():
+    out = shared_empty((4,), np.int64)
+    with pytest.raises(RuntimeError, match="exit code 3"):
+        parallel_fill(die, [0, 1, 2, 3], out, [0, 1, 2, 3, 4], 2)
+
+
+def square(item):
+    if item == 5:
+        raise ValueError("bad item")
+    return item * item
+
+
+@pytest.mark.parametrize("cpu_intensive", [True, False])
+def test_parallel_prefetch_iter(cpu_intensive):
+    assert list(parallel_prefetch_iter(square, list(range(5)), 3, cpu_intensive=cpu_intensive)) == \
+        [0, 1, 4, 9, 16]
+    results = []
+    with pytest.raises(RuntimeError, match="bad item"):
+        for r in parallel_prefetch_iter(square, list(range(8)), 2, cpu_intensive=cpu_intensive):
+            results.append(r)
+    # everything before the failing item is delivered, in order
+    assert results == [0, 1, 4, 9, 16]
@@ -1,12 +1,18 @@
 import os, sys
 import numpy as np
-import scann
 import argparse
 import glob
 from multiprocessing import cpu_count
 from tqdm import tqdm
 
-from ldm.util import parallel_data_prefetch
+from ldm.util import load_npz_pool
+from ldm.data.embedding_store import EmbeddingStore
+from ldm.modules.ivfpq import build_index
+
+try:
+    import scann
+except ImportError:
+    scann = None
 
 
 def search_bruteforce(searcher):
@@ -33,25 +39,14 @@ def load_datapool(dpath):
         database = {key: compressed[key] for key in compressed.files}
         return database
 
-    def load_multi_files(data_archive):
-        database = {key: [] for key in data_archive[0].files}
-        for d in tqdm(data_archive, desc=f'Loading datapool from {len(data_archive)} individual files.'):
-            for key in d.files:
-                database[key].append(d[key])
-
-        return database
-
     print(f'Load saved patch embedding from "{dpath}"')
     file_content = glob.glob(os.path.join(dpath, '*.npz'))
 
     if len(file_content) == 1:
         data_pool = load_single_file(file_content[0])
     elif len(file_content) > 1:
-        data = [np.load(f) for f in file_content]
-        prefetched_data = parallel_data_prefetch(load_multi_files, data,
-                                                 n_proc=min(len(data), cpu_count()), target_data_type='dict')
-
-        data_pool = {key: np.concatenate([od[key] for od in prefetched_data], axis=1)[0] for key in prefetched_data[0].keys()}
+        # workers decompress the files straight into one shared array per key
+        data_pool = load_npz_pool(sorted(file_content), n_proc=min(len(file_content), cpu_count()))
     else:
         raise ValueError(f'No npz-files in specified path "{dpath}" is this directory existing?')
 
@@ -69,16 +64,33 @@ def train_searcher(opt,
                    num_leaves=None,
                    num_leaves_to_search=None,):
 
-    data_pool = load_datapool(opt.database)
     k = opt.knn
 
     if not reorder_k:
         reorder_k = 2 * k
 
-    # normalize
-    # embeddings =
-    searcher = scann.scann_ops_pybind.builder(data_pool['embedding'] / np.linalg.norm(data_pool['embedding'], axis=1)[:, np.newaxis], k, metric)
-    pool_size = data_pool['embedding'].shape[0]
+    if opt.no_store:
+        data_pool = load_datapool(opt.database)
+        embeddings = data_pool['embedding'] / np.linalg.norm(data_pool['embedding'], axis=1)[:, np.newaxis]
+    else:
+        # memory-mapped, normalized once when the store is built
+        store = EmbeddingStore.open_or_build(opt.database, opt.store, dtype=opt.store_dtype)
+        print(f'Opened embedding store of length {len(store)} at "{store.path}"')
+        embeddings = store.normalized_embeddings()
+    pool_size = embeddings.shape[0]
+
+    if opt.backend == 'auto':
+        opt.backend = 'scann' if scann is not None else 'ivfpq'
+    if opt.backend == 'ivfpq':
+        print(f'Building NumPy IVF-PQ index over {pool_size} samples (k: {k}, reorder_k: {reorder_k})')
+        searcher = build_index(embeddings, k, reorder_k=reorder_k, num_leaves=num_leaves,
+                               num_leaves_to_search=num_leaves_to_search,
+                               training_sample_size=partioning_trainsize)
+        searcher.serialize(opt.target_path)
+        print(f'Saved trained searcher under "{opt.target_path}"')
+        return
+    assert scann is not None, 'scann is not installed, use --backend ivfpq'
+    searcher = scann.scann_ops_pybind.builder(embeddings, k, metric)
 
     print(*(['#'] * 100))
     print('Initializing scaNN searcher with the following values:')
@@ -103,7 +115,7 @@ def train_searcher(opt,
         print('Using using partioning, asymmetric hashing search and reordering.')
 
         if not partioning_trainsize:
-            partioning_trainsize = data_pool['embedding'].shape[0] // 10
+            partioning_trainsize = pool_size // 10
         if not num_leaves:
             num_leaves = int(np.sqrt(pool_size))
 
@@ -142,6 +154,26 @@ if __name__ == '__main__':
                         type=int,
                         help='number of nearest neighbors, for which the searcher shall be optimized')
 
+    parser.add_argument('--store',
+                        default=None,
+                        type=str,
+                        help='memory-mapped embedding store of the database, built from its npz-files if missing '
+                             '(default: <database>/store)')
+    parser.add_argument('--store_dtype',
+                        default='float32',
+                        choices=['float32', 'float16'],
+                        type=str,
+                        help='dtype of the normalized embeddings in a newly built store')
+    parser.add_argument('--no_store',
+                        action='store_true',
+                        help='load the npz-files into memory instead of using the embedding store')
+    parser.add_argument('--backend',
+                        default='auto',
+                        choices=['auto', 'scann', 'ivfpq'],
+                        type=str,
+                        help='searcher to train: scann, or the NumPy IVF-PQ index of ldm/modules/ivfpq.py that '
+                             'needs no scann install (default: scann if it is installed)')
+
     opt, _  = parser.parse_known_args()
 
     train_searcher(opt,)
\ No newline at end of file
@@ -15,6 +15,7 @@ from torch import autocast
 from contextlib import contextmanager, nullcontext
 
 from ldm.util import instantiate_from_config
+from ldm.flat_ckpt import load_checkpoint, load_state_dict_mmap
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.models.diffusion.dpm_solver import DPMSolverSampler
@@ -49,12 +50,11 @@ def numpy_to_pil(images):
 
 def load_model_from_config(config, ckpt, verbose=False):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
+    sd, global_step = load_checkpoint(ckpt)
+    if global_step is not None:
+        print(f"Global Step: {global_step}")
     model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    m, u = load_state_dict_mmap(model, sd)
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)